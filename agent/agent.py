@@ -5,42 +5,192 @@
 
 import argparse
 import cgi
-import io
+import collections
+import ctypes
+import errno
+import fnmatch
+import hashlib
 import json
+import math
+import mmap
+import multiprocessing.pool
 import os
 import platform
+import Queue
 import re
 import shutil
 import stat
 import subprocess
 import sys
+import tarfile
 import tempfile
+import threading
+import time
 import traceback
+import urlparse
 import zipfile
+import zlib
 
 import SimpleHTTPServer
 import SocketServer
 
 AGENT_VERSION = "0.7"
+BUFSIZE = 1024 * 1024
+
+# Uploaded zip files up to this size are extracted from memory.
+SPOOL_SIZE = 64 * 1024 * 1024
+
+# Amount of stdout and stderr output that is kept around.
+LOG_SIZE = 1024 * 1024
+
+# Files smaller than this are never compressed when being retrieved.
+COMPRESS_MIN_SIZE = 16 * 1024
+
+# Leading bytes of common file formats that are compressed already.
+COMPRESSED_MAGIC = (
+    "PK\x03\x04", "\x1f\x8b", "BZh", "\xfd7zXZ\x00", "7z\xbc\xaf\x27\x1c",
+    "Rar!", "MSCF", "\x89PNG", "\xff\xd8\xff", "GIF8",
+)
+
+# Routes that can't be part of a /batch request as they don't respond with
+# JSON, but with a (streamed) file.
+BATCH_UNSUPPORTED = "/batch", "/retrieve", "/archive"
+
+# Upper limit for the timeout of a /status/wait request, in seconds.
+STATUS_WAIT_MAX = 3600
+
 AGENT_FEATURES = [
-    "execpy", "pinning", "logs", "largefile", "unicodepath",
+    "execpy", "pinning", "logs", "largefile", "unicodepath", "concurrent",
+    "cache", "range", "batch", "logbuffer", "statuswait", "keepalive",
+    "metrics", "stream", "compression", "hash", "archive",
 ]
 
-sys.stdout = io.BytesIO()
-sys.stderr = io.BytesIO()
+class LogBuffer(object):
+    """Bounded buffer holding the most recent output written to stdout and
+    stderr. Each byte is assigned a monotonically increasing offset so that
+    new output can be fetched incrementally."""
+    def __init__(self, size):
+        self.size = size
+        self.records = collections.deque()
+        # Offsets of the oldest byte still available and of the next byte.
+        self.start = self.end = 0
+        self.lock = threading.Lock()
+
+    def write(self, stream, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf8")
+
+        if not data:
+            return
+
+        with self.lock:
+            self.records.append((self.end, stream, data))
+            self.end += len(data)
+
+            # Drop the oldest output once we're over the limit.
+            while self.end - self.start > self.size:
+                offset, stream, data = self.records.popleft()
+                self.start = self.end - self.size
+                if offset + len(data) > self.start:
+                    excess = self.start - offset
+                    self.records.appendleft(
+                        (self.start, stream, data[excess:])
+                    )
+                else:
+                    self.start = offset + len(data)
+
+    def read(self, since=0):
+        """Read the output starting at the given offset.
+        @return: tuple of a dict with the stdout and stderr output, the
+                 offset to continue from, and the amount of bytes that have
+                 been dropped since the given offset.
+        """
+        ret = {"stdout": [], "stderr": []}
+        with self.lock:
+            for offset, stream, data in self.records:
+                if offset + len(data) > since:
+                    ret[stream].append(data[max(since - offset, 0):])
+
+            dropped = max(self.start - since, 0)
+            return (
+                dict((k, "".join(v)) for k, v in ret.items()),
+                self.end, dropped,
+            )
+
+class LogStream(object):
+    """File-like object that writes to the log buffer."""
+    def __init__(self, buffer, name):
+        self.buffer = buffer
+        self.name = name
+
+    def write(self, data):
+        self.buffer.write(self.name, data)
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        return self.buffer.read()[0][self.name]
+
+logs = LogBuffer(LOG_SIZE)
+sys.stdout = LogStream(logs, "stdout")
+sys.stderr = LogStream(logs, "stderr")
 
 class MiniHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
     server_version = "Cuckoo Agent"
 
-    def do_GET(self):
+    # Persistent connections, every response is framed by Content-Length.
+    protocol_version = "HTTP/1.1"
+
+    def init_request(self):
+        request.started = time.time()
         request.client_ip, request.client_port = self.client_address
+        request.headers = self.headers
+        request.args = dict(
+            urlparse.parse_qsl(urlparse.urlsplit(self.path).query)
+        )
+        request.stream = None
         request.form = {}
         request.files = {}
 
+    def do_GET(self):
+        self.init_request()
+
         if "client_ip" not in state or request.client_ip == state["client_ip"]:
             self.httpd.handle(self)
+        else:
+            self.close_connection = 1
 
     def do_POST(self):
+        self.init_request()
+
+        ctype, pdict = cgi.parse_header(self.headers.get("Content-Type", ""))
+        length = self.headers.get("Content-Length")
+
+        # Multipart requests are decoded while streaming so that uploaded
+        # files are written to their destination straight from the socket.
+        if ctype == "multipart/form-data" and pdict.get("boundary") and \
+                length and length.isdigit():
+            reader = MultipartReader(
+                self.rfile, pdict["boundary"], int(length)
+            )
+            self.parse_multipart(reader)
+        else:
+            reader = None
+            self.parse_form()
+
+        request.stream = reader
+
+        if "client_ip" not in state or request.client_ip == state["client_ip"]:
+            self.httpd.handle(self)
+        else:
+            self.close_connection = 1
+
+        # Consume whatever part of the request body the route didn't read.
+        if reader:
+            reader.drain()
+
+    def parse_form(self):
         environ = {
             "REQUEST_METHOD": "POST",
             "CONTENT_TYPE": self.headers.get("Content-Type"),
@@ -50,9 +200,6 @@ class MiniHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                                 headers=self.headers,
                                 environ=environ)
 
-        request.form = {}
-        request.files = {}
-
         # Another pretty fancy workaround. Since we provide backwards
         # compatibility with the Old Agent we will get an xmlrpc request
         # from the analyzer when the analysis has finished. Now xmlrpc being
@@ -67,8 +214,28 @@ class MiniHTTPRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
                 else:
                     request.form[key] = value.value.decode("utf8")
 
-        if "client_ip" not in state or request.client_ip == state["client_ip"]:
-            self.httpd.handle(self)
+    def parse_multipart(self, reader):
+        # Regular form fields are read up until the first file. The file
+        # itself is handed to the route as a stream, i.e., form fields have
+        # to precede the file in the request (as is the case for the Cuckoo
+        # host, which uses the requests library).
+        while True:
+            part = reader.next_part()
+            if not part:
+                break
+
+            if part.filename is not None:
+                request.files[part.name] = part
+                break
+
+            request.form[part.name] = part.read().decode("utf8")
+
+class ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Serves each connection in its own thread so that long running
+    transfers (e.g., a large /store or /retrieve) don't block the /status
+    polling of the host."""
+    allow_reuse_address = True
+    daemon_threads = True
 
 class MiniHTTPServer(object):
     def __init__(self):
@@ -82,9 +249,12 @@ class MiniHTTPServer(object):
             "POST": [],
         }
 
-    def run(self, host="0.0.0.0", port=8000):
-        self.s = SocketServer.TCPServer((host, port), self.handler)
-        self.s.allow_reuse_address = True
+    def run(self, host="0.0.0.0", port=8000, threaded=True):
+        if threaded:
+            self.s = ThreadingTCPServer((host, port), self.handler)
+        else:
+            self.s = SocketServer.TCPServer((host, port), self.handler)
+            self.s.allow_reuse_address = True
         self.s.serve_forever()
 
     def route(self, path, methods=["GET"]):
@@ -94,23 +264,48 @@ class MiniHTTPServer(object):
             return fn
         return register
 
-    def handle(self, obj):
-        for route, fn in self.routes[obj.command]:
-            if route.match(obj.path):
-                ret = fn()
-                break
-        else:
-            ret = json_error(404, message="Route not found")
-
-        ret.init()
-        obj.send_response(ret.status_code)
-        ret.headers(obj)
-        obj.end_headers()
+    def match(self, method, path):
+        """Find the route for a request.
+        @return: tuple of the route path and its function, or Nones.
+        """
+        for route, fn in self.routes[method]:
+            if route.match(path):
+                return route.pattern[:-1], fn
+        return None, None
+
+    def dispatch(self, method, path):
+        _, fn = self.match(method, path)
+        if not fn:
+            return json_error(404, message="Route not found")
+        return fn()
 
-        if isinstance(ret, jsonify):
-            obj.wfile.write(ret.json())
-        elif isinstance(ret, send_file):
-            ret.write(obj.wfile)
+    def handle(self, obj):
+        path, fn = self.match(obj.command, urlparse.urlsplit(obj.path).path)
+        key = obj.command, path or "unknown"
+
+        metrics.begin(key)
+        status_code, length = 500, 0
+        try:
+            ret = fn() if fn else json_error(404, message="Route not found")
+            ret.init()
+            obj.send_response(ret.status_code)
+            ret.headers(obj)
+            obj.end_headers()
+
+            if isinstance(ret, (jsonify, make_response)):
+                obj.wfile.write(ret.body)
+                length = len(ret.body)
+            elif isinstance(ret, send_file):
+                ret.write(obj.wfile)
+                length = ret.length
+            elif isinstance(ret, stream_response):
+                length = ret.write(obj)
+            status_code = ret.status_code
+        finally:
+            metrics.end(
+                key, status_code, time.time() - request.started,
+                int(obj.headers.get("Content-Length") or 0), length
+            )
 
     def shutdown(self):
         # BaseServer also features a .shutdown() method, but you can't use
@@ -124,53 +319,726 @@ class jsonify(object):
         self.values = kwargs
 
     def init(self):
-        pass
+        self.body = self.json()
 
     def json(self):
         return json.dumps(self.values)
 
     def headers(self, obj):
+        obj.send_header("Content-Type", "application/json")
+        obj.send_header("Content-Length", len(self.body))
+
+class make_response(object):
+    """Wrapper that represents Flask.make_response functionality."""
+    def __init__(self, body, content_type="text/plain"):
+        self.body = body
+        self.content_type = content_type
+        self.status_code = 200
+
+    def init(self):
         pass
 
+    def headers(self, obj):
+        obj.send_header("Content-Type", self.content_type)
+        obj.send_header("Content-Length", len(self.body))
+
+class stream_response(object):
+    """Wrapper that represents Flask.Response functionality for generators,
+    i.e., a response that is sent as it is being generated. HTTP/1.1 clients
+    receive it with chunked encoding, others until the connection closes."""
+    def __init__(self, generator, content_type="application/x-ndjson",
+                 content_encoding=None):
+        self.generator = generator
+        self.content_type = content_type
+        self.content_encoding = content_encoding
+        self.status_code = 200
+
+    def init(self):
+        pass
+
+    def headers(self, obj):
+        self.chunked = obj.request_version == "HTTP/1.1"
+
+        obj.send_header("Content-Type", self.content_type)
+        if self.content_encoding:
+            obj.send_header("Content-Encoding", self.content_encoding)
+        if self.chunked:
+            obj.send_header("Transfer-Encoding", "chunked")
+        else:
+            obj.close_connection = 1
+
+    def write(self, obj):
+        length = 0
+        for buf in self.generator:
+            if not buf:
+                continue
+
+            if self.chunked:
+                obj.wfile.write("%x\r\n%s\r\n" % (len(buf), buf))
+            else:
+                obj.wfile.write(buf)
+            length += len(buf)
+
+        if self.chunked:
+            obj.wfile.write("0\r\n\r\n")
+        return length
+
+class DecompressFile(object):
+    """File-like object that decompresses a gzip or zlib stream on the fly.
+    Each read returns at most the requested amount of bytes, regardless of
+    the compression ratio. A stream that is cut short raises an IOError
+    rather than ending quietly."""
+    WBITS = {
+        "gzip": 16 + zlib.MAX_WBITS,
+        "zlib": zlib.MAX_WBITS,
+    }
+
+    def __init__(self, f, encoding):
+        if encoding not in self.WBITS:
+            raise ValueError("Unsupported encoding: %s" % encoding)
+
+        self.f = f
+        self.decompressor = zlib.decompressobj(self.WBITS[encoding])
+        self.eof = False
+
+    def read(self, size=BUFSIZE):
+        while True:
+            # Data following the end of the stream is ignored, zlib in
+            # Python 2 keeps it around as unconsumed input as well.
+            if self.decompressor.unused_data:
+                return ""
+            elif self.decompressor.unconsumed_tail:
+                buf = self.decompressor.unconsumed_tail
+            elif self.eof:
+                return ""
+            else:
+                buf = self.f.read(BUFSIZE)
+                if not buf:
+                    self.eof = True
+                    if not self.ended():
+                        raise IOError("Compressed stream is truncated")
+                    return self.decompressor.flush()
+
+            buf = self.decompressor.decompress(buf, size)
+            if buf:
+                return buf
+
+    def ended(self):
+        """Returns whether the end of the compressed stream has been reached.
+        For gzip that includes verifying the CRC and length in its trailer.
+        Unlike in Python 3 the decompressor doesn't say so, but once the
+        stream has ended any further input is left unused."""
+        try:
+            probe = self.decompressor.copy()
+            probe.decompress("\x00")
+        except zlib.error:
+            return False
+        return probe.unused_data == "\x00"
+
 class send_file(object):
     """Wrapper that represents Flask.send_file functionality."""
-    def __init__(self, path):
+    # Compression level for retrieved files, zero disables compression.
+    compresslevel = 6
+    def __init__(self, path, byterange=None):
         self.path = path
+        self.byterange = byterange
         self.status_code = 200
 
     def init(self):
+        self.offset = 0
+        self.content_range = None
+
         if not os.path.isfile(self.path):
             self.status_code = 404
             self.length = 0
-        else:
-            self.length = os.path.getsize(self.path)
+            return
+
+        size = os.path.getsize(self.path)
+        self.length = size
+
+        try:
+            byterange = parse_range(self.byterange, size)
+        except ValueError:
+            self.status_code = 416
+            self.length = 0
+            self.content_range = "bytes */%d" % size
+            return
+
+        if byterange:
+            start, end = byterange
+            self.status_code = 206
+            self.offset, self.length = start, end - start + 1
+            self.content_range = "bytes %d-%d/%d" % (start, end, size)
 
     def write(self, sock):
         if not self.length:
             return
 
         with open(self.path, "rb") as f:
-            while True:
-                buf = f.read(1024 * 1024)
+            # Let the operating system send the file if it's able to and
+            # fall back to regular reads for whatever it didn't send.
+            sent = sendfile(sock, f, self.offset, self.length)
+
+            f.seek(self.offset + sent)
+            remaining = self.length - sent
+            while remaining:
+                buf = f.read(min(remaining, BUFSIZE))
                 if not buf:
-                    break
+                    # We can't honor the Content-Length anymore, raising an
+                    # exception results in the connection being closed.
+                    raise IOError("File was truncated while sending it")
 
                 sock.write(buf)
+                remaining -= len(buf)
 
     def headers(self, obj):
         obj.send_header("Content-Length", self.length)
+        obj.send_header("Accept-Ranges", "bytes")
+        if self.content_range:
+            obj.send_header("Content-Range", self.content_range)
+
+def parse_range(header, size):
+    """Parses the Range header of a request. Only a single byte range is
+    supported, for other values the whole file is sent.
+    @param header: value of the Range header.
+    @param size: size of the requested file.
+    @return: (start, end) tuple of the inclusive range or None.
+    @raise ValueError: if the range can't be satisfied.
+    """
+    r = re.match("bytes=(\\d*)-(\\d*)$", (header or "").strip())
+    if not r or not any(r.groups()):
+        return
+
+    start, end = r.groups()
+    if not start:
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end or size - 1), size - 1)
+
+    if start >= size or start > end:
+        raise ValueError("Unsatisfiable byte range: %s" % header)
+    return start, end
+
+def sendfile(sock, f, offset, length):
+    """Sends part of a file through a socket without copying it through
+    userspace, using sendfile(2) on Linux and TransmitFile on Windows.
+    @return: amount of bytes sent, which may be zero if zero-copy isn't
+             supported by the operating system.
+    """
+    sock.flush()
+
+    system = platform.system()
+    if system == "Linux":
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.sendfile64.restype = ctypes.c_ssize_t
+        libc.sendfile64.argtypes = (
+            ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t,
+        )
+
+        off, sent = ctypes.c_int64(offset), 0
+        while sent < length:
+            ret = libc.sendfile64(
+                sock.fileno(), f.fileno(), ctypes.byref(off),
+                min(length - sent, 0x7ffff000)
+            )
+            if ret < 0:
+                err = ctypes.get_errno()
+                if err == errno.EINTR:
+                    continue
+
+                # Not supported for this type of file or socket.
+                if not sent and err in (errno.EINVAL, errno.ENOSYS):
+                    return 0
+                raise IOError(err, os.strerror(err))
+
+            # The file has been truncated in the meantime.
+            if not ret:
+                break
+            sent += ret
+        return sent
+
+    if system == "Windows":
+        import msvcrt
+
+        handle, sent = msvcrt.get_osfhandle(f.fileno()), 0
+        while sent < length:
+            count = min(length - sent, 0x40000000)
+
+            # TransmitFile starts sending at the current file position.
+            os.lseek(f.fileno(), offset + sent, os.SEEK_SET)
+            if not ctypes.windll.mswsock.TransmitFile(
+                    sock.fileno(), handle, count, 0, None, None, 0):
+                if not sent:
+                    return 0
+                raise ctypes.WinError()
+            sent += count
+        return sent
+
+    return 0
+
+class MultipartReader(object):
+    """Streaming multipart/form-data decoder. The request body is read in
+    chunks of at most BUFSIZE bytes, thus memory usage is bounded regardless
+    of the size of the uploaded files."""
+    def __init__(self, fp, boundary, length):
+        self.fp = fp
+        self.remaining = length
+        self.delimiter = "\r\n--%s" % boundary
+        # The first delimiter is not preceded by a newline.
+        self.buf = "\r\n"
+        self.part = None
+        self.eof = False
+
+    def fill(self):
+        if not self.remaining:
+            raise IOError("Unexpected end of multipart request body")
+
+        buf = self.fp.read(min(self.remaining, BUFSIZE))
+        if not buf:
+            raise IOError("Unexpected end of multipart request body")
+
+        self.remaining -= len(buf)
+        self.buf += buf
+
+    def read(self, size):
+        """Read up to size bytes from the body of the current part."""
+        while self.part:
+            idx = self.buf.find(self.delimiter)
+            if not idx:
+                self.part = None
+                break
 
-class request(object):
-    form = {}
-    files = {}
-    client_ip = None
-    client_port = None
-    environ = {
-        "werkzeug.server.shutdown": lambda: app.shutdown(),
-    }
+            # If no delimiter was found, keep enough trailing bytes around
+            # to detect a delimiter that spans two chunks.
+            if idx < 0:
+                idx = len(self.buf) - len(self.delimiter) + 1
 
+            if idx > 0:
+                idx = min(idx, size)
+                ret, self.buf = self.buf[:idx], self.buf[idx:]
+                return ret
+
+            self.fill()
+        return ""
+
+    def next_part(self):
+        """Skip to the next part and parse its headers.
+        @return: MultipartPart instance or None if no parts are left.
+        """
+        while self.part:
+            self.read(BUFSIZE)
+
+        if self.eof:
+            return
+
+        while len(self.buf) < len(self.delimiter) + 2:
+            self.fill()
+
+        if not self.buf.startswith(self.delimiter):
+            raise IOError("Invalid multipart request body")
+
+        self.buf = self.buf[len(self.delimiter):]
+        if self.buf.startswith("--"):
+            self.eof = True
+            return
+
+        while "\r\n\r\n" not in self.buf:
+            if len(self.buf) > BUFSIZE:
+                raise IOError("Multipart headers are too large")
+            self.fill()
+
+        headers, self.buf = self.buf.split("\r\n\r\n", 1)
+
+        disposition = {}
+        for line in headers.split("\r\n"):
+            if ":" not in line:
+                continue
+
+            key, value = line.split(":", 1)
+            if key.strip().lower() == "content-disposition":
+                disposition = cgi.parse_header(value.strip())[1]
+
+        self.part = MultipartPart(
+            self, disposition.get("name"), disposition.get("filename")
+        )
+        return self.part
+
+    def drain(self):
+        """Consume the remainder of the request body."""
+        while not self.eof and self.next_part():
+            pass
+
+        while self.remaining:
+            self.buf = ""
+            self.fill()
+
+class MultipartPart(object):
+    """File-like object representing one part of a multipart request."""
+    def __init__(self, reader, name, filename):
+        self.reader = reader
+        self.name = name
+        self.filename = filename
+
+    def read(self, size=-1):
+        if size >= 0:
+            return self.reader.read(size)
+
+        ret = []
+        while True:
+            buf = self.reader.read(BUFSIZE)
+            if not buf:
+                return "".join(ret)
+            ret.append(buf)
+
+class FileCache(object):
+    """Content-addressed cache of uploaded files, keyed by their sha256 hash.
+    Files that are uploaded with the "cache" flag are kept around so that
+    the host may later on refer to them by hash instead of uploading them
+    again. By keeping the cache in a persistent location (next to the agent
+    by default) it may be baked into the virtual machine snapshot."""
+    def __init__(self, dirpath, max_size):
+        self.dirpath = dirpath
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Maps each sha256 to a (size, last used) tuple.
+        self.entries = None
+
+    def init(self):
+        """Index the blobs that are already available in the cache."""
+        with self.lock:
+            if self.entries is not None:
+                return
+
+            self.entries = {}
+            if not os.path.isdir(self.dirpath):
+                os.makedirs(self.dirpath)
+
+            for filename in os.listdir(self.dirpath):
+                filepath = os.path.join(self.dirpath, filename)
+                if re.match("[0-9a-f]{64}$", filename):
+                    st = os.stat(filepath)
+                    self.entries[filename] = st.st_size, st.st_mtime
+                elif filename.endswith(".tmp"):
+                    os.remove(filepath)
+
+    def size(self):
+        with self.lock:
+            return sum(size for size, _ in self.entries.values())
+
+    def has(self, sha256):
+        self.init()
+        return sha256 in self.entries
+
+    def get(self, sha256):
+        """Look up a blob and mark it as recently used.
+        @return: path to the blob or None if it isn't cached.
+        """
+        self.init()
+        with self.lock:
+            if sha256 not in self.entries:
+                return
+
+            self.entries[sha256] = self.entries[sha256][0], time.time()
+            return os.path.join(self.dirpath, sha256)
+
+    def add(self, f, sha256=None):
+        """Store the contents of a file-like object in the cache.
+        @param f: file-like object to read from.
+        @param sha256: optional hash the contents have to match.
+        @return: path to the blob.
+        """
+        self.init()
+
+        h, size = hashlib.sha256(), 0
+        fd, tmppath = tempfile.mkstemp(suffix=".tmp", dir=self.dirpath)
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                while True:
+                    buf = f.read(BUFSIZE)
+                    if not buf:
+                        break
+
+                    h.update(buf)
+                    tmp.write(buf)
+                    size += len(buf)
+
+            if sha256 and sha256.lower() != h.hexdigest():
+                raise ValueError(
+                    "File hash %s doesn't match the provided hash %s" %
+                    (h.hexdigest(), sha256)
+                )
+
+            filepath = os.path.join(self.dirpath, h.hexdigest())
+            with self.lock:
+                if os.path.exists(filepath):
+                    os.remove(tmppath)
+                else:
+                    os.rename(tmppath, filepath)
+
+                self.entries[h.hexdigest()] = size, time.time()
+                self.evict(keep=h.hexdigest())
+        except:
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            raise
+
+        return filepath
+
+    def evict(self, keep):
+        """Remove the least recently used blobs until the cache fits within
+        its maximum size again. Must be called with the lock held."""
+        total = sum(size for size, _ in self.entries.values())
+        for sha256 in sorted(self.entries, key=lambda x: self.entries[x][1]):
+            if total <= self.max_size:
+                break
+
+            if sha256 == keep:
+                continue
+
+            try:
+                os.remove(os.path.join(self.dirpath, sha256))
+            except OSError:
+                # Still in use, e.g., by a concurrent request on Windows.
+                continue
+
+            total -= self.entries.pop(sha256)[0]
+
+class FileHasher(object):
+    """Hashes files in a bounded pool of worker threads. Results are cached
+    by path, size, and modification time so that repeated queries for files
+    that haven't changed are free."""
+    def __init__(self, workers, max_entries):
+        self.workers = workers
+        self.max_entries = max_entries
+        self.pool = None
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def sha256(self, filepath):
+        h = hashlib.sha256()
+        with open(filepath, "rb") as f:
+            # Mapping the file lets hashlib read it without copying it into
+            # Python strings. Empty files and files that can't be mapped,
+            # e.g., due to address space limitations, are read instead.
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError):
+                mm = None
+
+            if mm:
+                try:
+                    h.update(mm)
+                finally:
+                    mm.close()
+            else:
+                while True:
+                    buf = f.read(BUFSIZE)
+                    if not buf:
+                        break
+                    h.update(buf)
+        return h.hexdigest()
+
+    def hash(self, filepath):
+        try:
+            st = os.stat(filepath)
+            if not stat.S_ISREG(st.st_mode):
+                return {"filepath": filepath, "error": "Not a regular file"}
+
+            key = filepath, st.st_size, st.st_mtime
+            with self.lock:
+                if key in self.entries:
+                    return self.entries[key]
+
+            ret = {
+                "filepath": filepath,
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "sha256": self.sha256(filepath),
+            }
+        except EnvironmentError as e:
+            return {"filepath": filepath, "error": e.strerror or str(e)}
+
+        with self.lock:
+            self.entries[key] = ret
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return ret
+
+    def hash_files(self, filepaths):
+        with self.lock:
+            if not self.pool:
+                self.pool = multiprocessing.pool.ThreadPool(self.workers)
+        return self.pool.map(self.hash, filepaths)
+
+class Histogram(object):
+    """Cumulative histogram with fixed buckets, in seconds."""
+    BUCKETS = 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for idx, bucket in enumerate(self.BUCKETS):
+            if value <= bucket:
+                break
+        else:
+            idx = len(self.BUCKETS)
+
+        self.counts[idx] += 1
+        self.count += 1
+        self.sum += value
+
+    def buckets(self):
+        """Yields (upper bound, cumulative count) tuples."""
+        total = 0
+        for bucket, count in zip(self.BUCKETS + ("+Inf",), self.counts):
+            total += count
+            yield bucket, total
+
+    def to_dict(self):
+        return {
+            "buckets": [[str(x), y] for x, y in self.buckets()],
+            "count": self.count,
+            "sum": self.sum,
+        }
+
+class Metrics(object):
+    """Per-route request statistics. Updating these is limited to a couple
+    of additions under a lock, so they're always collected."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.processes = {}
+
+    def route(self, key):
+        if key not in self.routes:
+            self.routes[key] = {
+                "requests": 0, "errors": 0, "in_flight": 0,
+                "bytes_in": 0, "bytes_out": 0, "duration": Histogram(),
+            }
+        return self.routes[key]
+
+    def begin(self, key):
+        with self.lock:
+            self.route(key)["in_flight"] += 1
+
+    def end(self, key, status_code, duration, bytes_in, bytes_out):
+        with self.lock:
+            route = self.route(key)
+            route["in_flight"] -= 1
+            route["requests"] += 1
+            route["errors"] += status_code >= 400
+            route["bytes_in"] += bytes_in
+            route["bytes_out"] += bytes_out
+            route["duration"].observe(duration)
+
+    def process(self, path, spawn, run=None):
+        """Records the time it took to spawn a process and, if it has been
+        waited upon, the time it ran for."""
+        with self.lock:
+            if path not in self.processes:
+                self.processes[path] = {
+                    "spawn": Histogram(), "run": Histogram(),
+                }
+
+            self.processes[path]["spawn"].observe(spawn)
+            if run is not None:
+                self.processes[path]["run"].observe(run)
+
+    def to_dict(self):
+        with self.lock:
+            routes = []
+            for (method, path), route in sorted(self.routes.items()):
+                route = dict(route, method=method, path=path)
+                route["duration"] = route["duration"].to_dict()
+                routes.append(route)
+
+            processes = {}
+            for path, process in self.processes.items():
+                processes[path] = {
+                    "spawn": process["spawn"].to_dict(),
+                    "run": process["run"].to_dict(),
+                }
+            return routes, processes
+
+    def to_text(self):
+        """Formats the metrics in the Prometheus text exposition format."""
+        routes, processes = self.to_dict()
+        lines = []
+
+        def metric(name, kind, values):
+            if kind:
+                lines.append("# TYPE cuckoo_agent_%s %s" % (name, kind))
+
+            for labels, value in values:
+                labels = ",".join(
+                    "%s=\"%s\"" % (k, v) for k, v in sorted(labels.items())
+                )
+                lines.append("cuckoo_agent_%s{%s} %s" % (name, labels, value))
+
+        def histogram(name, values):
+            buckets, sums, counts = [], [], []
+            for labels, hist in values:
+                for bucket, count in hist["buckets"]:
+                    buckets.append((dict(labels, le=bucket), count))
+                sums.append((labels, hist["sum"]))
+                counts.append((labels, hist["count"]))
+
+            lines.append("# TYPE cuckoo_agent_%s histogram" % name)
+            metric("%s_bucket" % name, None, buckets)
+            metric("%s_sum" % name, None, sums)
+            metric("%s_count" % name, None, counts)
+
+        labels = [
+            ({"method": x["method"], "path": x["path"]}, x) for x in routes
+        ]
+        for name in ("requests", "errors", "bytes_in", "bytes_out"):
+            metric(
+                "%s_total" % name, "counter",
+                [(label, x[name]) for label, x in labels]
+            )
+        metric("in_flight", "gauge", [(l, x["in_flight"]) for l, x in labels])
+        histogram(
+            "request_duration_seconds",
+            [(label, x["duration"]) for label, x in labels]
+        )
+
+        for kind in ("spawn", "run"):
+            histogram("process_%s_seconds" % kind, [
+                ({"path": path}, x[kind])
+                for path, x in sorted(processes.items())
+            ])
+
+        return "\n".join(lines) + "\n"
+
+class LocalRequest(threading.local):
+    """Represents Flask.request functionality. The state is kept per thread,
+    and thus per connection, as connections are handled concurrently."""
+    def __init__(self):
+        self.headers = {}
+        self.args = {}
+        self.stream = None
+        self.form = {}
+        self.files = {}
+        self.client_ip = None
+        self.client_port = None
+        self.environ = {
+            "werkzeug.server.shutdown": lambda: app.shutdown(),
+        }
+
+request = LocalRequest()
 app = MiniHTTPServer()
 state = {}
+metrics = Metrics()
+hasher = FileHasher(4, 65536)
+status_changed = threading.Condition()
+cache = FileCache(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache"),
+    512 * 1024 * 1024
+)
 
 def json_error(error_code, message):
     r = jsonify(message=message, error_code=error_code)
@@ -186,6 +1054,236 @@ def json_exception(message):
 def json_success(message, **kwargs):
     return jsonify(message=message, **kwargs)
 
+def accepted_encoding():
+    """Returns the encoding the retrieved file may be compressed with, if
+    the client supports any."""
+    accept = request.headers.get("Accept-Encoding", "")
+    encodings = [x.split(";")[0].strip().lower() for x in accept.split(",")]
+    for encoding in ("gzip", "deflate"):
+        if encoding in encodings:
+            return encoding
+
+def is_compressible(filepath):
+    """Quick check whether compressing a file is worth the effort. Small
+    files and files of known compressed formats are skipped, as are files
+    of which sampled blocks barely compress, e.g., due to packing or
+    encryption."""
+    size = os.path.getsize(filepath)
+    if size < COMPRESS_MIN_SIZE:
+        return False
+
+    with open(filepath, "rb") as f:
+        if f.read(8).startswith(COMPRESSED_MAGIC):
+            return False
+
+        samples = []
+        for idx in xrange(4):
+            f.seek(size * idx / 4)
+            samples.append(f.read(4096))
+
+    sample = "".join(samples)
+    return len(zlib.compress(sample, 1)) < len(sample) * 0.9
+
+def compress_file(filepath, encoding):
+    """Yields the compressed contents of a file."""
+    if encoding == "gzip":
+        wbits = 16 + zlib.MAX_WBITS
+    else:
+        wbits = zlib.MAX_WBITS
+
+    compressor = zlib.compressobj(
+        send_file.compresslevel, zlib.DEFLATED, wbits
+    )
+    with open(filepath, "rb") as f:
+        while True:
+            buf = f.read(BUFSIZE)
+            if not buf:
+                break
+            yield compressor.compress(buf)
+    yield compressor.flush()
+
+class QueueWriter(object):
+    """File-like object that hands whatever is written to it to a bounded
+    queue in chunks of at least BUFSIZE bytes, blocking while the queue is
+    full. Writes fail once the consumer has gone away."""
+    def __init__(self, queue, done):
+        self.queue = queue
+        self.done = done
+        self.buf = []
+        self.length = 0
+
+    def put(self, item):
+        while not self.done.is_set():
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+        raise IOError("The client has gone away")
+
+    def write(self, data):
+        self.buf.append(data)
+        self.length += len(data)
+        if self.length >= BUFSIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.put("".join(self.buf))
+            self.buf, self.length = [], 0
+
+    def close(self):
+        self.flush()
+        self.put(None)
+
+def walk_files(dirpath, include, exclude):
+    """Lazily yields (filepath, relative path) tuples for all files in a
+    directory tree that match any of the include globs, if any, and none
+    of the exclude globs."""
+    for root, _, filenames in os.walk(dirpath):
+        for filename in filenames:
+            filepath = os.path.join(root, filename)
+            relpath = os.path.relpath(filepath, dirpath)
+
+            if include and \
+                    not any(fnmatch.fnmatch(relpath, x) for x in include):
+                continue
+
+            if any(fnmatch.fnmatch(relpath, x) for x in exclude):
+                continue
+
+            yield filepath, relpath
+
+def archive_file(tar, filepath, arcname):
+    """Adds a file to a tar archive. The file is opened before its header is
+    written, so files that are locked or have been removed are skipped
+    rather than resulting in a truncated member.
+    @return: whether the file has been added.
+    """
+    try:
+        # Links and the like have no contents that could be cut short.
+        if not stat.S_ISREG(os.lstat(filepath).st_mode):
+            tar.add(filepath, arcname)
+            return True
+
+        f = open(filepath, "rb")
+    except EnvironmentError:
+        traceback.print_exc()
+        return False
+
+    with f:
+        tarinfo = tar.gettarinfo(arcname=arcname, fileobj=f)
+        tar.addfile(tarinfo, f)
+    return True
+
+def archive_directory(dirpath, compression, include, exclude):
+    """Yields a tar archive of a directory as it is being created. The
+    archive is written by a separate thread into a bounded queue, so
+    neither a temporary archive nor the whole archive in memory is needed.
+    If the archive can't be completed an exception is raised, which aborts
+    the response so that the client can tell.
+    """
+    queue, done = Queue.Queue(16), threading.Event()
+    writer = QueueWriter(queue, done)
+    failed = threading.Event()
+
+    def produce():
+        try:
+            tar = tarfile.open(fileobj=writer, mode="w|%s" % compression)
+            for filepath, relpath in walk_files(dirpath, include, exclude):
+                archive_file(tar, filepath, relpath.replace(os.sep, "/"))
+            tar.close()
+            writer.close()
+        except:
+            # E.g., a file that shrunk while it was being archived. The
+            # member can't be completed anymore.
+            if not done.is_set():
+                traceback.print_exc()
+                failed.set()
+            done.set()
+
+    t = threading.Thread(target=produce)
+    t.daemon = True
+    t.start()
+
+    try:
+        while not done.is_set() or not queue.empty():
+            try:
+                buf = queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+
+            if buf is None:
+                break
+            yield buf
+
+        if failed.is_set():
+            raise IOError("Error archiving directory: %s" % dirpath)
+    finally:
+        done.set()
+
+def stream_output(path, p, start, spawned):
+    """Yields the output of a process as newline-delimited JSON records as
+    it becomes available, followed by a final record with its exit code.
+    Both pipes are read by a thread each into a small bounded queue, so the
+    child is slowed down rather than its output being buffered."""
+    queue, done = Queue.Queue(16), threading.Event()
+
+    def reader(name, f):
+        while True:
+            buf = os.read(f.fileno(), 64 * 1024)
+            # Once the client is gone the output is just discarded.
+            while not done.is_set():
+                try:
+                    queue.put((name, buf), timeout=1)
+                    break
+                except Queue.Full:
+                    pass
+
+            if not buf:
+                break
+
+    for name in ("stdout", "stderr"):
+        t = threading.Thread(target=reader, args=(name, getattr(p, name)))
+        t.daemon = True
+        t.start()
+
+    try:
+        pending = 2
+        while pending:
+            name, buf = queue.get()
+            if not buf:
+                pending -= 1
+                continue
+
+            yield json.dumps({
+                "stream": name, "data": buf.decode("utf8", "replace"),
+            }) + "\n"
+
+        exit_code = p.wait()
+        metrics.process(path, spawned - start, time.time() - spawned)
+        yield json.dumps({"exit_code": exit_code}) + "\n"
+    finally:
+        done.set()
+
+def uploaded_file(name):
+    """Returns an uploaded file. Files uploaded with an encoding (gzip or
+    zlib) are decompressed while they're being read."""
+    if "encoding" in request.form:
+        return DecompressFile(request.files[name], request.form["encoding"])
+    return request.files[name]
+
+def cached_upload(name):
+    """Returns the path to the cached version of an uploaded file. If the
+    file has been uploaded with the "cache" flag it's added to the cache,
+    if it hasn't been uploaded at all it's looked up by its sha256."""
+    sha256 = request.form.get("sha256")
+    if name in request.files:
+        return cache.add(uploaded_file(name), sha256)
+
+    if sha256:
+        return cache.get(sha256.lower())
+
 @app.route("/")
 def get_index():
     return json_success(
@@ -203,16 +1301,64 @@ def put_status():
     if "status" not in request.form:
         return json_error(400, "No status has been provided")
 
-    state["status"] = request.form["status"]
-    state["description"] = request.form.get("description")
+    with status_changed:
+        state["status"] = request.form["status"]
+        state["description"] = request.form.get("description")
+        status_changed.notify_all()
     return json_success("Analysis status updated")
 
+@app.route("/status/wait")
+def wait_status():
+    try:
+        timeout = float(request.args.get("timeout", 60))
+    except ValueError:
+        return json_error(400, "Invalid timeout has been provided")
+
+    if math.isnan(timeout) or math.isinf(timeout) or timeout < 0:
+        return json_error(400, "Invalid timeout has been provided")
+    timeout = min(timeout, STATUS_WAIT_MAX)
+
+    # The status to wait on may be provided explicitly so that a change
+    # in between an earlier /status request and this one isn't missed.
+    with status_changed:
+        status = request.args.get("status", state.get("status"))
+        deadline = time.time() + timeout
+        while state.get("status") == status:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            status_changed.wait(remaining)
+
+        return json_success("Analysis status",
+                            status=state.get("status"),
+                            description=state.get("description"),
+                            changed=state.get("status") != status)
+
 @app.route("/logs")
 def get_logs():
+    since = request.args.get("since", "0")
+    if not since.isdigit():
+        return json_error(400, "Invalid offset has been provided")
+
+    output, offset, dropped = logs.read(int(since))
     return json_success(
         "Agent logs",
-        stdout=sys.stdout.getvalue(),
-        stderr=sys.stderr.getvalue()
+        stdout=output["stdout"],
+        stderr=output["stderr"],
+        offset=offset,
+        dropped=dropped
+    )
+
+@app.route("/metrics")
+def get_metrics():
+    if request.args.get("format") == "json":
+        routes, processes = metrics.to_dict()
+        return json_success(
+            "Agent metrics", routes=routes, processes=processes
+        )
+
+    return make_response(
+        metrics.to_text(), content_type="text/plain; version=0.0.4"
     )
 
 @app.route("/system")
@@ -268,12 +1414,25 @@ def do_store():
     if "filepath" not in request.form:
         return json_error(400, "No filepath has been provided")
 
-    if "file" not in request.files:
+    if "file" not in request.files and "sha256" not in request.form:
         return json_error(400, "No file has been provided")
 
     try:
-        with open(request.form["filepath"], "wb") as f:
-            shutil.copyfileobj(request.files["file"], f, 10*1024*1024)
+        if "file" in request.files and "cache" not in request.form:
+            with open(request.form["filepath"], "wb") as f:
+                try:
+                    shutil.copyfileobj(uploaded_file("file"), f, BUFSIZE)
+                except:
+                    # Don't leave a partially stored file behind.
+                    f.close()
+                    os.remove(request.form["filepath"])
+                    raise
+        else:
+            filepath = cached_upload("file")
+            if not filepath:
+                return json_error(404, "File is not available in the cache")
+
+            shutil.copyfile(filepath, request.form["filepath"])
     except:
         return json_exception("Error storing file")
 
@@ -284,24 +1443,112 @@ def do_retrieve():
     if "filepath" not in request.form:
         return json_error(400, "No filepath has been provided")
 
-    return send_file(request.form["filepath"])
+    filepath = request.form["filepath"]
+    byterange = request.headers.get("Range")
+
+    # Compress the file on the fly if the client asks for it and supports
+    # it. HTTP libraries tend to advertise gzip support by default, hence
+    # the explicit flag, as older hosts expect a Content-Length. Ranges
+    # refer to the uncompressed file, so those are always sent as-is.
+    encoding = accepted_encoding() if "compress" in request.form else None
+    if encoding and not byterange and send_file.compresslevel and \
+            os.path.isfile(filepath) and is_compressible(filepath):
+        return stream_response(
+            compress_file(filepath, encoding),
+            content_type="application/octet-stream",
+            content_encoding=encoding
+        )
+
+    return send_file(filepath, byterange=byterange)
 
 @app.route("/extract", methods=["POST"])
 def do_extract():
     if "dirpath" not in request.form:
         return json_error(400, "No dirpath has been provided")
 
-    if "zipfile" not in request.files:
+    if "zipfile" not in request.files and "sha256" not in request.form:
         return json_error(400, "No zip file has been provided")
 
     try:
-        with zipfile.ZipFile(request.files["zipfile"], "r") as archive:
-            archive.extractall(request.form["dirpath"])
+        if "zipfile" in request.files and "cache" not in request.form:
+            # Zip files require random access, so the upload is spooled in
+            # memory and only hits the disk (once) when it's unusually large.
+            with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as f:
+                shutil.copyfileobj(uploaded_file("zipfile"), f, BUFSIZE)
+                with zipfile.ZipFile(f, "r") as archive:
+                    archive.extractall(request.form["dirpath"])
+        else:
+            filepath = cached_upload("zipfile")
+            if not filepath:
+                return json_error(404, "File is not available in the cache")
+
+            with zipfile.ZipFile(filepath, "r") as archive:
+                archive.extractall(request.form["dirpath"])
     except:
         return json_exception("Error extracting zip file")
 
     return json_success("Successfully extracted zip file")
 
+@app.route("/archive", methods=["POST"])
+def do_archive():
+    if "dirpath" not in request.form:
+        return json_error(400, "No dirpath has been provided")
+
+    if not os.path.isdir(request.form["dirpath"]):
+        return json_error(404, "Directory provided does not exist")
+
+    compression = request.form.get("compression", "")
+    if compression not in ("", "gz", "bz2"):
+        return json_error(400, "Unsupported compression has been provided")
+
+    try:
+        include = json.loads(request.form.get("include", "[]"))
+        exclude = json.loads(request.form.get("exclude", "[]"))
+    except ValueError:
+        return json_exception("Error parsing the include or exclude globs")
+
+    for globs in (include, exclude):
+        if not isinstance(globs, list) or \
+                not all(isinstance(x, basestring) for x in globs):
+            return json_error(
+                400, "Include and exclude should be lists of strings"
+            )
+
+    return stream_response(
+        archive_directory(
+            request.form["dirpath"], compression, include, exclude
+        ),
+        content_type="application/x-tar"
+    )
+
+@app.route("/cache", methods=["GET", "POST"])
+def get_cache():
+    cache.init()
+
+    hashes = request.form.get("sha256", "").lower().split(",")
+    return json_success(
+        "Cache status",
+        cached=[sha256 for sha256 in hashes if cache.has(sha256)],
+        size=cache.size(), max_size=cache.max_size
+    )
+
+@app.route("/hash", methods=["POST"])
+def do_hash():
+    if "filepaths" not in request.form:
+        return json_error(400, "No filepaths have been provided")
+
+    try:
+        filepaths = json.loads(request.form["filepaths"])
+    except ValueError:
+        return json_exception("Error parsing the filepaths")
+
+    if not isinstance(filepaths, list) or \
+            not all(isinstance(x, basestring) for x in filepaths):
+        return json_error(400, "Filepaths should be a list of strings")
+
+    return json_success("Successfully hashed files",
+                        files=hasher.hash_files(filepaths))
+
 @app.route("/remove", methods=["POST"])
 def do_remove():
     if "path" not in request.form:
@@ -332,22 +1579,35 @@ def do_execute():
     if "command" not in request.form:
         return json_error(400, "No command has been provided")
 
-    # Execute the command asynchronously? As a shell command?
+    # Execute the command asynchronously? As a shell command? Stream the
+    # output while it's running?
     async = "async" in request.form
     shell = "shell" in request.form
+    stream = "stream" in request.form
 
     cwd = request.form.get("cwd")
     stdout = stderr = None
 
     try:
+        start = time.time()
         if async:
             subprocess.Popen(request.form["command"], shell=shell, cwd=cwd)
+            metrics.process("/execute", time.time() - start)
         else:
             p = subprocess.Popen(
                 request.form["command"], shell=shell, cwd=cwd,
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE
             )
+            spawned = time.time()
+            if stream:
+                return stream_response(
+                    stream_output("/execute", p, start, spawned)
+                )
+
             stdout, stderr = p.communicate()
+            metrics.process(
+                "/execute", spawned - start, time.time() - spawned
+            )
     except:
         return json_exception("Error executing command")
 
@@ -359,8 +1619,10 @@ def do_execpy():
     if "filepath" not in request.form:
         return json_error(400, "No Python file has been provided")
 
-    # Execute the command asynchronously? As a shell command?
+    # Execute the command asynchronously? Stream the output while it's
+    # running?
     async = "async" in request.form
+    stream = "stream" in request.form
 
     cwd = request.form.get("cwd")
     stdout = stderr = None
@@ -371,19 +1633,108 @@ def do_execpy():
     ]
 
     try:
+        start = time.time()
         if async:
             subprocess.Popen(args, cwd=cwd)
+            metrics.process("/execpy", time.time() - start)
         else:
             p = subprocess.Popen(args, cwd=cwd,
                                  stdout=subprocess.PIPE,
                                  stderr=subprocess.PIPE)
+            spawned = time.time()
+            if stream:
+                return stream_response(
+                    stream_output("/execpy", p, start, spawned)
+                )
+
             stdout, stderr = p.communicate()
+            metrics.process(
+                "/execpy", spawned - start, time.time() - spawned
+            )
     except:
         return json_exception("Error executing command")
 
     return json_success("Successfully executed command",
                         stdout=stdout, stderr=stderr)
 
+def batch_supported(method, path, form):
+    """Only operations that result in JSON may be batched, i.e., files can't
+    be retrieved through a batch request. This has to be decided before the
+    operation is executed, as streamed responses start their work (running
+    a process, archiving a directory) before the response is sent."""
+    if method not in app.routes:
+        return False
+
+    route, _ = app.match(method, path or "")
+    return route not in BATCH_UNSUPPORTED and "stream" not in form
+
+@app.route("/batch", methods=["POST"])
+def do_batch():
+    if "operations" not in request.form:
+        return json_error(400, "No operations have been provided")
+
+    try:
+        operations = json.loads(request.form["operations"])
+    except ValueError:
+        return json_exception("Error parsing the operations")
+
+    if not isinstance(operations, list) or \
+            not all(isinstance(x, dict) for x in operations):
+        return json_error(400, "Operations should be a list of objects")
+
+    # Operations are executed in order and each operation takes the files
+    # it needs, in order, from the uploaded files of the batch request.
+    uploads = request.files.values()
+    results = []
+    for operation in operations:
+        method = operation.get("method", "POST")
+        path = operation.get("path")
+
+        request.form = dict(
+            (key, value if isinstance(value, basestring) else unicode(value))
+            for key, value in operation.get("form", {}).items()
+        )
+        request.files = {}
+
+        if not batch_supported(method, path, request.form):
+            ret = json_error(400, "Operation is not supported")
+        else:
+            ret = None
+            for name in operation.get("files", []):
+                upload = uploads.pop(0) if uploads else None
+                if not upload and request.stream:
+                    upload = request.stream.next_part()
+
+                if not upload or upload.name != name:
+                    ret = json_error(
+                        400, "File %s has not been provided" % name
+                    )
+                    break
+
+                request.files[name] = upload
+
+            if not ret:
+                ret = app.dispatch(method, path)
+
+        if not isinstance(ret, jsonify):
+            ret = json_error(400, "Operation is not supported")
+
+        ret.init()
+        results.append(
+            dict(path=path, status_code=ret.status_code, **ret.values)
+        )
+
+        # Stop at the first failure, e.g., the analyzer should not be
+        # started if its files couldn't be stored.
+        if ret.status_code != 200:
+            break
+
+    return json_success(
+        "Executed batch operations", results=results,
+        completed=len(results) == len(operations) and
+        all(x["status_code"] == 200 for x in results)
+    )
+
 @app.route("/pinning")
 def do_pinning():
     if "client_ip" in state:
@@ -406,6 +1757,30 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("host", nargs="?", default="0.0.0.0")
     parser.add_argument("port", nargs="?", default="8000")
+    parser.add_argument(
+        "--single-threaded", action="store_true",
+        help="Handle one request at a time (legacy behavior)"
+    )
+    parser.add_argument(
+        "--cache-dir", default=cache.dirpath,
+        help="Directory for the content-addressed file cache"
+    )
+    parser.add_argument(
+        "--cache-size", type=int, default=cache.max_size / 1024 / 1024,
+        help="Maximum size of the file cache in megabytes"
+    )
+    parser.add_argument(
+        "--compress-level", type=int, default=send_file.compresslevel,
+        help="Compression level for retrieved files, 0 to disable"
+    )
     args = parser.parse_args()
 
-    app.run(host=args.host, port=int(args.port))
+    send_file.compresslevel = args.compress_level
+
+    cache.dirpath = args.cache_dir
+    cache.max_size = args.cache_size * 1024 * 1024
+
+    app.run(
+        host=args.host, port=int(args.port),
+        threaded=not args.single_threaded
+    )
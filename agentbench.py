@@ -0,0 +1,427 @@
+# Copyright (C) 2017 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+"""Benchmarks of the guest agent.
+
+Every benchmark starts the agent (agent/agent.py) in a process of its own on
+loopback and talks to it over plain HTTP, the way the Cuckoo host does. Run
+all benchmarks or just a couple of them, e.g.:
+
+    $ python agentbench.py
+    $ python agentbench.py --size 200 status_during_store
+    $ python agentbench.py retrieve_throughput retrieve_compressed
+
+File contents are generated from a fixed seed, so the results of different
+runs (and of different versions of the agent) may be compared.
+
+"""
+
+import argparse
+import contextlib
+import httplib
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import zipfile
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS = {}
+
+BOUNDARY = "agentbench-boundary"
+
+def benchmark(fn):
+    """Registers a benchmark function. The function is called with the
+    working directory and the amount of data to transfer and returns a list
+    of results."""
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+def result(name, length, duration, **kwargs):
+    kwargs.update({
+        "name": name,
+        "bytes": length,
+        "duration": duration,
+    })
+    return kwargs
+
+def create_file(filepath, size, seed=0):
+    """Creates a file with somewhat compressible contents."""
+    rand = random.Random(seed)
+    block = "".join(chr(rand.randrange(256)) for _ in xrange(16384))
+    with open(filepath, "wb") as f:
+        for offset in xrange(0, size, 65536):
+            buf = block + "\x00" * 49152
+            f.write(buf[:size - offset])
+    return filepath
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+@contextlib.contextmanager
+def agent(*args):
+    """Runs the agent with the given command-line arguments."""
+    port = free_port()
+    p = subprocess.Popen([
+        sys.executable, os.path.abspath(__file__), "--agent", str(port),
+    ] + list(args))
+
+    try:
+        # Wait for the agent to start listening.
+        for _ in xrange(100):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except socket.error:
+                time.sleep(0.05)
+        yield port
+    finally:
+        p.kill()
+        p.wait()
+
+def request(port, method, path, fields={}, filepath=None, headers={}):
+    """Sends a request, with the file (if any) as a streamed multipart
+    upload, and returns the response."""
+    conn = httplib.HTTPConnection("127.0.0.1", port)
+
+    if method == "GET":
+        conn.request(method, path, headers=headers)
+        return conn.getresponse()
+
+    if not filepath:
+        body = urllib.urlencode(fields)
+        conn.request(method, path, body, dict(headers, **{
+            "Content-Type": "application/x-www-form-urlencoded",
+        }))
+        return conn.getresponse()
+
+    head = []
+    for key, value in fields.items():
+        head.append(
+            "--%s\r\nContent-Disposition: form-data; name=\"%s\"\r\n\r\n%s"
+            "\r\n" % (BOUNDARY, key, value)
+        )
+    head.append(
+        "--%s\r\nContent-Disposition: form-data; name=\"file\"; "
+        "filename=\"%s\"\r\n\r\n" % (BOUNDARY, os.path.basename(filepath))
+    )
+    head = "".join(head)
+    tail = "\r\n--%s--\r\n" % BOUNDARY
+
+    conn.putrequest(method, path)
+    conn.putheader(
+        "Content-Type", "multipart/form-data; boundary=%s" % BOUNDARY
+    )
+    conn.putheader(
+        "Content-Length",
+        len(head) + os.path.getsize(filepath) + len(tail)
+    )
+    for key, value in headers.items():
+        conn.putheader(key, value)
+    conn.endheaders()
+
+    conn.send(head)
+    with open(filepath, "rb") as f:
+        while True:
+            buf = f.read(1024 * 1024)
+            if not buf:
+                break
+            conn.send(buf)
+    conn.send(tail)
+    return conn.getresponse()
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+@benchmark
+def status_during_store(workdir, size):
+    """Latency of /status polls while a large file is being stored. The
+    single-threaded agent can't answer any poll until the upload is done."""
+    filepath = create_file(os.path.join(workdir, "sample.bin"), size)
+
+    ret = []
+    for name, args in (("threaded", []),
+                       ("single-threaded", ["--single-threaded"])):
+        with agent(*args) as port:
+            store = {}
+
+            def upload():
+                start = time.time()
+                r = request(port, "POST", "/store", {
+                    "filepath": os.path.join(workdir, "stored.bin"),
+                }, filepath)
+                assert r.status == 200, r.read()
+                r.read()
+                store["duration"] = time.time() - start
+
+            t = threading.Thread(target=upload)
+            t.start()
+
+            # Give the upload a head start, then poll like the host does,
+            # with a new connection for every request. Small uploads may be
+            # done before the first poll, which is sent regardless.
+            time.sleep(0.1)
+            latencies = []
+            while True:
+                start = time.time()
+                r = request(port, "GET", "/status")
+                r.read()
+                latencies.append(time.time() - start)
+                if not t.is_alive():
+                    break
+                time.sleep(0.01)
+            t.join()
+
+        ret.append(result("%s store" % name, size, store["duration"]))
+        ret.append(result(
+            "%s status" % name, 0, max(latencies),
+            polls=len(latencies),
+            p50=percentile(latencies, 0.5),
+            p99=percentile(latencies, 0.99),
+        ))
+    return ret
+
+def retrieve(port, filepath, byterange=None, headers={}, fields={}):
+    """Retrieves (part of) a file.
+    @return: tuple of the amount of bytes received and the response."""
+    if byterange:
+        headers = dict(headers, Range="bytes=%d-%d" % byterange)
+
+    r = request(port, "POST", "/retrieve", dict(fields, filepath=filepath),
+                headers=headers)
+    assert r.status in (200, 206), r.status
+
+    length = 0
+    while True:
+        buf = r.read(1024 * 1024)
+        if not buf:
+            break
+        length += len(buf)
+    return length, r
+
+@benchmark
+def retrieve_throughput(workdir, size):
+    """Throughput of /retrieve with zero-copy sends against the regular
+    chunked loop, for the whole file and for parallel byte ranges. The best
+    of a couple of rounds is reported."""
+    filepath = create_file(os.path.join(workdir, "memory.dmp"), size)
+
+    def whole(port):
+        length, _ = retrieve(port, filepath)
+        assert length == size
+
+    def ranges(port, count=4):
+        step = size / count
+        threads = []
+        for idx in xrange(count):
+            end = size - 1 if idx == count - 1 else (idx + 1) * step - 1
+            t = threading.Thread(
+                target=retrieve, args=(port, filepath, (idx * step, end))
+            )
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            t.join()
+
+    ret = []
+    for name, args in (("sendfile", []), ("chunked", ["--no-sendfile"])):
+        with agent(*args) as port:
+            for kind, fn in (("whole file", whole), ("4 ranges", ranges)):
+                durations = []
+                for _ in xrange(3):
+                    start = time.time()
+                    fn(port)
+                    durations.append(time.time() - start)
+                ret.append(result(
+                    "%s, %s" % (name, kind), size, min(durations)
+                ))
+    return ret
+
+# Byte sequences that are common in x86 code, e.g., function prologues,
+# calls, and register moves, to make up somewhat realistic code sections.
+CODE = (
+    "\x55\x8b\xec", "\x83\xec\x10", "\x8b\x45\x08", "\x8b\x4d\x0c",
+    "\x50", "\x51", "\x52", "\x53", "\x56", "\x57", "\x5d", "\xc3",
+    "\xe8", "\xff\x15", "\x85\xc0", "\x74", "\x75", "\x33\xc0",
+    "\x89\x45\xfc", "\x6a\x00", "\x68", "\x8d\x45\xf0", "\xcc",
+)
+
+WORDS = (
+    "the", "invoice", "payment", "account", "please", "enable", "content",
+    "document", "macro", "security", "update", "of", "to", "and", "your",
+)
+
+def code(rand, size):
+    ret, length = [], 0
+    while length < size:
+        buf = rand.choice(CODE)
+        # Operands, e.g., addresses and immediates.
+        if rand.random() < 0.3:
+            buf += "".join(chr(rand.randrange(256)) for _ in xrange(4))
+        ret.append(buf)
+        length += len(buf)
+    return "".join(ret)[:size]
+
+def text(rand, size):
+    ret, length = [], 0
+    while length < size:
+        ret.append(rand.choice(WORDS))
+        length += len(ret[-1]) + 1
+    return " ".join(ret)[:size]
+
+def create_mix(dirpath, size):
+    """Creates a representative mix of files that are retrieved from the
+    guest: executables (regular and packed), Office documents (legacy and
+    Office Open XML), and a memory dump.
+    @return: list of (name, filepath) tuples.
+    """
+    rand = random.Random(0)
+    block = code(rand, 65536)
+    page = text(rand, 4096)
+
+    def pe(filepath, size, packed):
+        with open(filepath, "wb") as f:
+            f.write("MZ\x90\x00" + "\x00" * 0x3c + "PE\x00\x00")
+            f.write("\x00" * (4096 - f.tell()))
+            # The code section followed by resources and padding.
+            for offset in xrange(0, size * 3 / 4, len(block)):
+                if packed:
+                    f.write(os.urandom(len(block)))
+                else:
+                    f.write(block[rand.randrange(1024):])
+            while f.tell() < size:
+                f.write(page if rand.random() < 0.5 else "\x00" * 4096)
+
+    def doc(filepath, size):
+        with open(filepath, "wb") as f:
+            f.write("\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1" + "\x00" * 504)
+            while f.tell() < size:
+                f.write(text(rand, 512) if rand.random() < 0.7 else
+                        "\xff" * 512)
+
+    def docx(filepath, size):
+        with zipfile.ZipFile(filepath, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("word/document.xml", "<w:t>%s</w:t>" % text(rand, size))
+            z.writestr("word/media/image1.png", os.urandom(size / 4))
+
+    def dump(filepath, size):
+        # Mostly empty pages, some code and data, and some noise.
+        with open(filepath, "wb") as f:
+            for offset in xrange(0, size, 4096):
+                kind = rand.random()
+                if kind < 0.5:
+                    f.write("\x00" * 4096)
+                elif kind < 0.65:
+                    f.write(block[:4096])
+                elif kind < 0.8:
+                    f.write(page)
+                else:
+                    f.write(os.urandom(4096))
+
+    ret = []
+    for name, fn, args in (
+            ("sample.exe", pe, (size / 8, False)),
+            ("packed.exe", pe, (size / 8, True)),
+            ("invoice.doc", doc, (size / 16,)),
+            ("invoice.docx", docx, (size / 16,)),
+            ("memory.dmp", dump, (size / 2,))):
+        filepath = os.path.join(dirpath, name)
+        fn(filepath, *args)
+        ret.append((name, filepath))
+    return ret
+
+@benchmark
+def retrieve_compressed(workdir, size):
+    """Retrieves a mix of files with and without compression. Compressing
+    trades agent CPU time for bytes on the wire, so the amount of bytes
+    transferred is reported along with the duration on loopback."""
+    ret = []
+    with agent() as port:
+        for name, filepath in create_mix(workdir, size):
+            length = os.path.getsize(filepath)
+            for kind, fields in (("plain", {}), ("gzip", {"compress": 1})):
+                start = time.time()
+                wire, r = retrieve(
+                    port, filepath, fields=fields,
+                    headers={"Accept-Encoding": "gzip"}
+                )
+                ret.append(result(
+                    "%s, %s" % (name, kind), length, time.time() - start,
+                    wire=wire,
+                    encoding=r.getheader("Content-Encoding") or "identity",
+                ))
+    return ret
+
+def report(name, rows):
+    for row in rows:
+        line = "%-22s %-26s %8.3fs" % (name, row["name"], row["duration"])
+        if row["bytes"]:
+            line += " %8.1f MB/s" % (
+                row["bytes"] / row["duration"] / 1024 / 1024
+            )
+        if "polls" in row:
+            line += " %5d polls, p50 %.1fms, p99 %.1fms" % (
+                row["polls"], row["p50"] * 1000, row["p99"] * 1000
+            )
+        if "wire" in row:
+            line += " %7.1f MB sent (%s)" % (
+                row["wire"] / 1024.0 / 1024, row["encoding"]
+            )
+        print line
+
+def serve(port, args):
+    """Runs the agent in this process."""
+    sys.path.insert(0, os.path.join(ROOT, "agent"))
+    import agent
+
+    # Leave sending files up to the regular loop of 1MB reads and writes.
+    if "--no-sendfile" in args:
+        agent.sendfile = lambda sock, f, offset, length: 0
+
+    agent.app.run(
+        host="127.0.0.1", port=port,
+        threaded="--single-threaded" not in args
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run")
+    parser.add_argument("--size", type=int, default=200,
+                        help="Amount of data to transfer (MB)")
+    parser.add_argument("--save", help="Save the results to a JSON file")
+    parser.add_argument("--agent", type=int, help=argparse.SUPPRESS)
+    args, extra = parser.parse_known_args()
+
+    if args.agent:
+        serve(args.agent, extra)
+        sys.exit(0)
+
+    results = {}
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        workdir = tempfile.mkdtemp(prefix="agentbench-")
+        try:
+            results[name] = BENCHMARKS[name](
+                workdir, args.size * 1024 * 1024
+            )
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        report(name, results[name])
+
+    if args.save:
+        with open(args.save, "wb") as f:
+            json.dump(results, f, indent=4)
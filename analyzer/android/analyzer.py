@@ -15,6 +15,7 @@ from lib.core.packages import choose_package
 from lib.common.exceptions import CuckooError, CuckooPackageError
 from lib.common.abstracts import Package, Auxiliary
 from lib.common.constants import PATHS
+from lib.common.timeline import Timeline
 from lib.core.config import Config
 from lib.core.startup import init_logging
 from modules import auxiliary
@@ -26,11 +27,22 @@ class Analyzer(object):
     def __init__(self):
         self.config = None
         self.target = None
+        self.timeline = Timeline()
 
     def complete(self):
         """End analysis."""
+        # Report where the time went.
+        self.timeline.phase("complete")
+        self.timeline.stop()
+        self.timeline.upload()
+
         log.info("Analysis completed")
 
+        # Make sure the queued log records reach the result server before
+        # the analysis is reported as completed.
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+
     def get_options(self):
         """Get analysis options.
         @return: options dict.
@@ -79,6 +91,7 @@ class Analyzer(object):
             self.target = self.config.target
 
     def run(self):
+        self.timeline.phase("prepare")
         self.prepare()
 
         log.info("Starting analyzer from: {0}".format(os.getcwd()))
@@ -131,6 +144,7 @@ class Analyzer(object):
         pack = package_class(self.get_options())
 
         # Initialize Auxiliary modules
+        self.timeline.phase("aux_import")
         Auxiliary()
         prefix = auxiliary.__name__ + "."
         for loader, name, ispkg in pkgutil.iter_modules(auxiliary.__path__, prefix):
@@ -145,6 +159,7 @@ class Analyzer(object):
                             "\"%s\": %s", name, e)
 
         # Walk through the available auxiliary modules.
+        self.timeline.phase("aux_start")
         aux_enabled = []
         for module in Auxiliary.__subclasses__():
             # Try to start the auxiliary module.
@@ -165,7 +180,10 @@ class Analyzer(object):
                 aux_enabled.append(aux)
 
         # Start analysis package. If for any reason, the execution of the
-        # analysis package fails, we have to abort the analysis.
+        # analysis package fails, we have to abort the analysis. There's no
+        # first_monitored_event on Android: Droidmon writes the behavior to
+        # the Xposed log, which is only read once the package finishes.
+        self.timeline.phase("package_start")
         try:
             pack.start(self.target)
         except NotImplementedError:
@@ -179,6 +197,7 @@ class Analyzer(object):
                               "an unhandled exception: "
                               "{1}".format(package_name, e))
 
+        self.timeline.phase("main_loop")
         time_counter = 0
         while True:
             time_counter += 1
@@ -206,6 +225,7 @@ class Analyzer(object):
                 # Zzz.
                 time.sleep(1)
 
+        self.timeline.phase("package_finish")
         try:
             # Before shutting down the analysis, the package can perform some
             # final operations through the finish() function.
@@ -215,6 +235,7 @@ class Analyzer(object):
                         "exception: %s", package_name, e)
 
         # Terminate the Auxiliary modules.
+        self.timeline.phase("aux_stop")
         for aux in aux_enabled:
             try:
                 aux.stop()
@@ -4,13 +4,53 @@
 # Originally contributed by Check Point Software Technologies, Ltd.
 
 import ConfigParser
+import os
+import threading
 
 class Config:
+    # Parsed configuration files by path, along with the modification time
+    # and size they were parsed at. Every netlog connection, e.g., for each
+    # screenshot, loads the configuration for the address of the result
+    # server, so it's only parsed again if it has changed.
+    cache = {}
+    lock = threading.Lock()
+
     def __init__(self, cfg):
         """@param cfg: configuration file."""
+        for name, value in self.load(cfg).items():
+            setattr(self, name, value)
+
+    @classmethod
+    def load(cls, cfg):
+        """Get the values of a configuration file.
+        @param cfg: configuration file.
+        @return: dict of values, which is shared and should not be modified.
+        """
+        path = os.path.abspath(cfg)
+        try:
+            st = os.stat(path)
+            stamp = st.st_mtime, st.st_size
+        except OSError:
+            stamp = None
+
+        with cls.lock:
+            if path in cls.cache and cls.cache[path][0] == stamp:
+                return cls.cache[path][1]
+
+            values = cls.parse(path)
+            cls.cache[path] = stamp, values
+            return values
+
+    @classmethod
+    def parse(cls, cfg):
+        """Parse a configuration file.
+        @param cfg: configuration file.
+        @return: dict of values.
+        """
         config = ConfigParser.ConfigParser(allow_no_value=True)
         config.read(cfg)
 
+        ret = {}
         for section in config.sections():
             for name, raw_value in config.items(section):
                 try:
@@ -21,4 +61,5 @@ class Config:
                     except ValueError:
                         value = config.get(section, name)
 
-                setattr(self, name, value)
+                ret[name] = value
+        return ret
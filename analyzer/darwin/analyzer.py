@@ -12,8 +12,9 @@ from os import path, getcwd, makedirs
 import pkgutil
 
 from lib.common.config import Config
-from lib.common.hashing import hash_file
+from lib.common.hashing import hash_file_buffered
 from lib.common.results import NetlogHandler, upload_to_host
+from lib.common.timeline import Timeline
 from lib.core.constants import PATHS
 from lib.core.packages import choose_package_class
 from lib.core.osx import set_wallclock
@@ -34,9 +35,15 @@ class Macalyzer(object):
     files_to_upload = []
     uploaded_hashes = []
 
+    # Files up to this size are hashed and then uploaded from memory, larger
+    # ones are hashed while uploading.
+    MAX_SIZE_BUFFERED = 8*1024*1024
+
     def __init__(self, host, configuration=None):
         self.config = configuration
         self.host = host
+        self.timeline = Timeline()
+        self.host.timeline = self.timeline
 
     def bootstrap(self):
         _create_result_folders()
@@ -46,6 +53,7 @@ class Macalyzer(object):
     def run(self):
         """Run analysis.
         """
+        self.timeline.phase("prepare")
         self.bootstrap()
 
         self.log.debug("Starting analyzer from %s", getcwd())
@@ -57,6 +65,7 @@ class Macalyzer(object):
             set_wallclock(self.config.clock)
 
         # Initialize Auxiliary modules
+        self.timeline.phase("aux_import")
         Auxiliary()
         prefix = auxiliary.__name__ + "."
         for loader, name, ispkg in pkgutil.iter_modules(auxiliary.__path__, prefix):
@@ -71,6 +80,7 @@ class Macalyzer(object):
                             "\"%s\": %s", name, e)
 
         # Walk through the available auxiliary modules.
+        self.timeline.phase("aux_start")
         aux_enabled, aux_avail = [], []
         for module in Auxiliary.__subclasses__():
             # Try to start the auxiliary module.
@@ -91,13 +101,21 @@ class Macalyzer(object):
                           module.__name__)
                 aux_enabled.append(aux)
 
+        # The package runs the analysis itself.
+        self.timeline.phase("main_loop")
         self._analysis(package)
 
         return self._complete()
 
     def _complete(self):
+        self.timeline.phase("file_dumps")
         for f in self.files_to_upload:
             self._upload_file(f)
+
+        # Report where the time went.
+        self.timeline.phase("complete")
+        self.timeline.stop()
+        self.timeline.upload()
         return True
 
     #
@@ -138,22 +156,39 @@ class Macalyzer(object):
     def _upload_file(self, filepath):
         if not path.isfile(filepath):
             return
-        # Check whether we've already dumped this file - in that case skip it
-        try:
-            hashsum = hash_file(sha256, filepath)
-            if sha256 in self.uploaded_hashes:
+        basename = path.basename(filepath)
+
+        def name(hashsum):
+            # Check whether we've already dumped this file - in that case
+            # skip it
+            if hashsum in self.uploaded_hashes:
                 return
-        except IOError as e:
+            return path.join("files", "%s_%s" % (hashsum[:16], basename))
+
+        try:
+            hashsum, data = hash_file_buffered(
+                sha256, filepath, self.MAX_SIZE_BUFFERED
+            )
+        except (IOError, OSError) as e:
             self.log.info("Error dumping file from path \"%s\": %s", filepath, e)
             return
-        filename = "%s_%s" % (hashsum[:16], path.basename(filepath))
-        upload_path = path.join("files", filename)
 
-        try:
-            upload_to_host(filepath, upload_path)
+        # Larger files are hashed while uploading, they're named afterwards
+        # and dropped by the result server if they turn out to be a duplicate.
+        if hashsum:
+            upload_path = name(hashsum)
+            if not upload_path:
+                return
+            hashsum = upload_to_host(filepath, upload_path, data)
+        else:
+            hashsum = upload_to_host(
+                filepath, path.join("files", basename), name=name
+            )
+
+        if not hashsum:
+            self.log.error("Unable to upload dropped file at path \"%s\"", filepath)
+        elif hashsum not in self.uploaded_hashes:
             self.uploaded_hashes.append(hashsum)
-        except IOError as e:
-            self.log.error("Unable to upload dropped file at path \"%s\": %s", filepath, e)
 
 def _create_result_folders():
     for _, folder in PATHS.items():
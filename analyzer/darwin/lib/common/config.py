@@ -3,13 +3,54 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import ConfigParser
+import os
+import threading
 
 class Config:
+    # Parsed configuration files by path, along with the modification time
+    # and size they were parsed at. Every netlog connection, e.g., for each
+    # dropped file and screenshot, loads the configuration for the address
+    # of the result server, so it's only parsed again if it has changed.
+    cache = {}
+    lock = threading.Lock()
+
     def __init__(self, cfg):
         """@param cfg: configuration file."""
+        values = self.load(cfg)
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def load(cls, cfg):
+        """Get the values of a configuration file.
+        @param cfg: configuration file.
+        @return: dict of values, which is shared and should not be modified.
+        """
+        path = os.path.abspath(cfg)
+        try:
+            st = os.stat(path)
+            stamp = st.st_mtime, st.st_size
+        except OSError:
+            stamp = None
+
+        with cls.lock:
+            if path in cls.cache and cls.cache[path][0] == stamp:
+                return cls.cache[path][1]
+
+            values = cls.parse(path)
+            cls.cache[path] = stamp, values
+            return values
+
+    @classmethod
+    def parse(cls, cfg):
+        """Parse a configuration file.
+        @param cfg: configuration file.
+        @return: dict of values.
+        """
         config = ConfigParser.ConfigParser(allow_no_value=True)
         config.read(cfg)
 
+        ret = {}
         for section in config.sections():
             for name, raw_value in config.items(section):
                 if name == "file_name":
@@ -22,10 +63,12 @@ class Config:
                             value = config.getint(section, name)
                         except ValueError:
                             value = config.get(section, name)
-                setattr(self, name, value)
+                ret[name] = value
+        return ret
 
-    def get_options(self):
-        """Get analysis options.
+    @staticmethod
+    def parse_options(options):
+        """Parse analysis options.
         @return: options dict.
         """
         # The analysis package can be provided with some options in the
@@ -34,35 +77,31 @@ class Config:
         #
         # Here we parse such options and provide a dictionary that will be made
         # accessible to the analysis package.
-        options = {}
-        if hasattr(self, "options") and len(self.options) > 0:
-            try:
-                # Split the options by comma.
-                fields = self.options.split(",")
-            except ValueError:
-                pass
-            else:
-                for field in fields:
-                    # Split the name and the value of the option.
-                    try:
-                        # Sometimes, we have a key without a value (i.e. it's a
-                        # command line argument), so we can't use the
-                        # `key, value = field.split("=", 1)` style here
-                        parts = field.split("=", 1)
-                    except ValueError:
-                        pass
-                    else:
-                        key = parts[0].strip()
-                        arg_prefix = "arg-"
-                        if not key.startswith(arg_prefix):
-                            # If the parsing went good, we add the option to the
-                            # dictionary.
-                            value = parts[1].strip()
-                            options[key] = value
-                        elif len(key) > len(arg_prefix):
-                            # Remove "arg-" prefix from the key
-                            key = key[4:]; parts[0] = key
-                            # Add this key (with a value maybe) to the args
-                            if "args" not in options: options["args"] = []
-                            options["args"] += parts
-        return options
+        ret = {}
+        if not isinstance(options, basestring) or not options:
+            return ret
+
+        arg_prefix = "arg-"
+        for field in options.split(","):
+            # Sometimes, we have a key without a value (i.e. it's a command
+            # line argument), so we can't use the
+            # `key, value = field.split("=", 1)` style here
+            parts = field.split("=", 1)
+            key = parts[0].strip()
+            if not key.startswith(arg_prefix):
+                # If the parsing went good, we add the option to the
+                # dictionary.
+                if len(parts) == 2:
+                    ret[key] = parts[1].strip()
+            elif len(key) > len(arg_prefix):
+                # Remove "arg-" prefix from the key
+                parts[0] = key[len(arg_prefix):]
+                # Add this key (with a value maybe) to the args
+                ret.setdefault("args", []).extend(parts)
+        return ret
+
+    def get_options(self):
+        """Get analysis options.
+        @return: options dict.
+        """
+        return self.parse_options(getattr(self, "options", None))
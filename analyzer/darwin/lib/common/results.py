@@ -4,23 +4,57 @@
 
 import time
 import socket
+import struct
+import hashlib
+import io
 import logging
+import os
 from config import Config
+from hashing import hash_fileobj
 
 log = logging.getLogger(__name__)
 
 BUFSIZE = 1024*1024
 
-def upload_to_host(file_path, dump_path):
+# Seconds to wait for the result server to answer.
+ACK_TIMEOUT = 60
+
+def upload_to_host(file_path, dump_path, data=None, name=None):
+    """Uploads a file to the result server, hashing it along the way.
+    @param data: contents of the file if these have been read already.
+    @param name: callable that returns the final dump path given the sha256
+    hash of the file, or None to drop the file. dump_path is provisional in
+    that case, the file is named once it has been hashed while uploading.
+    @return: sha256 hash of the uploaded data or None on failure.
+    """
     nc = infd = None
     try:
+        if data is None:
+            infd = open(file_path, "rb")
+        else:
+            infd = io.BytesIO(data)
+
+        if name and NetlogUpload.renames():
+            nc = NetlogUpload()
+            return nc.upload(infd, dump_path, name)
+
+        # Without a result server that renames uploads, the file has to be
+        # hashed before it's uploaded.
+        if name:
+            sha256 = hash_fileobj(hashlib.sha256, infd)
+            dump_path = name(sha256)
+            if not dump_path:
+                return sha256
+
         nc = NetlogFile(dump_path)
 
-        infd = open(file_path, "rb")
+        sha256 = hashlib.sha256()
         buf = infd.read(BUFSIZE)
         while buf:
+            sha256.update(buf)
             nc.send(buf, retry=False)
             buf = infd.read(BUFSIZE)
+        return sha256.hexdigest()
     except Exception as e:
         log.error("Exception uploading file %s to host: %s", file_path, e)
     finally:
@@ -31,8 +65,8 @@ def upload_to_host(file_path, dump_path):
 
 class NetlogConnection(object):
     def __init__(self, proto=""):
-        config = Config(cfg="analysis.conf")
-        self.hostip, self.hostport = config.ip, config.port
+        config = Config.load("analysis.conf")
+        self.hostip, self.hostport = config["ip"], config["port"]
         self.sock, self.file = None, None
         self.proto = proto
 
@@ -83,7 +117,118 @@ class NetlogFile(NetlogConnection):
         NetlogConnection.__init__(self, proto="FILE\n{0}\n".format(self.filepath))
         self.connect()
 
+class NetlogUpload(NetlogConnection):
+    """Uploads a file as the single stream of a multiplexed connection, using
+    the resumable upload protocol of the result server: the file is sent as
+    chunk records followed by a name record and a trailer with its sha256
+    hash, so that the file can be named after its hash without reading it
+    twice. The name is the final dump path, an empty one drops the file.
+    Interrupted uploads aren't resumed, they fail like any other upload."""
+
+    FRAME = struct.Struct("!IBI")
+    OPEN, DATA, CLOSE, ACK = 1, 2, 3, 4
+
+    ACK_INFO = struct.Struct("!QB")
+    PENDING, COMPLETE, FAILED = 0, 1, 2
+
+    RECORD = struct.Struct("!BQI")
+    CHUNK, TRAILER, NAME = 1, 2, 3
+
+    STREAM_ID = 1
+
+    # Features advertised by the result server, negotiated once.
+    features = None
+
+    def __init__(self):
+        NetlogConnection.__init__(self, proto="MUX\n")
+
+    @classmethod
+    def renames(cls):
+        """Returns whether the result server can name uploads afterwards."""
+        if cls.features is None:
+            nc = cls()
+            try:
+                cls.features = nc.negotiate()
+            except (IOError, socket.error) as e:
+                log.debug("Result server doesn't multiplex: %s", e)
+                cls.features = []
+            finally:
+                nc.close()
+
+        return "resume" in cls.features and "rename" in cls.features
+
+    def negotiate(self):
+        """Connects to the result server.
+        @return: list of features that it advertises.
+        """
+        self.connect()
+        self.sock.settimeout(ACK_TIMEOUT)
+
+        # Older result servers drop the connection instead.
+        line = self.file.readline()
+        if not line.startswith("OK"):
+            raise IOError("multiplexing has been refused")
+        return line.split()[1:]
+
+    def frame(self, frame_type, data=""):
+        self.sock.sendall(
+            self.FRAME.pack(self.STREAM_ID, frame_type, len(data)) + data
+        )
+
+    def record(self, record_type, offset, data):
+        self.frame(
+            self.DATA, self.RECORD.pack(record_type, offset, len(data)) + data
+        )
+
+    def upload(self, f, dump_path, name):
+        """Uploads the contents of a file object and waits for the result
+        server to confirm it.
+        @return: sha256 hash of the uploaded data.
+        """
+        self.negotiate()
+
+        # Provisional dump paths have to be unique, as the result server
+        # keeps incomplete uploads next to them.
+        upload_id = os.urandom(8).encode("hex")
+        self.frame(self.OPEN, "FILE 3\n%s.%s\n\n\nupload=%s\n" % (
+            dump_path.encode("utf8"), upload_id, upload_id
+        ))
+
+        sha256, offset = hashlib.sha256(), 0
+        buf = f.read(BUFSIZE)
+        while buf:
+            sha256.update(buf)
+            self.record(self.CHUNK, offset, buf)
+            offset += len(buf)
+            buf = f.read(BUFSIZE)
+
+        dump_name = name(sha256.hexdigest()) or ""
+        self.record(self.NAME, offset, dump_name.encode("utf8"))
+        self.record(self.TRAILER, offset, sha256.digest())
+        self.frame(self.CLOSE)
+
+        # Every record is acknowledged, only the final status matters.
+        while True:
+            header = self.file.read(self.FRAME.size)
+            if len(header) != self.FRAME.size:
+                raise IOError("upload has been interrupted")
+
+            _, frame_type, length = self.FRAME.unpack(header)
+            data = self.file.read(length)
+            if frame_type != self.ACK or len(data) != self.ACK_INFO.size:
+                continue
+
+            _, status = self.ACK_INFO.unpack(data)
+            if status == self.COMPLETE:
+                return sha256.hexdigest()
+            if status == self.FAILED:
+                raise IOError("upload has been rejected by the result server")
+
 class NetlogHandler(logging.Handler, NetlogConnection):
+    """Sends log records to the result server as they're emitted. The
+    analyzer only logs a handful of records around the analysis itself, the
+    behavior is reported through dtrace, so there's no need to queue them."""
+
     def __init__(self):
         logging.Handler.__init__(self)
         NetlogConnection.__init__(self, proto="LOG\n")
@@ -37,6 +37,8 @@ class CuckooHost(object):
         # Here goes all the additional information about APIs like category,
         # arguments names and so on. See date/apis.json for more details.
     }
+    # The analyzer's Timeline, on which the first API call is recorded.
+    timeline = None
 
     def __init__(self, host_ip, host_port):
         self.ip = host_ip
@@ -57,6 +59,8 @@ class CuckooHost(object):
             # ... and don't forget to explain every single API call again
             self.descriptions.setdefault(pid, ["__process__", "__thread__"])
             self._send_new_process(thing)
+            if self.timeline:
+                self.timeline.event("first_monitored_event")
         try:
             lookup_idx = self.descriptions[pid].index(api)
         except ValueError:
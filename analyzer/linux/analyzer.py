@@ -7,6 +7,7 @@ import sys
 import pkgutil
 import logging
 import tempfile
+import threading
 import xmlrpclib
 import traceback
 import urllib
@@ -14,11 +15,12 @@ import urllib2
 import time
 import datetime
 
-from lib.api.process import Process
+from lib.api.process import Process, ProcessWatcher
 from lib.common.abstracts import Package, Auxiliary
 from lib.common.constants import PATHS
 from lib.common.exceptions import CuckooError, CuckooPackageError
 from lib.common.results import upload_to_host
+from lib.common.timeline import Timeline, monotonic
 from lib.core.config import Config
 from lib.core.startup import create_folders, init_logging
 from modules import auxiliary
@@ -28,21 +30,60 @@ log = logging.getLogger()
 PID = os.getpid()
 FILES_LIST = set()
 DUMPED_LIST = set()
-PROCESS_LIST = set()
 SEEN_LIST = set()
 PPID = Process(pid=PID).get_parent_pid()
 
-def add_pids(pids):
-    """Add PID."""
-    if not isinstance(pids, (tuple, list, set)):
-        pids = [pids]
+class ProcessList(object):
+    def __init__(self):
+        self.pids = set()
+
+        # Protects the process identifiers. The condition is notified when a
+        # process has been added or has terminated.
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.watcher = ProcessWatcher(self.terminated)
+
+    def add_pids(self, pids):
+        """Add one or more process identifiers to the process list. Processes
+        that have been seen before aren't tracked again."""
+        if not isinstance(pids, (tuple, list, set)):
+            pids = [pids]
+
+        for pid in pids:
+            log.info("Added new process to list with pid: %s", pid)
+            pid = int(pid)
+            with self.lock:
+                if pid not in SEEN_LIST:
+                    self.pids.add(pid)
+                    self.watcher.watch(pid)
+                    self.changed.notify_all()
+                SEEN_LIST.add(pid)
+
+    def terminated(self, pid):
+        """Called by the process watcher when a process has terminated."""
+        with self.lock:
+            log.info("Process with pid %s has terminated", pid)
+            self.pids.discard(pid)
+            self.changed.notify_all()
+
+    def tracked(self):
+        """Get the process identifiers of the tracked processes.
+        @return: set of pids.
+        """
+        with self.lock:
+            return set(self.pids)
+
+    def wait(self, timeout):
+        """Wait until none of the tracked processes are alive anymore.
+        @param timeout: maximum amount of seconds to wait.
+        @return: whether all tracked processes have terminated.
+        """
+        with self.lock:
+            if self.pids:
+                self.changed.wait(timeout)
+            return not self.pids
 
-    for pid in pids:
-        log.info("Added new process to list with pid: %s", pid)
-        pid = int(pid)
-        if pid not in SEEN_LIST:
-            PROCESS_LIST.add(pid)
-        SEEN_LIST.add(pid)
+PROCESS_LIST = ProcessList()
 
 def dump_files():
     """Dump all the dropped files."""
@@ -59,6 +100,7 @@ class Analyzer:
     def __init__(self):
         self.config = None
         self.target = None
+        self.timeline = Timeline()
 
     def prepare(self):
         """Prepare env for analysis."""
@@ -89,15 +131,27 @@ class Analyzer:
     def complete(self):
         """End analysis."""
         # Dump all the notified files.
+        self.timeline.phase("file_dumps")
         dump_files()
 
+        # Report where the time went.
+        self.timeline.phase("complete")
+        self.timeline.stop()
+        self.timeline.upload()
+
         # Hell yeah.
         log.info("Analysis completed.")
 
+        # Make sure the queued log records reach the result server before
+        # the analysis is reported as completed.
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+
     def run(self):
         """Run analysis.
         @return: operation status.
         """
+        self.timeline.phase("prepare")
         self.prepare()
 
         log.debug("Starting analyzer from: %s", os.getcwd())
@@ -150,6 +204,7 @@ class Analyzer:
         pack = package_class(self.config.get_options())
 
         # Initialize Auxiliary modules
+        self.timeline.phase("aux_import")
         Auxiliary()
         prefix = auxiliary.__name__ + "."
         for loader, name, ispkg in pkgutil.iter_modules(auxiliary.__path__, prefix):
@@ -164,6 +219,7 @@ class Analyzer:
                             "\"%s\": %s", name, e)
 
         # Walk through the available auxiliary modules.
+        self.timeline.phase("aux_start")
         aux_enabled, aux_avail = [], []
         for module in sorted(Auxiliary.__subclasses__(), key=lambda x: x.priority, reverse=True):
             # Try to start the auxiliary module.
@@ -186,6 +242,7 @@ class Analyzer:
 
         # Start analysis package. If for any reason, the execution of the
         # analysis package fails, we have to abort the analysis.
+        self.timeline.phase("package_start")
         try:
             pids = pack.start(self.target)
         except NotImplementedError:
@@ -202,7 +259,8 @@ class Analyzer:
         # If the analysis package returned a list of process IDs, we add them
         # to the list of monitored processes and enable the process monitor.
         if pids:
-            add_pids(pids)
+            PROCESS_LIST.add_pids(pids)
+            self.timeline.event("first_monitored_event")
             pid_check = True
 
         # If the package didn't return any process ID (for example in the case
@@ -219,33 +277,28 @@ class Analyzer:
             log.info("Enabled timeout enforce, running for the full timeout.")
             pid_check = False
 
-        time_counter = 0
+        self.timeline.phase("main_loop")
+        end = monotonic() + int(self.config.timeout)
 
         while True:
-            time_counter += 1
-            if time_counter == int(self.config.timeout):
+            now = monotonic()
+            if now >= end:
                 log.info("Analysis timeout hit, terminating analysis.")
                 break
 
             try:
-                # If the process monitor is enabled we start checking whether
-                # the monitored processes are still alive.
+                # If the process monitor is enabled we wait for the monitored
+                # processes to terminate. The process watcher wakes us up as
+                # soon as the last one has, rather than at the next interval.
                 if pid_check:
-                    for pid in list(PROCESS_LIST):
-                        if not Process(pid=pid).is_alive():
-                            log.info("Process with pid %s has terminated", pid)
-                            PROCESS_LIST.remove(pid)
-
                     # ask the package if it knows any new pids
-                    add_pids(pack.get_pids())
+                    PROCESS_LIST.add_pids(pack.get_pids())
 
                     # also ask the auxiliaries
                     for aux in aux_avail:
-                        add_pids(aux.get_pids())
+                        PROCESS_LIST.add_pids(aux.get_pids())
 
-                    # If none of the monitored processes are still alive, we
-                    # can terminate the analysis.
-                    if not PROCESS_LIST:
+                    if PROCESS_LIST.wait(min(end - now, 1)):
                         log.info("Process list is empty, "
                                  "terminating analysis.")
                         break
@@ -253,7 +306,10 @@ class Analyzer:
                     # Update the list of monitored processes available to the
                     # analysis package. It could be used for internal
                     # operations within the module.
-                    pack.set_pids(PROCESS_LIST)
+                    pack.set_pids(PROCESS_LIST.tracked())
+                else:
+                    # Zzz.
+                    time.sleep(1)
 
                 try:
                     # The analysis packages are provided with a function that
@@ -273,10 +329,9 @@ class Analyzer:
                                 "an exception: %s", package_name, e)
             except Exception as e:
                 log.exception("The PID watching loop raised an exception: %s", e)
-            finally:
-                # Zzz.
                 time.sleep(1)
 
+        self.timeline.phase("package_finish")
         try:
             # Before shutting down the analysis, the package can perform some
             # final operations through the finish() function.
@@ -285,6 +340,7 @@ class Analyzer:
             log.warning("The package \"%s\" finish function raised an "
                         "exception: %s", package_name, e)
 
+        self.timeline.phase("package_files")
         try:
             # Upload files the package created to package_files in the results folder
             package_files = pack.package_files()
@@ -298,6 +354,7 @@ class Analyzer:
                         "exception: %s", package_name, e)
 
         # Terminate the Auxiliary modules.
+        self.timeline.phase("aux_stop")
         for aux in sorted(aux_enabled, key=lambda x: x.priority):
             try:
                 aux.stop()
@@ -312,7 +369,7 @@ class Analyzer:
             # that we clean up remaining open handles (sockets, files, etc.).
             log.info("Terminating remaining processes before shutdown.")
 
-            for pid in PROCESS_LIST:
+            for pid in PROCESS_LIST.tracked():
                 proc = Process(pid=pid)
                 if proc.is_alive():
                     try:
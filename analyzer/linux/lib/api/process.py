@@ -2,12 +2,19 @@
 # This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
 # See the file 'docs/LICENSE' for copying permission.
 
+import ctypes
+import errno
 import os
+import select
 import subprocess
 import logging
+import threading
 
 log = logging.getLogger(__name__)
 
+# The pidfd_open(2) system call shares its number across architectures.
+SYS_pidfd_open = 434
+
 class Process:
     """Linux process."""
     first_process = True
@@ -22,7 +29,7 @@ class Process:
         if not os.path.exists("/proc/%u" % self.pid): return False
         status = self.get_proc_status()
         if not status: return False
-        if "zombie" in status.get("State:", ""): return False
+        if "zombie" in status.get("State", ""): return False
         return True
 
     def get_parent_pid(self):
@@ -31,7 +38,8 @@ class Process:
     def get_proc_status(self):
         try:
             status = open("/proc/%u/status" % self.pid).readlines()
-            status_values = dict((i[0], i[1]) for i in [j.strip().split(None, 1) for j in status])
+            # Some fields, e.g., "Groups", may not have a value.
+            status_values = dict((i[0].strip(), i[2].strip()) for i in [j.partition(":") for j in status])
             return status_values
         except:
             log.critical("could not get process status for pid %u", self.pid)
@@ -41,3 +49,112 @@ class Process:
         self.proc = proc = subprocess.Popen(cmd)
         self.pid = proc.pid
         return True
+
+class ProcessWatcher(threading.Thread):
+    """Polls a pidfd of each of the watched processes and reports each
+    process that has exited through a callback, so that nobody has to poll
+    /proc. On kernels without pidfd_open(2), i.e., before Linux 5.3, the
+    processes are checked through /proc once in a while instead."""
+
+    POLL_INTERVAL = 1000
+
+    def __init__(self, callback):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.callback = callback
+        self.pidfds = {}
+        self.lock = threading.Lock()
+        self.poll = select.poll()
+        self.do_run = True
+
+        # Used to wake up the thread when the watched processes change.
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        self.poll.register(self.wakeup_r, select.POLLIN)
+
+        try:
+            self.syscall = ctypes.CDLL(None, use_errno=True).syscall
+        except (OSError, AttributeError):
+            self.syscall = None
+
+    def pidfd_open(self, pid):
+        """Get a file descriptor that becomes readable once the process has
+        exited.
+        @return: file descriptor, or None if pidfd is not supported.
+        @raise OSError: the process doesn't exist.
+        """
+        if not self.syscall:
+            return
+
+        fd = self.syscall(SYS_pidfd_open, pid, 0)
+        if fd >= 0:
+            return fd
+
+        err = ctypes.get_errno()
+        if err in (errno.ENOSYS, errno.EPERM):
+            self.syscall = None
+            return
+        raise OSError(err, os.strerror(err))
+
+    def watch(self, pid):
+        """Start watching a process. If the process doesn't exist, it's
+        considered to have exited."""
+        with self.lock:
+            if pid in self.pidfds:
+                return
+
+            try:
+                fd = self.pidfd_open(pid)
+            except OSError:
+                fd = -1
+
+            self.pidfds[pid] = fd
+            if fd is not None and fd >= 0:
+                self.poll.register(fd, select.POLLIN)
+
+            if not self.is_alive():
+                self.start()
+
+        os.write(self.wakeup_w, "\x00")
+
+    def has_exited(self, pid, fd, ready):
+        if fd is None:
+            return not Process(pid=pid).is_alive()
+        return fd < 0 or fd in ready
+
+    def run(self):
+        while self.do_run:
+            with self.lock:
+                pidfds = self.pidfds.items()
+
+            # Processes without a pidfd have to be polled.
+            if any(fd is None for pid, fd in pidfds):
+                timeout = self.POLL_INTERVAL
+            else:
+                timeout = None
+
+            try:
+                ready = set(fd for fd, event in self.poll.poll(timeout))
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+
+            if self.wakeup_r in ready:
+                os.read(self.wakeup_r, 4096)
+
+            for pid, fd in pidfds:
+                if not self.has_exited(pid, fd, ready):
+                    continue
+
+                with self.lock:
+                    self.pidfds.pop(pid, None)
+                    if fd is not None and fd >= 0:
+                        self.poll.unregister(fd)
+                        os.close(fd)
+
+                self.callback(pid)
+
+    def stop(self):
+        """Stop watching processes."""
+        self.do_run = False
+        os.write(self.wakeup_w, "\x00")
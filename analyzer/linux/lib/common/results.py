@@ -2,8 +2,11 @@
 # This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
 # See the file 'docs/LICENSE' for copying permission.
 
+import Queue
 import logging
 import socket
+import sys
+import threading
 import time
 
 from lib.core.config import Config
@@ -32,8 +35,8 @@ def upload_to_host(file_path, dump_path):
 
 class NetlogConnection(object):
     def __init__(self, proto=""):
-        config = Config(cfg="analysis.conf")
-        self.hostip, self.hostport = config.ip, config.port
+        config = Config.load("analysis.conf")
+        self.hostip, self.hostport = config["ip"], config["port"]
         self.sock, self.file = None, None
         self.proto = proto
 
@@ -85,11 +88,79 @@ class NetlogFile(NetlogConnection):
         self.connect()
 
 class NetlogHandler(logging.Handler, NetlogConnection):
+    """Sends log records to the result server from a background thread.
+
+    Records are queued by emit() and written in batches by the sender thread
+    so that the analysis loop, the process watcher and the auxiliary modules
+    don't wait on the network for every record. When the queue is full new
+    records are dropped and counted, and a notice with the number of dropped
+    records is sent once there's room again."""
+
+    QUEUE_SIZE = 4096
+    BATCH_SIZE = 64*1024
+    FLUSH_TIMEOUT = 10
+
     def __init__(self):
         logging.Handler.__init__(self)
         NetlogConnection.__init__(self, proto="LOG\n")
+        self.queue = Queue.Queue(self.QUEUE_SIZE)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
         self.connect()
 
+        self.sender = threading.Thread(target=self.run)
+        self.sender.daemon = True
+        self.sender.start()
+
     def emit(self, record):
-        msg = self.format(record)
-        self.send("{0}\n".format(msg))
+        try:
+            self.queue.put_nowait("%s\n" % self.format(record))
+        except Queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            length = len(batch[0])
+            while length < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+                length += len(batch[-1])
+
+            records = len(batch)
+            with self.dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+
+            if dropped:
+                batch.append("%s\n" % self.format(logging.makeLogRecord({
+                    "name": __name__,
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": "Dropped %d log records, log queue was full.",
+                    "args": (dropped,),
+                })))
+
+            try:
+                self.send("".join(batch))
+            except Exception as e:
+                print >>sys.stderr, "Error sending log records:", str(e)
+
+            for _ in xrange(records):
+                self.queue.task_done()
+
+    def flush(self):
+        """Waits, for at most FLUSH_TIMEOUT seconds, until all queued log
+        records have been sent. Called by Analyzer.complete() and on exit.
+        @return: whether all records have been sent.
+        """
+        deadline = time.time() + self.FLUSH_TIMEOUT
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
@@ -0,0 +1,116 @@
+# Copyright (C) 2017 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from lib.common.results import upload_to_host
+
+log = logging.getLogger(__name__)
+
+PLATFORM = "linux"
+CLOCK_MONOTONIC = 1
+
+class timespec(ctypes.Structure):
+    _fields_ = [
+        ("tv_sec", ctypes.c_long),
+        ("tv_nsec", ctypes.c_long),
+    ]
+
+try:
+    clock_gettime = ctypes.CDLL(ctypes.util.find_library("c")).clock_gettime
+except (OSError, AttributeError):
+    clock_gettime = None
+
+def monotonic():
+    """Seconds since some point in time, unaffected by changes to the
+    system clock (which the analysis itself does). Falls back to the
+    system clock if clock_gettime(2) is not available."""
+    ts = timespec()
+    if clock_gettime and not clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+        return ts.tv_sec + ts.tv_nsec / 1e9
+    return time.time()
+
+class Timeline(object):
+    """Records how long each phase of the analysis takes. Phases follow one
+    another, starting a phase ends the current one. Events, e.g., the first
+    process being monitored, are points in time. The timeline is uploaded as
+    a JSON document so that it can be aggregated across tasks."""
+
+    DUMP_PATH = "logs/timeline.json"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.base = monotonic()
+        self.phases = []
+        self.events = {}
+        self.current = None
+
+    def phase(self, name):
+        """End the current phase, if any, and start the next one."""
+        now = monotonic()
+        with self.lock:
+            self._end(now)
+            self.current = name, now
+
+    def stop(self):
+        """End the current phase."""
+        now = monotonic()
+        with self.lock:
+            self._end(now)
+
+    def _end(self, now):
+        if self.current:
+            name, start = self.current
+            self.phases.append({
+                "name": name,
+                "start": round(start - self.base, 3),
+                "duration": round(now - start, 3),
+            })
+            self.current = None
+
+    def event(self, name, timestamp=None):
+        """Record the first occurrence of an event.
+        @param timestamp: monotonic() timestamp, defaults to now.
+        """
+        timestamp = monotonic() if timestamp is None else timestamp
+        with self.lock:
+            if name not in self.events:
+                self.events[name] = round(timestamp - self.base, 3)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "platform": PLATFORM,
+                "started": self.started,
+                "duration": round(monotonic() - self.base, 3),
+                "phases": list(self.phases),
+                "events": dict(self.events),
+            }
+
+    def upload(self):
+        """Upload the timeline to the result server."""
+        timeline = self.to_dict()
+
+        fd, filepath = tempfile.mkstemp(suffix=".json")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                json.dump(timeline, f)
+            upload_to_host(filepath, self.DUMP_PATH)
+        except (IOError, OSError) as e:
+            log.warning("Error uploading the analysis timeline: %s", e)
+        finally:
+            os.unlink(filepath)
+
+        log.debug("Analysis phases: %s.", ", ".join(
+            "%s=%.1fs" % (phase["name"], phase["duration"])
+            for phase in timeline["phases"]
+        ))
@@ -3,13 +3,54 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import ConfigParser
+import os
+import threading
 
 class Config:
+    # Parsed configuration files by path, along with the modification time
+    # and size they were parsed at. Every netlog connection, e.g., for each
+    # package file that is uploaded, loads the configuration for the address
+    # of the result server, so it's only parsed again if it has changed.
+    cache = {}
+    lock = threading.Lock()
+
     def __init__(self, cfg):
         """@param cfg: configuration file."""
+        values = self.load(cfg)
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    @classmethod
+    def load(cls, cfg):
+        """Get the values of a configuration file.
+        @param cfg: configuration file.
+        @return: dict of values, which is shared and should not be modified.
+        """
+        path = os.path.abspath(cfg)
+        try:
+            st = os.stat(path)
+            stamp = st.st_mtime, st.st_size
+        except OSError:
+            stamp = None
+
+        with cls.lock:
+            if path in cls.cache and cls.cache[path][0] == stamp:
+                return cls.cache[path][1]
+
+            values = cls.parse(path)
+            cls.cache[path] = stamp, values
+            return values
+
+    @classmethod
+    def parse(cls, cfg):
+        """Parse a configuration file.
+        @param cfg: configuration file.
+        @return: dict of values.
+        """
         config = ConfigParser.ConfigParser(allow_no_value=True)
         config.read(cfg)
 
+        ret = {}
         for section in config.sections():
             for name, raw_value in config.items(section):
                 if name == "file_name":
@@ -22,15 +63,12 @@ class Config:
                             value = config.getint(section, name)
                         except ValueError:
                             value = config.get(section, name)
-                setattr(self, name, value)
+                ret[name] = value
+        return ret
 
-    def get(self, name, default=None):
-        if hasattr(self, name):
-            return getattr(self, name)
-        return default
-
-    def get_options(self):
-        """Get analysis options.
+    @staticmethod
+    def parse_options(options):
+        """Parse analysis options.
         @return: options dict.
         """
         # The analysis package can be provided with some options in the
@@ -39,23 +77,29 @@ class Config:
         #
         # Here we parse such options and provide a dictionary that will be made
         # accessible to the analysis package.
-        options = {}
-        if hasattr(self, "options"):
+        ret = {}
+        if not isinstance(options, basestring):
+            return ret
+
+        for field in options.split(","):
+            # Split the name and the value of the option.
             try:
-                # Split the options by comma.
-                fields = self.options.split(",")
-            except ValueError as e:
+                key, value = field.split("=", 1)
+            except ValueError:
                 pass
             else:
-                for field in fields:
-                    # Split the name and the value of the option.
-                    try:
-                        key, value = field.split("=", 1)
-                    except ValueError:
-                        pass
-                    else:
-                        # If the parsing went good, we add the option to the
-                        # dictionary.
-                        options[key.strip()] = value.strip()
+                # If the parsing went good, we add the option to the
+                # dictionary.
+                ret[key.strip()] = value.strip()
+        return ret
 
-        return options
+    def get(self, name, default=None):
+        if hasattr(self, name):
+            return getattr(self, name)
+        return default
+
+    def get_options(self):
+        """Get analysis options.
+        @return: options dict.
+        """
+        return self.parse_options(getattr(self, "options", None))
@@ -8,7 +8,6 @@ import hashlib
 import logging
 import os
 import pkgutil
-import socket
 import struct
 import sys
 import threading
@@ -18,14 +17,16 @@ import urllib2
 import xmlrpclib
 import zipfile
 
-from lib.api.process import Process
+from lib.api.process import Process, ProcessWatcher
 from lib.common.abstracts import Package, Auxiliary
 from lib.common.constants import SHUTDOWN_MUTEX
 from lib.common.defines import KERNEL32
 from lib.common.exceptions import CuckooError, CuckooDisableModule
-from lib.common.hashing import hash_file
+from lib.common.hashing import hash_file_buffered
 from lib.common.rand import random_string
+from lib.common.results import UploadPool, unconfirmed, upload_stats
 from lib.common.results import upload_to_host
+from lib.common.timeline import Timeline
 from lib.core.config import Config
 from lib.core.ioctl import zer0m0n
 from lib.core.packages import choose_package
@@ -37,6 +38,53 @@ from modules import auxiliary
 log = logging.getLogger("analyzer")
 
 
+class Activity(object):
+    """Keeps track of what the analyzed processes are doing, i.e., the
+    amount of behavior logged by the monitor, the commands it sends, new
+    files and new processes. An analysis without any of these for a while
+    is considered to be idle."""
+
+    # Defaults for ending idle analyses, the amount of seconds without any
+    # activity (0 to never end them early) and the minimum amount of
+    # seconds to run for.
+    IDLE_TIMEOUT = 0
+    IDLE_MIN_RUNTIME = 30
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {
+            "bytes": 0,
+            "commands": 0,
+            "files": 0,
+            "processes": 0,
+        }
+        self.last = KERNEL32.GetTickCount()
+
+        # When the monitor first reported anything.
+        self.first = None
+
+    def add(self, name, count=1):
+        """Count some activity."""
+        with self.lock:
+            self.counters[name] += count
+            self.last = KERNEL32.GetTickCount()
+            if self.first is None and name in ("bytes", "commands"):
+                self.first = self.last
+
+    def idle(self, now):
+        """Get the amount of milliseconds without any activity."""
+        with self.lock:
+            return now - self.last
+
+    def report(self):
+        """Get a summary of the activity counters."""
+        with self.lock:
+            return ", ".join(
+                "%s=%d" % (name, count)
+                for name, count in sorted(self.counters.items())
+            )
+
+
 class Files(object):
     PROTECTED_NAMES = ()
 
@@ -44,104 +92,213 @@ class Files(object):
     MAX_SIZE_SINGLE = 25000000
     MAX_SIZE_TOTAL = 50000000
 
-    def __init__(self):
+    # Files up to this size are hashed and then uploaded from memory, larger
+    # ones are hashed while uploading.
+    MAX_SIZE_BUFFERED = 8*1024*1024
+
+    # Defaults for uploading the pending files at the end of the analysis,
+    # the bandwidth in bytes per second (0 for no limit) and the timeout in
+    # seconds per file.
+    UPLOAD_WORKERS = 4
+    UPLOAD_BANDWIDTH = 0
+    UPLOAD_TIMEOUT = 120
+
+    def __init__(self, activity):
+        self.activity = activity
         self.files = {}
         self.files_orig = {}
         self.dumped = []
         self.dumped_bytes = 0
 
+        # Files are tracked by the pipe handler threads and may be dumped
+        # from multiple threads at once, so the bookkeeping is protected by
+        # a lock. Files that are being dumped are tracked as well.
+        self.lock = threading.RLock()
+        self.dumping = threading.Condition(self.lock)
+        self.dumping_files = set()
+
     def is_protected_filename(self, file_name):
         """Do we want to inject into a process with this name?"""
         return file_name.lower() in self.PROTECTED_NAMES
 
     def add_pid(self, filepath, pid, verbose=True):
         """Tracks a process identifier for this file."""
-        if not pid or filepath.lower() not in self.files:
-            return
+        with self.lock:
+            if not pid or filepath.lower() not in self.files:
+                return
 
-        if pid not in self.files[filepath.lower()]:
-            self.files[filepath.lower()].append(pid)
-            verbose and log.info("Added pid %s for %r", pid, filepath)
+            if pid not in self.files[filepath.lower()]:
+                self.files[filepath.lower()].append(pid)
+                verbose and log.info("Added pid %s for %r", pid, filepath)
 
     def add_file(self, filepath, pid=None):
         """Add filepath to the list of files and track the pid."""
-        if filepath.lower() not in self.files:
-            log.info(
-                "Added new file to list with pid %s and path %s",
-                pid, filepath.encode("utf8")
-            )
-            self.files[filepath.lower()] = []
-            self.files_orig[filepath.lower()] = filepath
+        with self.lock:
+            if filepath.lower() not in self.files:
+                log.info(
+                    "Added new file to list with pid %s and path %s",
+                    pid, filepath.encode("utf8")
+                )
+                self.files[filepath.lower()] = []
+                self.files_orig[filepath.lower()] = filepath
+                self.activity.add("files")
 
-        self.add_pid(filepath, pid, verbose=False)
+            self.add_pid(filepath, pid, verbose=False)
 
-    def dump_file(self, filepath):
+    def dump_file(self, filepath, pool=None):
         """Dump a file to the host."""
+        with self.lock:
+            # Another thread is dumping this file already, wait for it.
+            if filepath.lower() in self.dumping_files:
+                while filepath.lower() in self.dumping_files:
+                    self.dumping.wait()
+                return
+
+            self.dumping_files.add(filepath.lower())
+
+        try:
+            return self._dump_file(filepath, pool)
+        finally:
+            with self.lock:
+                self.dumping_files.discard(filepath.lower())
+                self.dumping.notify_all()
+
+    def _dump_file(self, filepath, pool):
         if not os.path.isfile(filepath):
             log.warning("File at path %r does not exist, skip.", filepath)
             return False
 
-        # Check whether we've already dumped this file - in that case skip it.
         try:
-            sha256 = hash_file(hashlib.sha256, filepath)
-            if sha256 in self.dumped:
-                return
-        except IOError as e:
+            file_size = os.path.getsize(filepath)
+        except (IOError, OSError) as e:
             log.info("Error dumping file from path \"%s\": %s", filepath, e)
             return
 
-        file_size = os.path.getsize(filepath)
-        will_exceed_total = self.dumped_bytes + file_size > self.MAX_SIZE_TOTAL
-
-        if file_size > self.MAX_SIZE_SINGLE or will_exceed_total:
+        if file_size > self.MAX_SIZE_SINGLE:
             log.info("File from path \"%s\" exceeded size limits", filepath)
             return
 
-        filename = "%s_%s" % (sha256[:16], os.path.basename(filepath))
-        upload_path = os.path.join("files", filename)
-
         try:
-            upload_to_host(
-                # If available use the original filepath, the one that is
-                # not lowercased.
-                self.files_orig.get(filepath.lower(), filepath),
-                upload_path, self.files.get(filepath.lower(), [])
+            sha256, data = hash_file_buffered(
+                hashlib.sha256, filepath, self.MAX_SIZE_BUFFERED
             )
-            self.dumped.append(sha256)
+        except (IOError, OSError) as e:
+            log.info("Error dumping file from path \"%s\": %s", filepath, e)
+            return
+
+        basename = os.path.basename(filepath)
+        reserved = []
+
+        def name(sha256):
+            """Reserves the hash of the file and names it accordingly.
+            @return: dump path, or None if the file has been dumped already.
+            """
+            with self.lock:
+                if sha256 in self.dumped:
+                    return
+
+                self.dumped.append(sha256)
+                reserved.append(sha256)
+
+            filename = "%s_%s" % (sha256[:16], basename)
+            return os.path.join("files", filename)
+
+        # Reserve the hash and the file size up front so that concurrent
+        # uploads can't dump the same file twice or exceed the total size
+        # limit together. Larger files are hashed while uploading, they're
+        # named afterwards and dropped by the result server if they turn out
+        # to be a duplicate.
+        with self.lock:
+            # Check whether we've already dumped this file - in that case
+            # skip it.
+            if sha256 and sha256 in self.dumped:
+                return
+
+            if self.dumped_bytes + file_size > self.MAX_SIZE_TOTAL:
+                log.info(
+                    "File from path \"%s\" exceeded size limits", filepath
+                )
+                return
+
             self.dumped_bytes += file_size
-        except (IOError, socket.error) as e:
-            log.error(
-                "Unable to upload dropped file at path \"%s\": %s",
-                filepath, e
+
+            # If available use the original filepath, the one that is
+            # not lowercased.
+            original = self.files_orig.get(filepath.lower(), filepath)
+            pids = list(self.files.get(filepath.lower(), []))
+
+            if sha256:
+                upload_path = name(sha256)
+
+        upload = pool.upload if pool else upload_to_host
+        if sha256:
+            uploaded = upload(original, upload_path, pids, data=data)
+        else:
+            uploaded = upload(
+                original, os.path.join("files", basename), pids, name=name
             )
 
-    def delete_file(self, filepath, pid=None):
+        with self.lock:
+            if not uploaded:
+                for sha256 in reserved:
+                    self.dumped.remove(sha256)
+                self.dumped_bytes -= file_size
+                log.error(
+                    "Unable to upload dropped file at path \"%s\"", filepath
+                )
+            elif not reserved:
+                # A duplicate after all, it hasn't been stored.
+                self.dumped_bytes -= file_size
+
+    def delete_file(self, filepath, pid=None, pool=None):
         """A file is about to removed and thus should be dumped right away."""
         self.add_pid(filepath, pid)
-        self.dump_file(filepath)
+        self.dump_file(filepath, pool)
 
         # Remove the filepath from the files list.
-        self.files.pop(filepath.lower(), None)
-        self.files_orig.pop(filepath.lower(), None)
+        with self.lock:
+            self.files.pop(filepath.lower(), None)
+            self.files_orig.pop(filepath.lower(), None)
 
     def move_file(self, oldfilepath, newfilepath, pid=None):
         """A file will be moved - track this change."""
-        self.add_pid(oldfilepath, pid)
-        if oldfilepath.lower() in self.files:
-            # Replace the entry with the new filepath.
-            self.files[newfilepath.lower()] = \
-                self.files.pop(oldfilepath.lower(), [])
+        with self.lock:
+            self.add_pid(oldfilepath, pid)
+            if oldfilepath.lower() in self.files:
+                # Replace the entry with the new filepath.
+                self.files[newfilepath.lower()] = \
+                    self.files.pop(oldfilepath.lower(), [])
+                self.files_orig.pop(oldfilepath.lower(), None)
+                self.files_orig[newfilepath.lower()] = newfilepath
+
+    def dump_files(self, workers=UPLOAD_WORKERS, bandwidth=UPLOAD_BANDWIDTH,
+                   timeout=UPLOAD_TIMEOUT):
+        """Dump all pending files from a pool of upload workers."""
+        pool = UploadPool(workers, bandwidth, timeout)
+        try:
+            while True:
+                with self.lock:
+                    filepaths = self.files.keys()
 
-    def dump_files(self):
-        """Dump all pending files."""
-        while self.files:
-            self.delete_file(self.files.keys()[0])
+                if not filepaths:
+                    break
+
+                pool.map(lambda x: self.delete_file(x, pool=pool), filepaths)
+        finally:
+            pool.close()
 
 
 class ProcessList(object):
-    def __init__(self):
-        self.pids = []
-        self.pids_notrack = []
+    def __init__(self, activity):
+        self.activity = activity
+        self.pids = set()
+        self.pids_notrack = set()
+
+        # Protects the process identifiers. The condition is notified when a
+        # tracked process has been added or has terminated.
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.watcher = ProcessWatcher(self.terminated)
 
     def add_pid(self, pid, track=True):
         """Add a process identifier to the process list.
@@ -149,11 +306,19 @@ class ProcessList(object):
         Track determines whether the analyzer should be monitoring this
         process, i.e., whether Cuckoo should wait for this process to finish.
         """
-        if int(pid) not in self.pids and int(pid) not in self.pids_notrack:
-            if track:
-                self.pids.append(int(pid))
-            else:
-                self.pids_notrack.append(int(pid))
+        pid = int(pid)
+        with self.lock:
+            if pid in self.pids or pid in self.pids_notrack:
+                return
+
+            if not track:
+                self.pids_notrack.add(pid)
+                return
+
+            self.pids.add(pid)
+            self.watcher.watch(pid)
+            self.activity.add("processes")
+            self.changed.notify_all()
 
     def add_pids(self, pids):
         """Add one or more process identifiers to the process list."""
@@ -165,21 +330,46 @@ class ProcessList(object):
 
     def has_pid(self, pid, notrack=True):
         """Is this process identifier being tracked?"""
-        if int(pid) in self.pids:
-            return True
+        with self.lock:
+            if int(pid) in self.pids:
+                return True
 
-        if notrack and int(pid) in self.pids_notrack:
-            return True
+            if notrack and int(pid) in self.pids_notrack:
+                return True
 
         return False
 
     def remove_pid(self, pid):
         """Remove a process identifier from being tracked."""
-        if pid in self.pids:
-            self.pids.remove(pid)
+        with self.lock:
+            self.pids.discard(pid)
+            self.pids_notrack.discard(pid)
+            self.changed.notify_all()
+
+    def terminated(self, pid):
+        """Called by the process watcher when a tracked process has
+        terminated."""
+        with self.lock:
+            if pid in self.pids:
+                log.info("Process with pid %s has terminated", pid)
+                self.remove_pid(pid)
+
+    def tracked(self):
+        """Get the process identifiers of the tracked processes.
+        @return: list of pids.
+        """
+        with self.lock:
+            return list(self.pids)
 
-        if pid in self.pids_notrack:
-            self.pids_notrack.remove(pid)
+    def wait(self, timeout):
+        """Wait until none of the tracked processes are alive anymore.
+        @param timeout: maximum amount of seconds to wait.
+        @return: whether all tracked processes have terminated.
+        """
+        with self.lock:
+            if self.pids:
+                self.changed.wait(timeout)
+            return not self.pids
 
 
 class CommandPipeHandler(object):
@@ -223,9 +413,7 @@ class CommandPipeHandler(object):
                         "skipping it.")
             return
 
-        self.analyzer.process_lock.acquire()
         self.analyzer.process_list.add_pid(int(pid), track=int(track))
-        self.analyzer.process_lock.release()
 
         log.debug("Loaded monitor into process with pid %s", pid)
 
@@ -236,65 +424,61 @@ class CommandPipeHandler(object):
 
     def _inject_process(self, process_id, thread_id, mode):
         """Helper function for injecting the monitor into a process."""
-        # We acquire the process lock in order to prevent the analyzer to
-        # terminate the analysis while we are operating on the new process.
-        self.analyzer.process_lock.acquire()
-
-        # Set the current DLL to the default one provided at submission.
-        dll = self.analyzer.default_dll
-
-        if process_id in (self.analyzer.pid, self.analyzer.ppid):
-            if process_id not in self.ignore_list["pid"]:
-                log.warning("Received request to inject Cuckoo processes, "
-                            "skipping it.")
-                self.ignore_list["pid"].append(process_id)
-            self.analyzer.process_lock.release()
-            return
+        # We hold the process list lock while operating on the new process,
+        # so that other requests for the same process have to wait for us.
+        with self.analyzer.process_list.lock:
+            # Set the current DLL to the default one provided at submission.
+            dll = self.analyzer.default_dll
+
+            if process_id in (self.analyzer.pid, self.analyzer.ppid):
+                if process_id not in self.ignore_list["pid"]:
+                    log.warning("Received request to inject Cuckoo "
+                                "processes, skipping it.")
+                    self.ignore_list["pid"].append(process_id)
+                return
 
-        # We inject the process only if it's not being monitored already,
-        # otherwise we would generated polluted logs (if it wouldn't crash
-        # horribly to start with).
-        if self.analyzer.process_list.has_pid(process_id):
-            # This pid is already on the notrack list, move it to the
-            # list of tracked pids.
-            if not self.analyzer.process_list.has_pid(process_id, notrack=False):
-                log.debug("Received request to inject pid=%d. It was already "
-                          "on our notrack list, moving it to the track list.")
-
-                self.analyzer.process_list.remove_pid(process_id)
-                self.analyzer.process_list.add_pid(process_id)
-                self.ignore_list["pid"].append(process_id)
-            # Spit out an error once and just ignore it further on.
-            elif process_id not in self.ignore_list["pid"]:
-                log.debug("Received request to inject pid=%d, but we are "
-                          "already injected there.", process_id)
-                self.ignore_list["pid"].append(process_id)
-
-            # We're done operating on the processes list, release the lock.
-            self.analyzer.process_lock.release()
-            return
+            # We inject the process only if it's not being monitored already,
+            # otherwise we would generated polluted logs (if it wouldn't crash
+            # horribly to start with).
+            if self.analyzer.process_list.has_pid(process_id):
+                # This pid is already on the notrack list, move it to the
+                # list of tracked pids.
+                if not self.analyzer.process_list.has_pid(process_id,
+                                                          notrack=False):
+                    log.debug("Received request to inject pid=%d. It was "
+                              "already on our notrack list, moving it to the "
+                              "track list.", process_id)
+
+                    self.analyzer.process_list.remove_pid(process_id)
+                    self.analyzer.process_list.add_pid(process_id)
+                    self.ignore_list["pid"].append(process_id)
+                # Spit out an error once and just ignore it further on.
+                elif process_id not in self.ignore_list["pid"]:
+                    log.debug("Received request to inject pid=%d, but we are "
+                              "already injected there.", process_id)
+                    self.ignore_list["pid"].append(process_id)
+                return
+
+            # Open the process and inject the DLL. Hope it enjoys it.
+            proc = Process(pid=process_id, tid=thread_id)
 
-        # Open the process and inject the DLL. Hope it enjoys it.
-        proc = Process(pid=process_id, tid=thread_id)
+            filename = os.path.basename(proc.get_filepath())
 
-        filename = os.path.basename(proc.get_filepath())
+            if self.analyzer.files.is_protected_filename(filename):
+                return
 
-        if not self.analyzer.files.is_protected_filename(filename):
             # Add the new process ID to the list of monitored processes.
+            # Once we're done here the injection can do its thing.
             self.analyzer.process_list.add_pid(process_id)
 
-            # We're done operating on the processes list,
-            # release the lock. Let the injection do its thing.
-            self.analyzer.process_lock.release()
-
-            # If we have both pid and tid, then we can use APC to inject.
-            if process_id and thread_id:
-                proc.inject(dll, apc=True, mode="%s" % mode)
-            else:
-                proc.inject(dll, apc=False, mode="%s" % mode)
+        # If we have both pid and tid, then we can use APC to inject.
+        if process_id and thread_id:
+            proc.inject(dll, apc=True, mode="%s" % mode)
+        else:
+            proc.inject(dll, apc=False, mode="%s" % mode)
 
-            log.info("Injected into process with pid %s and name %r",
-                     proc.pid, filename)
+        log.info("Injected into process with pid %s and name %r",
+                 proc.pid, filename)
 
     def _handle_process(self, data):
         """Request for injection into a process."""
@@ -403,6 +587,8 @@ class CommandPipeHandler(object):
     def dispatch(self, data):
         response = "NOPE"
 
+        self.analyzer.activity.add("commands")
+
         if not data or ":" not in data:
             log.critical("Unknown command received from the monitor: %r",
                          data.strip())
@@ -444,13 +630,14 @@ class Analyzer(object):
         self.config = None
         self.target = None
         self.do_run = True
+        self.timeline = Timeline()
 
-        self.process_lock = threading.Lock()
         self.default_dll = None
         self.pid = os.getpid()
         self.ppid = Process(pid=self.pid).get_parent_pid()
-        self.files = Files()
-        self.process_list = ProcessList()
+        self.activity = Activity()
+        self.files = Files(self.activity)
+        self.process_list = ProcessList(self.activity)
         self.package = None
 
         self.reboot = []
@@ -485,6 +672,7 @@ class Analyzer(object):
 
         # Parse the analysis configuration file generated by the agent.
         self.config = Config(cfg="analysis.conf")
+        self.parse_numeric_options()
 
         # Pass the configuration through to the Process class.
         Process.set_config(self.config)
@@ -519,7 +707,8 @@ class Analyzer(object):
         # before they head off to the host machine.
         destination = self.config.ip, self.config.port
         self.log_pipe_server = PipeServer(
-            PipeForwarder, self.config.logpipe, destination=destination
+            PipeForwarder, self.config.logpipe, destination=destination,
+            activity=self.activity
         )
         self.log_pipe_server.daemon = True
         self.log_pipe_server.start()
@@ -549,6 +738,30 @@ class Analyzer(object):
         else:
             self.target = self.config.target
 
+    def parse_numeric_options(self):
+        """Check the numerical analysis options up front, rather than failing
+        once they're used, e.g., when dumping the files at the end of the
+        analysis. Malformed values are replaced by their defaults."""
+        options = self.config.options
+        for name, default, minimum in (
+                ("upload_workers", Files.UPLOAD_WORKERS, 1),
+                ("upload_bandwidth", Files.UPLOAD_BANDWIDTH, 0),
+                ("upload_timeout", Files.UPLOAD_TIMEOUT, 0),
+                ("idle_timeout", Activity.IDLE_TIMEOUT, 0),
+                ("idle_min_runtime", Activity.IDLE_MIN_RUNTIME, 0)):
+            try:
+                value = int(options.get(name, default))
+                if value < minimum:
+                    raise ValueError
+            except ValueError:
+                log.warning(
+                    "Invalid value %r for option %s, using %d instead.",
+                    options[name], name, default
+                )
+                value = default
+
+            options[name] = value
+
     def stop(self):
         """Allows an auxiliary module to stop the analysis."""
         self.do_run = False
@@ -559,18 +772,44 @@ class Analyzer(object):
         self.command_pipe.stop()
         self.log_pipe_server.stop()
 
+        # Stop watching the processes.
+        self.process_list.watcher.stop()
+
         # Dump all the notified files.
-        self.files.dump_files()
+        self.timeline.phase("file_dumps")
+        options = self.config.options
+        self.files.dump_files(
+            workers=options["upload_workers"],
+            bandwidth=options["upload_bandwidth"],
+            timeout=options["upload_timeout"]
+        )
+
+        self.timeline.phase("complete")
+
+        # Report how the bandwidth has been spent per upload class.
+        upload_stats.report()
+
+        # Report where the time went.
+        self.timeline.stop()
+        self.timeline.upload()
+
+        # Make sure the result server has received every uploaded file,
+        # resuming those uploads that have been interrupted.
+        unconfirmed.confirm()
 
         # Hell yeah.
         log.info("Analysis completed.")
 
+        # Make sure the queued log records reach the result server before
+        # the analysis is reported as completed.
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+
     def run(self):
         """Run analysis.
         @return: operation status.
         """
-        start = KERNEL32.GetTickCount()
-
+        self.timeline.phase("prepare")
         self.prepare()
         self.path = os.getcwd()
 
@@ -643,8 +882,7 @@ class Analyzer(object):
             self.target = self.package.move_curdir(self.target)
 
         # Initialize Auxiliary modules
-        aux_start = KERNEL32.GetTickCount()
-
+        self.timeline.phase("aux_import")
         Auxiliary()
         prefix = auxiliary.__name__ + "."
         for loader, name, ispkg in pkgutil.iter_modules(auxiliary.__path__, prefix):
@@ -659,6 +897,7 @@ class Analyzer(object):
                             "\"%s\": %s", name, e)
 
         # Walk through the available auxiliary modules.
+        self.timeline.phase("aux_start")
         aux_enabled, aux_avail = [], []
         for module in Auxiliary.__subclasses__():
             # Try to start the auxiliary module.
@@ -684,9 +923,6 @@ class Analyzer(object):
                           module.__name__)
                 aux_enabled.append(aux)
 
-        aux_end = KERNEL32.GetTickCount()
-        log.debug("Loaded auxiliary modules in {}s".format(str((aux_end - aux_start) / 1000)))
-
         # Forward the command pipe and logpipe names on to zer0m0n.
         zer0m0n.cmdpipe(self.config.pipe)
         zer0m0n.channel(self.config.logpipe)
@@ -696,13 +932,9 @@ class Analyzer(object):
 
         # Start analysis package. If for any reason, the execution of the
         # analysis package fails, we have to abort the analysis.
-        process_monitoring_start = KERNEL32.GetTickCount()
-
+        self.timeline.phase("package_start")
         pids = self.package.start(self.target)
 
-        process_monitoring_end = KERNEL32.GetTickCount()
-        log.debug("Monitored first process in {}s".format(str((process_monitoring_end - process_monitoring_start)/1000)))
-
         # If the analysis package returned a list of process identifiers, we
         # add them to the list of monitored processes and enable the process monitor.
         if pids:
@@ -723,10 +955,22 @@ class Analyzer(object):
             log.info("Enabled timeout enforce, running for the full timeout.")
             pid_check = False
 
-        end = KERNEL32.GetTickCount()
-        log.info("Initialized VM in {}s".format(str((end - start)/1000)))
+        # The analysis may end early once the analyzed processes have been
+        # idle for a while, unless the full timeout has been enforced.
+        options = self.config.options
+        idle_timeout = options["idle_timeout"] * 1000
+        idle_min_runtime = options["idle_min_runtime"] * 1000
 
-        end = KERNEL32.GetTickCount() + int(self.config.timeout) * 1000
+        if self.config.enforce_timeout:
+            idle_timeout = 0
+        elif idle_timeout:
+            log.info("Terminating the analysis after %ds without activity, "
+                     "once it has run for %ds.", idle_timeout / 1000,
+                     idle_min_runtime / 1000)
+
+        self.timeline.phase("main_loop")
+        started = KERNEL32.GetTickCount()
+        end = started + int(self.config.timeout) * 1000
 
         while self.do_run:
             now = KERNEL32.GetTickCount()
@@ -737,53 +981,54 @@ class Analyzer(object):
                 log.info("Analysis timeout hit, terminating analysis.")
                 break
 
-            # If the process lock is locked, it means that something is
-            # operating on the list of monitored processes. Therefore we
-            # cannot proceed with the checks until the lock is released.
-            if self.process_lock.locked():
+            # If the process monitor is enabled we wait for the monitored
+            # processes to terminate. The process watcher wakes us up as
+            # soon as the last one has, rather than at the next interval.
+            if pid_check:
+                if self.process_list.wait(min(end - now, 1000) / 1000.0):
+                    log.info("Process list is empty, "
+                             "terminating analysis.")
+                    break
+
+                # Update the list of monitored processes available to the
+                # analysis package. It could be used for internal
+                # operations within the module.
+                self.package.set_pids(self.process_list.tracked())
+            else:
+                # Zzz.
                 KERNEL32.Sleep(1000)
-                continue
+
+            if idle_timeout:
+                now = KERNEL32.GetTickCount()
+                idle = min(self.activity.idle(now), now - started)
+                if now - started >= idle_min_runtime and idle >= idle_timeout:
+                    log.info("No activity for %ds after running for %ds, "
+                             "terminating analysis (%s).", idle / 1000,
+                             (now - started) / 1000, self.activity.report())
+                    break
 
             try:
-                # If the process monitor is enabled we start checking whether
-                # the monitored processes are still alive.
-                if pid_check:
-                    for pid in self.process_list.pids:
-                        if not Process(pid=pid).is_alive():
-                            log.info("Process with pid %s has terminated", pid)
-                            self.process_list.remove_pid(pid)
-
-                    # If none of the monitored processes are still alive, we
-                    # can terminate the analysis.
-                    if not self.process_list.pids:
-                        log.info("Process list is empty, "
-                                 "terminating analysis.")
-                        break
-
-                    # Update the list of monitored processes available to the
-                    # analysis package. It could be used for internal
-                    # operations within the module.
-                    self.package.set_pids(self.process_list.pids)
+                # The analysis packages are provided with a function that
+                # is executed at every loop's iteration. If such function
+                # returns False, it means that it requested the analysis
+                # to be terminate.
+                if not self.package.check():
+                    log.info("The analysis package requested the "
+                             "termination of the analysis.")
+                    break
+
+            # If the check() function of the package raised some exception
+            # we don't care, we can still proceed with the analysis but we
+            # throw a warning.
+            except Exception as e:
+                log.warning("The package \"%s\" check function raised "
+                            "an exception: %s", package_name, e)
 
-                try:
-                    # The analysis packages are provided with a function that
-                    # is executed at every loop's iteration. If such function
-                    # returns False, it means that it requested the analysis
-                    # to be terminate.
-                    if not self.package.check():
-                        log.info("The analysis package requested the "
-                                 "termination of the analysis.")
-                        break
-
-                # If the check() function of the package raised some exception
-                # we don't care, we can still proceed with the analysis but we
-                # throw a warning.
-                except Exception as e:
-                    log.warning("The package \"%s\" check function raised "
-                                "an exception: %s", package_name, e)
-            finally:
-                # Zzz.
-                KERNEL32.Sleep(1000)
+        log.debug("Activity during the analysis: %s.", self.activity.report())
+        if self.activity.first is not None:
+            self.timeline.event(
+                "first_monitored_event", self.activity.first / 1000.0
+            )
 
         if not self.do_run:
             log.debug("The analyzer has been stopped on request by an "
@@ -792,6 +1037,7 @@ class Analyzer(object):
         # Create the shutdown mutex.
         KERNEL32.CreateMutexA(None, False, SHUTDOWN_MUTEX)
 
+        self.timeline.phase("package_finish")
         try:
             # Before shutting down the analysis, the package can perform some
             # final operations through the finish() function.
@@ -800,6 +1046,7 @@ class Analyzer(object):
             log.warning("The package \"%s\" finish function raised an "
                         "exception: %s", package_name, e)
 
+        self.timeline.phase("package_files")
         try:
             # Upload files the package created to package_files in the
             # results folder.
@@ -810,6 +1057,7 @@ class Analyzer(object):
                         "exception: %s", package_name, e)
 
         # Terminate the Auxiliary modules.
+        self.timeline.phase("aux_stop")
         for aux in aux_enabled:
             try:
                 aux.stop()
@@ -823,7 +1071,7 @@ class Analyzer(object):
             # Try to terminate remaining active processes.
             log.info("Terminating remaining processes before shutdown.")
 
-            for pid in self.process_list.pids:
+            for pid in self.process_list.tracked():
                 proc = Process(pid=pid)
                 if proc.is_alive():
                     try:
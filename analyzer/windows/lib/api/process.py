@@ -8,13 +8,17 @@ import logging
 import random
 import subprocess
 import tempfile
+import threading
 
 from ctypes import byref, c_ulong, create_string_buffer, c_int, sizeof
 from ctypes import c_uint, c_wchar_p, create_unicode_buffer
+from ctypes.wintypes import HANDLE
 
 from lib.common.constants import SHUTDOWN_MUTEX
 from lib.common.defines import KERNEL32, NTDLL, SYSTEM_INFO, STILL_ACTIVE
 from lib.common.defines import THREAD_ALL_ACCESS, PROCESS_ALL_ACCESS
+from lib.common.defines import SYNCHRONIZE, INFINITE, MAXIMUM_WAIT_OBJECTS
+from lib.common.defines import WAIT_OBJECT_0, WAIT_FAILED
 from lib.common.exceptions import CuckooError
 from lib.common.results import upload_to_host
 from lib.core.ioctl import zer0m0n
@@ -575,7 +579,7 @@ class Process(object):
         else:
             file_name = os.path.join("memory", "%s-%s.dmp" % (self.pid, idx))
 
-        upload_to_host(dump_path, file_name)
+        upload_to_host(dump_path, file_name, upload_class="memory")
         os.unlink(dump_path)
 
         log.info("Memory dump of process with pid %d completed", self.pid)
@@ -584,3 +588,101 @@ class Process(object):
     # The dump_memory_block functionality has been integrated with the
     # dump_memory function, this alias is just for backwards compatibility.
     dump_memory_block = dump_memory
+
+class ProcessWatcher(threading.Thread):
+    """Waits on the handles of the watched processes and reports each process
+    that has exited through a callback, so that nobody has to poll them."""
+
+    # Interval at which the processes that don't fit in a single wait are
+    # polled, as well as the interval used when waiting fails altogether.
+    POLL_INTERVAL = 1000
+
+    def __init__(self, callback):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.callback = callback
+        self.handles = {}
+        self.lock = threading.Lock()
+
+        # Handles are pointer-sized, the default return type (a C int)
+        # truncates them on 64-bit Windows.
+        KERNEL32.CreateEventA.restype = HANDLE
+        KERNEL32.OpenProcess.restype = HANDLE
+
+        self.event = HANDLE(KERNEL32.CreateEventA(None, False, False, None))
+        self.do_run = True
+
+    def watch(self, pid):
+        """Start watching a process. If the process can't be opened, it's
+        considered to have exited."""
+        with self.lock:
+            if not self.do_run or pid in self.handles:
+                return
+
+            self.handles[pid] = KERNEL32.OpenProcess(SYNCHRONIZE, False, pid)
+            if not self.is_alive():
+                self.start()
+
+        # Have the thread wait on the new handle as well.
+        KERNEL32.SetEvent(self.event)
+
+    def has_exited(self, handle):
+        return not handle or \
+            KERNEL32.WaitForSingleObject(HANDLE(handle), 0) == WAIT_OBJECT_0
+
+    def run(self):
+        # The return value is a DWORD, e.g., WAIT_FAILED is 0xffffffff.
+        KERNEL32.WaitForMultipleObjects.restype = c_uint
+
+        while self.do_run:
+            with self.lock:
+                handles = self.handles.items()
+
+            # Wait for any of the processes to exit or for the watched
+            # processes to change. A single wait is limited in the amount of
+            # handles, any remaining processes are polled.
+            waiting = [self.event] + [
+                handle for pid, handle in handles if handle
+            ]
+            if len(waiting) > MAXIMUM_WAIT_OBJECTS:
+                waiting, timeout = \
+                    waiting[:MAXIMUM_WAIT_OBJECTS], self.POLL_INTERVAL
+            else:
+                timeout = INFINITE
+
+            ret = KERNEL32.WaitForMultipleObjects(
+                len(waiting), (HANDLE * len(waiting))(*waiting),
+                False, timeout
+            )
+            if ret == WAIT_FAILED:
+                log.warning("Error waiting for processes to exit: %d",
+                            KERNEL32.GetLastError())
+                KERNEL32.Sleep(self.POLL_INTERVAL)
+
+            for pid, handle in handles:
+                if not self.has_exited(handle):
+                    continue
+
+                with self.lock:
+                    self.handles.pop(pid, None)
+
+                if handle:
+                    KERNEL32.CloseHandle(HANDLE(handle))
+
+                self.callback(pid)
+
+    def stop(self):
+        """Stop watching processes and close the handles."""
+        with self.lock:
+            self.do_run = False
+
+        KERNEL32.SetEvent(self.event)
+        if self.is_alive():
+            self.join()
+
+        for handle in self.handles.values():
+            if handle:
+                KERNEL32.CloseHandle(HANDLE(handle))
+
+        self.handles = {}
+        KERNEL32.CloseHandle(self.event)
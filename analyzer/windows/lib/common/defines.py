@@ -33,6 +33,7 @@ CREATE_SUSPENDED          = 0x00000004
 DBG_CONTINUE              = 0x00010002
 INFINITE                  = 0xFFFFFFFF
 PROCESS_ALL_ACCESS        = 0x001F0FFF
+SYNCHRONIZE               = 0x00100000
 THREAD_ALL_ACCESS         = 0x001f03ff
 TOKEN_ALL_ACCESS          = 0x000F01FF
 SE_PRIVILEGE_ENABLED      = 0x00000002
@@ -80,7 +81,10 @@ ERROR_BROKEN_PIPE         = 0x0000006d
 ERROR_MORE_DATA           = 0x000000EA
 ERROR_PIPE_CONNECTED      = 0x00000217
 
+WAIT_OBJECT_0             = 0x00000000
 WAIT_TIMEOUT              = 0x00000102
+WAIT_FAILED               = 0xFFFFFFFF
+MAXIMUM_WAIT_OBJECTS      = 64
 
 FILE_ATTRIBUTE_HIDDEN     = 0x00000002
 
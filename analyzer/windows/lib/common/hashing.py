@@ -3,6 +3,8 @@
 # This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
 # See the file 'docs/LICENSE' for copying permission.
 
+import os
+
 BUFSIZE = 1024*1024
 
 
@@ -12,11 +14,41 @@ def hash_file(method, path):
     @param path: file path
     @return: computed hash string
     """
-    f = open(path, "rb")
+    with open(path, "rb") as f:
+        return hash_fileobj(method, f)
+
+
+def hash_fileobj(method, f):
+    """Calculates an hash on a file object from its start, rewinding it
+    afterwards.
+    @param method: callable hashing method
+    @param f: file object
+    @return: computed hash string
+    """
+    f.seek(0)
     h = method()
     while True:
         buf = f.read(BUFSIZE)
         if not buf:
             break
         h.update(buf)
+    f.seek(0)
     return h.hexdigest()
+
+
+def hash_file_buffered(method, path, limit):
+    """Calculates an hash on a file by path, keeping its contents in memory
+    so that it doesn't have to be read again afterwards. Files larger than
+    limit bytes aren't read at all, these are to be hashed while uploading.
+    @param method: callable hashing method
+    @param path: file path
+    @param limit: maximum size in bytes of the file
+    @return: tuple of the computed hash string and the contents, or of None
+    and None if the file is larger than limit
+    """
+    if os.path.getsize(path) > limit:
+        return None, None
+
+    with open(path, "rb") as f:
+        data = f.read()
+    return method(data).hexdigest(), data
@@ -3,28 +3,188 @@
 # This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
 # See the file 'docs/LICENSE' for copying permission.
 
+import Queue
+import collections
+import hashlib
+import io
 import logging
+import math
+import os
 import socket
-import time
+import struct
 import sys
+import threading
+import time
+import zlib
 
+from multiprocessing.pool import ThreadPool
+
+from lib.common.hashing import hash_fileobj
 from lib.core.config import Config
 
 log = logging.getLogger(__name__)
 
 BUFSIZE = 1024*1024
 
-def upload_to_host(file_path, dump_path, pids=[]):
+# Files smaller than this aren't worth compressing.
+COMPRESS_MIN_SIZE = 16*1024
+
+# Fast compression level, the analyzer shares the CPU with the sample.
+COMPRESS_LEVEL = 1
+
+# Data with a higher entropy (bits per byte) is most likely compressed or
+# encrypted already.
+ENTROPY_THRESHOLD = 7.5
+
+ENTROPY_SAMPLES = 4
+ENTROPY_SAMPLE_SIZE = 4096
+
+# Upload classes in order of priority along with their weight in the fair
+# share of the bandwidth of a multiplexed connection.
+UPLOAD_CLASSES = (
+    ("logs", 16),
+    ("behavior", 8),
+    ("files", 4),
+    ("screenshots", 2),
+    ("memory", 1),
+)
+
+# Upload class of artifacts by their directory in the analysis folder.
+UPLOAD_CLASS_DIRS = {
+    "files": "files",
+    "package_files": "files",
+    "shots": "screenshots",
+    "memory": "memory",
+    "logs": "behavior",
+}
+
+# Number of attempts for resumable uploads and the amount of seconds to wait
+# for the result server to acknowledge.
+UPLOAD_ATTEMPTS = 3
+ACK_TIMEOUT = 60
+
+# Maximum number of uploads that have been sent completely, but of which the
+# result server has yet to confirm that it has received them.
+UNCONFIRMED_MAX = 64
+
+def entropy(data):
+    """Calculates the Shannon entropy of a string in bits per byte."""
+    ret = 0.0
+    for count in collections.Counter(data).values():
+        p = float(count) / len(data)
+        ret -= p * math.log(p, 2)
+    return ret
+
+def is_compressible(f):
+    """Guesses whether a file compresses well by calculating the entropy of
+    a couple of blocks sampled throughout the file."""
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size < COMPRESS_MIN_SIZE:
+        return False
+
+    step = size / ENTROPY_SAMPLES
+    sample = ""
+    for idx in xrange(ENTROPY_SAMPLES):
+        f.seek(idx * step)
+        sample += f.read(ENTROPY_SAMPLE_SIZE)
+    f.seek(0)
+
+    return entropy(sample) < ENTROPY_THRESHOLD
+
+class UploadStatistics(object):
+    """Keeps track of the streams, bytes and time spent sending per upload
+    class."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.classes = dict((name, {
+            "streams": 0,
+            "bytes": 0,
+            "duration": 0.0,
+        }) for name, _ in UPLOAD_CLASSES)
+
+    def add(self, upload_class, streams=0, length=0, duration=0):
+        with self.lock:
+            stats = self.classes[upload_class]
+            stats["streams"] += streams
+            stats["bytes"] += length
+            stats["duration"] += duration
+
+    def report(self):
+        """Logs the statistics of each upload class."""
+        total = sum(stats["bytes"] for stats in self.classes.values())
+        for name, _ in UPLOAD_CLASSES:
+            stats = self.classes[name]
+            log.info(
+                "Uploaded %d bytes (%.1f%%) of %s in %d streams, spent %.2fs "
+                "sending.", stats["bytes"],
+                100.0 * stats["bytes"] / total if total else 0, name,
+                stats["streams"], stats["duration"]
+            )
+
+upload_stats = UploadStatistics()
+
+def upload_class_of(dump_path):
+    """Determines the upload class of an artifact by its path."""
+    dirname = dump_path.replace("\\", "/").split("/")[0]
+    return UPLOAD_CLASS_DIRS.get(dirname, "files")
+
+def recvall(sock, length):
+    """Receives exactly length bytes from a socket."""
+    ret = ""
+    while len(ret) < length:
+        buf = sock.recv(length - len(ret))
+        if not buf:
+            raise socket.error("connection closed by the result server")
+        ret += buf
+    return ret
+
+def upload_to_host(file_path, dump_path, pids=[], ratelimit=None,
+                   timeout=None, upload_class=None, data=None, name=None):
+    """Uploads a file to the result server.
+    @param ratelimit: RateLimiter shared with other uploads.
+    @param timeout: maximum amount of seconds the upload may take.
+    @param upload_class: upload class, by default based on dump_path.
+    @param data: contents of the file if these have been read already.
+    @param name: callable that returns the final dump path given the sha256
+    hash of the file, or None to drop the file. dump_path is provisional in
+    that case, the file is named once it has been hashed while uploading.
+    @return: sha256 hash of the uploaded data or None on failure. The result
+    server may not have confirmed resumable uploads yet, see
+    UnconfirmedUploads.
+    """
     nc = infd = None
     try:
-        nc = NetlogFile()
-        nc.init(dump_path, file_path, pids)
+        if data is None:
+            infd = open(file_path, "rb")
+        else:
+            infd = io.BytesIO(data)
 
-        infd = open(file_path, "rb")
-        buf = infd.read(BUFSIZE)
-        while buf:
-            nc.send(buf, retry=False)
-            buf = infd.read(BUFSIZE)
+        nc = NetlogFile(
+            upload_class=upload_class or upload_class_of(dump_path)
+        )
+        nc.ratelimit = ratelimit
+        nc.timeout = timeout
+
+        # Without a result server that renames uploads, the file has to be
+        # hashed before it's uploaded.
+        if name and not nc.renames():
+            sha256 = hash_fileobj(hashlib.sha256, infd)
+            dump_path, name = name(sha256), None
+            if not dump_path:
+                return sha256
+
+        nc.init(
+            dump_path, file_path, pids, compress=is_compressible(infd),
+            name=name
+        )
+        sha256 = nc.upload(infd)
+
+        if nc.unconfirmed:
+            unconfirmed.add(nc, file_path)
+            nc = None
+        return sha256
     except Exception as e:
         log.error("Exception uploading file %r to host: %s", file_path, e)
     finally:
@@ -33,20 +193,522 @@ def upload_to_host(file_path, dump_path, pids=[]):
         if nc:
             nc.close()
 
+class UnconfirmedUploads(object):
+    """Resumable uploads that have been sent completely, but of which the
+    result server has yet to confirm that it has received them. Rather than
+    waiting for the final acknowledgement of every upload, which costs a
+    round trip per file, the next upload starts right away and the
+    acknowledgements are collected later on. Uploads that turn out to have
+    been interrupted are resumed from their file at that point."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.uploads = collections.deque()
+
+    def add(self, nc, file_path):
+        # The stream is closed, but keeps receiving acknowledgements.
+        nc.close()
+
+        with self.lock:
+            self.uploads.append((nc, file_path))
+            if len(self.uploads) <= UNCONFIRMED_MAX:
+                return
+            nc, file_path = self.uploads.popleft()
+
+        self.confirm_upload(nc, file_path)
+
+    def confirm_upload(self, nc, file_path):
+        """Waits for the result server to confirm an upload.
+        @return: whether the upload has been completed.
+        """
+        try:
+            try:
+                # The upload has been sent in time, it's only the result
+                # server that's left to answer.
+                nc.deadline = None
+                nc.confirm()
+            except socket.error as e:
+                log.warning(
+                    "Upload %s was interrupted: %s", nc.upload_id, e
+                )
+                with open(file_path, "rb") as f:
+                    nc.start()
+                    nc.resume(f)
+            return True
+        except Exception as e:
+            log.error("Exception uploading file %r to host: %s", file_path, e)
+            return False
+        finally:
+            nc.unconfirmed = False
+            nc.close()
+
+    def confirm(self):
+        """Waits for all outstanding uploads to be confirmed.
+        @return: whether all uploads have been completed.
+        """
+        ret = True
+        while True:
+            with self.lock:
+                if not self.uploads:
+                    return ret
+                nc, file_path = self.uploads.popleft()
+
+            ret = self.confirm_upload(nc, file_path) and ret
+
+unconfirmed = UnconfirmedUploads()
+
+class RateLimiter(object):
+    """Limits the combined throughput of all threads sharing it."""
+
+    def __init__(self, rate):
+        """@param rate: bytes per second."""
+        self.rate = float(rate)
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def consume(self, length):
+        """Waits until length bytes may be sent."""
+        with self.lock:
+            now = time.time()
+            start = max(self.next_time, now)
+            self.next_time = start + length / self.rate
+
+        if start > now:
+            time.sleep(start - now)
+
+class UploadPool(object):
+    """Uploads files from a bounded number of worker threads. The uploads
+    share one bandwidth limit and each one of them has to finish within the
+    timeout.
+
+    Every worker has a multiplexed connection of its own (see
+    NetlogMux.dedicate()). On the shared connection all uploads would go
+    through one sender thread and one queue per upload class, so the
+    workers would only be taking turns. These connections are kept when
+    the pool is closed, as the uploads on them may still have to be
+    confirmed."""
+
+    def __init__(self, workers, bandwidth=0, timeout=0):
+        """@param workers: number of worker threads.
+        @param bandwidth: bytes per second for all uploads, 0 for no limit.
+        @param timeout: maximum amount of seconds per upload, 0 for none.
+        """
+        self.ratelimit = RateLimiter(bandwidth) if bandwidth else None
+        self.timeout = timeout
+        self.pool = ThreadPool(workers, NetlogMux.dedicate)
+
+    def upload(self, file_path, dump_path, pids=[], data=None, name=None):
+        return upload_to_host(
+            file_path, dump_path, pids, self.ratelimit, self.timeout,
+            data=data, name=name
+        )
+
+    def map(self, fn, iterable):
+        """Calls fn for each item from the worker threads.
+        @return: list of results.
+        """
+        return self.pool.map(fn, iterable)
+
+    def close(self):
+        """Stops the worker threads."""
+        self.pool.close()
+        self.pool.join()
+
+class NetlogStream(object):
+    """Logical stream on a multiplexed netlog connection. Behaves like a
+    socket as far as NetlogConnection is concerned."""
+
+    def __init__(self, mux, stream_id, upload_class):
+        self.mux = mux
+        self.stream_id = stream_id
+        self.upload_class = upload_class
+        self.pending = 0
+        self.closed = False
+        self.acked = None
+        self.deadline = None
+        self.cond = threading.Condition()
+
+    def sendall(self, data):
+        if self.closed:
+            raise socket.error("netlog stream %d is closed" % self.stream_id)
+
+        self.mux.send(self, NetlogMux.DATA, data)
+
+    def ack(self, offset, status):
+        with self.cond:
+            self.acked = offset, status
+            self.cond.notify_all()
+
+    def wakeup(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def wait_ack(self, timeout, final=False):
+        """Waits for the result server to acknowledge the stream.
+        @param timeout: maximum amount of seconds to wait.
+        @param final: wait for the final status rather than any offset.
+        @return: tuple of acknowledged offset and upload status.
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            while True:
+                if self.acked and (
+                        not final or self.acked[1] != NetlogMux.PENDING):
+                    return self.acked
+
+                if not self.mux.sock:
+                    raise socket.error("netlog connection has been closed")
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.error("timeout waiting for the result server")
+
+                self.cond.wait(remaining)
+
+    def release(self):
+        """Stops handling acknowledgements for this stream."""
+        self.mux.streams.pop(self.stream_id, None)
+
+    def flush(self, timeout):
+        """Waits until all queued frames of this stream have been sent.
+        @param timeout: maximum amount of seconds to wait.
+        @return: whether all frames have been sent.
+        """
+        deadline = time.time() + timeout
+        with self.mux.cond:
+            while self.mux.sock and self.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.mux.cond.wait(remaining)
+        return not self.pending
+
+    def close(self, release=True):
+        """Closes the stream.
+        @param release: also stop handling its acknowledgements.
+        """
+        if release:
+            self.release()
+
+        if not self.closed:
+            self.closed = True
+            self.mux.send(self, NetlogMux.CLOSE)
+
+class NetlogMux(object):
+    """Carries many netlog streams over one persistent connection to the
+    result server rather than opening a new connection for each log stream
+    and uploaded file.
+
+    The connection is negotiated by sending the "MUX" protocol line, to which
+    a capable result server replies with a line starting with "OK" followed
+    by any features it supports, e.g., "compress" for the compressed file
+    upload protocol ("FILE 3") or "resume" for resumable uploads. From there
+    on all data is sent as frames, each consisting of a stream id, the frame
+    type, and the payload length, followed by the payload. Every stream
+    starts with an OPEN frame carrying the regular protocol header (e.g.,
+    "LOG\n" or "FILE 2\n...") and ends with a CLOSE frame. Only a CLOSE
+    frame ends a stream, an OPEN or DATA frame without payload doesn't. The
+    result server sends ACK frames, carrying the offset and status of an
+    upload, back for resumable uploads. A result server that doesn't
+    recognize the "MUX" protocol drops the connection, in which case we fall
+    back to the one connection per stream protocol.
+
+    Frames are queued per upload class and written by a sender thread that
+    shares the bandwidth between the classes by their weight, so that,
+    e.g., a memory dump can't starve the log stream."""
+
+    FRAME = struct.Struct("!IBI")
+    OPEN, DATA, CLOSE, ACK = 1, 2, 3, 4
+
+    ACK_INFO = struct.Struct("!QB")
+    PENDING, COMPLETE, FAILED = 0, 1, 2
+
+    # Split large writes so that log messages don't get stuck behind the
+    # upload of, e.g., a process memory dump.
+    FRAME_SIZE = 64*1024
+
+    # Maximum amount of bytes queued per upload class.
+    QUEUE_SIZE = 1024*1024
+
+    NEGOTIATE_TIMEOUT = 5
+
+    lock = threading.Lock()
+    instance = None
+    supported = None
+
+    # Multiplexed connections of the threads that have one of their own.
+    local = threading.local()
+
+    def __init__(self, hostip, hostport):
+        self.hostip, self.hostport = hostip, hostport
+        self.sock = None
+        self.features = []
+        self.next_id = 1
+        self.streams = {}
+
+        self.cond = threading.Condition()
+        self.queues = dict(
+            (name, collections.deque()) for name, _ in UPLOAD_CLASSES
+        )
+        self.queued = dict((name, 0) for name, _ in UPLOAD_CLASSES)
+        self.passes = dict((name, 0.0) for name, _ in UPLOAD_CLASSES)
+        self.vtime = 0.0
+
+    @classmethod
+    def get(cls, hostip, hostport, attempts=None):
+        """Returns the shared multiplexed connection or None if the result
+        server doesn't support it.
+        @param attempts: connection attempts before giving up with a
+        socket.error, by default it's tried until the result server is up.
+        """
+        with cls.lock:
+            if cls.supported is False:
+                return None
+
+            if cls.instance and not cls.instance.sock:
+                cls.instance = None
+
+            if not cls.instance:
+                mux = cls(hostip, hostport)
+                cls.supported = mux.negotiate(attempts)
+                if cls.supported:
+                    cls.instance = mux
+
+            shared = cls.instance
+
+        if not getattr(cls.local, "dedicated", False):
+            return shared
+
+        mux = getattr(cls.local, "mux", None)
+        if not mux or not mux.sock:
+            mux = cls(hostip, hostport)
+            if not mux.negotiate(attempts):
+                return shared
+            cls.local.mux = mux
+        return mux
+
+    @classmethod
+    def dedicate(cls):
+        """Gives the calling thread a multiplexed connection of its own from
+        now on. The uploads of such a thread don't share the sender thread,
+        queues, and TCP connection with those of other threads, but neither
+        are they scheduled by their upload class against them."""
+        cls.local.dedicated = True
+
+    def negotiate(self, attempts=None):
+        attempt = 0
+        while True:
+            try:
+                s = socket.create_connection(
+                    (self.hostip, self.hostport), 0.1
+                )
+            except socket.error:
+                attempt += 1
+                if attempts and attempt >= attempts:
+                    raise
+                time.sleep(0.1)
+                continue
+            break
+
+        try:
+            s.settimeout(self.NEGOTIATE_TIMEOUT)
+            s.sendall("MUX\n")
+
+            reply = ""
+            while not reply.endswith("\n") and len(reply) < 1024:
+                buf = s.recv(1)
+                if not buf:
+                    break
+                reply += buf
+        except socket.error:
+            reply = ""
+
+        if not reply.startswith("OK"):
+            s.close()
+            return False
+
+        # Frames are small and acknowledgements are waited upon, so don't
+        # let Nagle's algorithm hold them back.
+        s.settimeout(None)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = s
+        self.features = reply.split()[1:]
+
+        for target in (self.receive, self.transmit):
+            t = threading.Thread(target=target, args=(s,))
+            t.daemon = True
+            t.start()
+        return True
+
+    def receive(self, sock):
+        """Handles the frames sent back by the result server."""
+        try:
+            while True:
+                header = recvall(sock, self.FRAME.size)
+                stream_id, frame_type, length = self.FRAME.unpack(header)
+                data = recvall(sock, length)
+
+                stream = self.streams.get(stream_id)
+                if stream and frame_type == self.ACK:
+                    stream.ack(*self.ACK_INFO.unpack(data))
+        except socket.error:
+            pass
+
+        self.close()
+
+    def open(self, proto, upload_class):
+        with self.cond:
+            stream_id = self.next_id
+            self.next_id += 1
+
+        stream = NetlogStream(self, stream_id, upload_class)
+        self.streams[stream_id] = stream
+        self.send(stream, self.OPEN, proto)
+        return stream
+
+    def send(self, stream, frame_type, data=""):
+        """Queues data as one or more frames of a stream. Waiting for room
+        in the queue gives up once the deadline of the stream has passed.
+        OPEN and CLOSE frames are tiny and always queued right away, so that
+        a stream can be closed even if the connection has stalled."""
+        name = stream.upload_class
+        offset = 0
+        while True:
+            chunk = data[offset:offset+self.FRAME_SIZE]
+            frame = self.FRAME.pack(
+                stream.stream_id, frame_type, len(chunk)
+            ) + chunk
+
+            with self.cond:
+                while frame_type == self.DATA and self.sock and \
+                        self.queued[name] >= self.QUEUE_SIZE:
+                    if not stream.deadline:
+                        self.cond.wait()
+                        continue
+
+                    remaining = stream.deadline - time.time()
+                    if remaining <= 0:
+                        raise IOError("upload timed out")
+                    self.cond.wait(remaining)
+
+                if not self.sock:
+                    raise socket.error("netlog connection has been closed")
+
+                # A class that becomes active doesn't get to make up for the
+                # time it has been idle.
+                if not self.queues[name]:
+                    self.passes[name] = max(self.passes[name], self.vtime)
+
+                self.queues[name].append((stream, frame))
+                self.queued[name] += len(frame)
+                stream.pending += 1
+                self.cond.notify_all()
+
+            offset += len(chunk)
+            if offset >= len(data):
+                break
+
+            # A long protocol header continues in DATA frames.
+            frame_type = self.DATA
+
+    def next_frame(self):
+        """Picks the next frame to send, i.e., from the upload class that
+        has had the least bandwidth relative to its weight. Ties go to the
+        class with the highest priority."""
+        name, weight = min(
+            ((name, weight) for name, weight in UPLOAD_CLASSES
+             if self.queues[name]),
+            key=lambda x: self.passes[x[0]]
+        )
+
+        stream, frame = self.queues[name].popleft()
+        self.queued[name] -= len(frame)
+        self.vtime = self.passes[name]
+        self.passes[name] += float(len(frame)) / weight
+        return stream, frame
+
+    def transmit(self, sock):
+        """Sends the queued frames."""
+        try:
+            while True:
+                with self.cond:
+                    while self.sock and not any(self.queues.values()):
+                        self.cond.wait()
+
+                    if not self.sock:
+                        break
+
+                    stream, frame = self.next_frame()
+                    self.cond.notify_all()
+
+                sock.sendall(frame)
+
+                with self.cond:
+                    stream.pending -= 1
+                    self.cond.notify_all()
+        except socket.error:
+            pass
+
+        self.close()
+
+    def close(self):
+        with self.cond:
+            if self.sock:
+                try:
+                    self.sock.close()
+                except socket.error:
+                    pass
+                self.sock = None
+
+            for name in self.queues:
+                for stream, _ in self.queues[name]:
+                    stream.pending -= 1
+                self.queues[name].clear()
+                self.queued[name] = 0
+            self.cond.notify_all()
+
+        # Wake up anyone waiting for an acknowledgement.
+        for stream in self.streams.values():
+            stream.wakeup()
+
 class NetlogConnection(object):
-    def __init__(self, proto=""):
-        config = Config(cfg="analysis.conf")
-        self.hostip, self.hostport = config.ip, config.port
+    def __init__(self, proto="", upload_class="files"):
+        config = Config.load("analysis.conf")
+        self.hostip, self.hostport = config["ip"], config["port"]
         self.sock = None
         self.proto = proto
+        self.upload_class = upload_class
+
+    def connect(self, attempts=None):
+        """Connects to the result server.
+        @param attempts: connection attempts before giving up with a
+        socket.error, by default it's tried until the result server is up.
+        """
+        upload_stats.add(self.upload_class, streams=1)
+
+        # Prefer a stream on the shared connection, if the result server
+        # supports it.
+        attempt = 0
+        mux = NetlogMux.get(self.hostip, self.hostport, attempts)
+        while mux:
+            try:
+                self.sock = mux.open(self.proto, self.upload_class)
+                return
+            except socket.error:
+                attempt += 1
+                if attempts and attempt >= attempts:
+                    raise
+                mux = NetlogMux.get(self.hostip, self.hostport, attempts)
 
-    def connect(self):
         # Try to connect as quickly as possible. Just sort of force it to
         # connect with a short timeout.
         while not self.sock:
             try:
                 s = socket.create_connection((self.hostip, self.hostport), 0.1)
             except socket.error:
+                attempt += 1
+                if attempts and attempt >= attempts:
+                    raise
                 time.sleep(0.1)
                 continue
 
@@ -55,15 +717,32 @@ class NetlogConnection(object):
 
             self.sock = s
 
+    def reconnect(self):
+        """Replaces the connection. The old one is closed first, so that the
+        result server finishes off its end of it rather than, e.g., keeping
+        an interrupted upload locked."""
+        NetlogConnection.close(self)
+        self.sock = None
+        self.connect()
+
+    def sendall(self, data):
+        """Sends data and accounts for it in the upload statistics."""
+        start = time.time()
+        self.sock.sendall(data)
+        upload_stats.add(
+            self.upload_class, length=len(data),
+            duration=time.time() - start
+        )
+
     def send(self, data, retry=True):
         if not self.sock:
             self.connect()
 
         try:
-            self.sock.sendall(data)
+            self.sendall(data)
         except socket.error as e:
             if retry:
-                self.connect()
+                self.reconnect()
                 self.send(data, retry=False)
             else:
                 print >>sys.stderr, "Unhandled exception in NetlogConnection:", str(e)
@@ -81,8 +760,77 @@ class NetlogConnection(object):
             pass
 
 class NetlogFile(NetlogConnection):
-    def init(self, dump_path, filepath=None, pids=[]):
-        if filepath:
+    """Uploads a file to the result server.
+
+    Resumable uploads, used when the result server advertises them, send the
+    file as a series of records: chunks that carry their offset in the file,
+    and a trailer that carries the total length and sha256 hash of the file.
+    The result server acknowledges each record, so an interrupted upload is
+    resumed from the last acknowledged offset after reconnecting with the
+    same upload id. Incomplete uploads are kept apart by the result server
+    until a matching trailer has been received.
+
+    A fresh upload doesn't wait for the result server at all: it starts at
+    offset zero and its final acknowledgement is collected later on (see
+    UnconfirmedUploads). Only resuming an upload requires asking the result
+    server for the offset to continue from.
+
+    A result server that advertises renaming accepts a name record right
+    before the trailer, so that a file can be named after its hash without
+    reading it twice. The name is the final dump path of the file, an empty
+    one drops the file once it has been verified."""
+
+    RECORD = struct.Struct("!BQI")
+    CHUNK, TRAILER, NAME = 1, 2, 3
+
+    compressor = None
+    encoding = None
+    upload_id = None
+    name = None
+    dump_name = None
+    ratelimit = None
+    timeout = None
+    deadline = None
+    unconfirmed = False
+
+    def renames(self):
+        """Returns whether the result server can name uploads afterwards."""
+        mux = NetlogMux.get(self.hostip, self.hostport)
+        features = mux.features if mux else []
+        return "resume" in features and "rename" in features
+
+    def init(self, dump_path, filepath=None, pids=[], compress=False,
+             name=None):
+        # The compressed and resumable upload protocols are only available on
+        # multiplexed connections to a result server that advertises them.
+        mux = NetlogMux.get(self.hostip, self.hostport)
+        features = mux.features if mux else []
+
+        options = []
+        if "resume" in features:
+            self.upload_id = os.urandom(8).encode("hex")
+            options.append("upload=%s" % self.upload_id)
+
+            # Provisional dump paths have to be unique, as the result server
+            # keeps incomplete uploads next to them.
+            if name and "rename" in features:
+                self.name = name
+                dump_path = "%s.%s" % (dump_path, self.upload_id)
+
+        if compress and "compress" in features:
+            self.encoding = "zlib"
+            options.append("encoding=zlib")
+
+            # Chunks of resumable uploads are compressed individually.
+            if not self.upload_id:
+                self.compressor = zlib.compressobj(COMPRESS_LEVEL)
+
+        if options:
+            self.proto = "FILE 3\n%s\n%s\n%s\n%s\n" % (
+                dump_path.encode("utf8"), (filepath or "").encode("utf8"),
+                " ".join(pids), " ".join(options)
+            )
+        elif filepath:
             self.proto = "FILE 2\n%s\n%s\n%s\n" % (
                 dump_path.encode("utf8"), filepath.encode("utf8"),
                 " ".join(pids)
@@ -92,12 +840,249 @@ class NetlogFile(NetlogConnection):
 
         self.connect()
 
+    def start(self):
+        """Starts the clock on the upload timeout, if any."""
+        self.deadline = time.time() + self.timeout if self.timeout else None
+
+    def upload(self, f):
+        """Uploads the contents of a file object, hashing it along the way.
+        @return: sha256 hash of the uploaded data.
+        """
+        self.start()
+        if not self.upload_id:
+            sha256 = hashlib.sha256()
+            buf = f.read(BUFSIZE)
+            while buf:
+                sha256.update(buf)
+                self.throttle(len(buf))
+                self.write(buf)
+                buf = f.read(BUFSIZE)
+
+            # Like the data itself, the end of the compressed stream has to
+            # reach the result server for the upload to be complete.
+            if self.compressor:
+                data, self.compressor = self.compressor.flush(), None
+                self.sendall(data)
+            return sha256.hexdigest()
+
+        try:
+            sha256 = self.upload_records(f)
+            self.unconfirmed = True
+            return sha256
+        except socket.error as e:
+            log.warning("Upload %s was interrupted: %s", self.upload_id, e)
+
+        return self.resume(f)
+
+    def resume(self, f):
+        """Resumes an interrupted upload from the offset that the result
+        server has acknowledged and waits for it to be confirmed.
+        @return: sha256 hash of the uploaded data.
+        """
+        self.unconfirmed = False
+        for attempt in xrange(UPLOAD_ATTEMPTS):
+            self.reconnect()
+
+            try:
+                offset, status = self.sock.wait_ack(self.ack_timeout())
+                if status == NetlogMux.FAILED:
+                    break
+
+                sha256 = self.upload_records(f, offset, status)
+                if status == NetlogMux.PENDING:
+                    self.confirm()
+                return sha256
+            except socket.error as e:
+                log.warning("Upload %s was interrupted: %s", self.upload_id, e)
+        else:
+            raise IOError("giving up after %d attempts" % UPLOAD_ATTEMPTS)
+
+        raise IOError("upload has been rejected by the result server")
+
+    def upload_records(self, f, offset=0, status=NetlogMux.PENDING):
+        """Sends the file as records, starting at the given offset.
+        @return: sha256 hash of the uploaded data.
+        """
+        # Hash the part that the result server already has.
+        sha256 = hashlib.sha256()
+        f.seek(0)
+        while f.tell() < offset:
+            buf = f.read(min(BUFSIZE, offset - f.tell()))
+            if not buf:
+                raise IOError("file has been truncated during the upload")
+            sha256.update(buf)
+
+        if status == NetlogMux.COMPLETE:
+            return sha256.hexdigest()
+
+        buf = f.read(BUFSIZE)
+        while buf:
+            sha256.update(buf)
+            self.throttle(len(buf))
+            if self.encoding:
+                data = zlib.compress(buf, COMPRESS_LEVEL)
+            else:
+                data = buf
+
+            self.sendall(
+                self.RECORD.pack(self.CHUNK, offset, len(data)) + data
+            )
+            offset += len(buf)
+            buf = f.read(BUFSIZE)
+
+        # The name is decided only once, a resumed upload sends it again.
+        if self.name:
+            if self.dump_name is None:
+                self.dump_name = self.name(sha256.hexdigest()) or ""
+
+            name = self.dump_name.encode("utf8")
+            self.sendall(self.RECORD.pack(self.NAME, offset, len(name)) + name)
+
+        digest = sha256.digest()
+        self.sendall(
+            self.RECORD.pack(self.TRAILER, offset, len(digest)) + digest
+        )
+        return sha256.hexdigest()
+
+    def confirm(self):
+        """Waits for the final acknowledgement of the upload."""
+        offset, status = self.sock.wait_ack(self.ack_timeout(), final=True)
+        if status != NetlogMux.COMPLETE:
+            raise IOError("upload has been rejected by the result server")
+
+    def throttle(self, length):
+        """Applies the bandwidth limit and the upload timeout."""
+        if self.ratelimit:
+            self.ratelimit.consume(length)
+
+        self.remaining()
+
+    def remaining(self):
+        """Returns the amount of seconds left until the upload times out, if
+        there's a timeout at all."""
+        if not self.deadline:
+            return
+
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise IOError("upload timed out")
+        return remaining
+
+    def ack_timeout(self):
+        return min(ACK_TIMEOUT, self.remaining() or ACK_TIMEOUT)
+
+    def sendall(self, data):
+        # Streams apply the deadline while waiting for room to queue the
+        # data, regular sockets get a timeout instead.
+        remaining = self.remaining()
+        if isinstance(self.sock, NetlogStream):
+            self.sock.deadline = self.deadline
+        elif remaining:
+            self.sock.settimeout(remaining)
+
+        NetlogConnection.sendall(self, data)
+
+    def write(self, data):
+        """Sends data, compressing it if requested. Unlike send(), errors
+        (including timeouts) are raised, as the upload is incomplete."""
+        if self.compressor:
+            data = self.compressor.compress(data)
+            if not data:
+                return
+
+        if not self.sock:
+            self.connect()
+        self.sendall(data)
+
+    def close(self):
+        # The final acknowledgement of the upload is still to come.
+        if self.unconfirmed:
+            try:
+                self.sock.close(release=False)
+            except socket.error:
+                pass
+            return
+
+        NetlogConnection.close(self)
+
 class NetlogHandler(logging.Handler, NetlogConnection):
+    """Sends log records to the result server from a background thread.
+
+    Records are queued by emit() and written in batches by the sender thread
+    so that threads that log, e.g., the pipe handlers, never wait on the
+    network. When the queue is full new records are dropped and counted, and
+    a notice with the number of dropped records is sent once there's room
+    again."""
+
+    QUEUE_SIZE = 4096
+    BATCH_SIZE = 64*1024
+    FLUSH_TIMEOUT = 10
+
     def __init__(self):
         logging.Handler.__init__(self)
-        NetlogConnection.__init__(self, proto="LOG\n")
+        NetlogConnection.__init__(self, proto="LOG\n", upload_class="logs")
+        self.queue = Queue.Queue(self.QUEUE_SIZE)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
         self.connect()
 
+        self.sender = threading.Thread(target=self.run)
+        self.sender.daemon = True
+        self.sender.start()
+
     def emit(self, record):
-        msg = self.format(record)
-        self.send("{0}\n".format(msg))
+        try:
+            self.queue.put_nowait("%s\n" % self.format(record))
+        except Queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            length = len(batch[0])
+            while length < self.BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+                length += len(batch[-1])
+
+            records = len(batch)
+            with self.dropped_lock:
+                dropped, self.dropped = self.dropped, 0
+
+            if dropped:
+                batch.append("%s\n" % self.format(logging.makeLogRecord({
+                    "name": __name__,
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": "Dropped %d log records, log queue was full.",
+                    "args": (dropped,),
+                })))
+
+            try:
+                self.send("".join(batch))
+            except Exception as e:
+                print >>sys.stderr, "Error sending log records:", str(e)
+
+            for _ in xrange(records):
+                self.queue.task_done()
+
+    def flush(self):
+        """Waits, for at most FLUSH_TIMEOUT seconds, until all queued log
+        records have been sent. Called by Analyzer.complete() and on exit.
+        @return: whether all records have been sent.
+        """
+        deadline = time.time() + self.FLUSH_TIMEOUT
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+
+        # The records may still be queued on the multiplexed connection.
+        if isinstance(self.sock, NetlogStream):
+            return self.sock.flush(max(deadline - time.time(), 0))
+        return True
@@ -4,19 +4,67 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import ConfigParser
+import os
+import threading
 
 class Config:
+    # Parsed configuration files by path, along with the modification time
+    # and size they were parsed at. Every netlog connection, i.e., each
+    # uploaded file and behavior stream, loads the configuration for the
+    # address of the result server, so it's only parsed again if it has
+    # changed.
+    cache = {}
+    lock = threading.Lock()
+
     def __init__(self, cfg):
         """@param cfg: configuration file."""
+        for name, value in self.load(cfg).items():
+            # The options may be updated by the analyzer.
+            if isinstance(value, dict):
+                value = dict(value)
+            setattr(self, name, value)
+
+        # Just make sure the options field is available.
+        if not hasattr(self, "options"):
+            self.options = {}
+
+    @classmethod
+    def load(cls, cfg):
+        """Get the values of a configuration file.
+        @param cfg: configuration file.
+        @return: dict of values, which is shared and should not be modified.
+        """
+        path = os.path.abspath(cfg)
+        try:
+            st = os.stat(path)
+            stamp = st.st_mtime, st.st_size
+        except OSError:
+            stamp = None
+
+        with cls.lock:
+            if path in cls.cache and cls.cache[path][0] == stamp:
+                return cls.cache[path][1]
+
+            values = cls.parse(path)
+            cls.cache[path] = stamp, values
+            return values
+
+    @classmethod
+    def parse(cls, cfg):
+        """Parse a configuration file.
+        @param cfg: configuration file.
+        @return: dict of values.
+        """
         config = ConfigParser.ConfigParser(allow_no_value=True)
         config.read(cfg)
 
+        ret = {}
         for section in config.sections():
             for name, raw_value in config.items(section):
                 if name == "file_name":
                     value = config.get(section, name).decode("utf8")
                 elif name == "options":
-                    value = self.parse_options(config.get(section, name))
+                    value = cls.parse_options(config.get(section, name))
                 else:
                     try:
                         value = config.getboolean(section, name)
@@ -25,13 +73,11 @@ class Config:
                             value = config.getint(section, name)
                         except ValueError:
                             value = config.get(section, name)
-                setattr(self, name, value)
-
-        # Just make sure the options field is available.
-        if not hasattr(self, "options"):
-            self.options = {}
+                ret[name] = value
+        return ret
 
-    def parse_options(self, options):
+    @staticmethod
+    def parse_options(options):
         """Get analysis options.
         @return: options dict.
         """
@@ -15,6 +15,7 @@ from lib.common.defines import PIPE_UNLIMITED_INSTANCES, INVALID_HANDLE_VALUE
 from lib.common.defines import FILE_FLAG_WRITE_THROUGH, PIPE_READMODE_BYTE
 from lib.common.defines import ERROR_BROKEN_PIPE, PIPE_TYPE_MESSAGE
 from lib.common.defines import PIPE_ACCESS_DUPLEX, PIPE_READMODE_MESSAGE
+from lib.common.results import NetlogConnection
 
 log = logging.getLogger(__name__)
 
@@ -22,14 +23,39 @@ BUFSIZE = 0x10000
 
 class PipeForwarder(threading.Thread):
     """The Pipe Forwarder forwards all data received from a local pipe to
-    the Cuckoo server through a socket."""
+    the Cuckoo server through a netlog connection of the behavior upload
+    class.
+
+    Like any other netlog connection, the behavior streams are carried by
+    the shared multiplexed connection when the result server supports it.
+    That way they get their share of the bandwidth ahead of dropped files
+    and memory dumps. The flip side is that losing the shared connection
+    ends the behavior stream of every process at once. A behavior stream
+    can't be resumed, as the monitor only sends its protocol header at the
+    start, so this is accepted: the usual cause, the result server going
+    away, ends separate connections just the same."""
     sockets = {}
     active = {}
 
-    def __init__(self, pipe_handle, destination):
+    # Connection attempts, a tenth of a second apart, before giving up on a
+    # stream.
+    CONNECT_ATTEMPTS = 25
+
+    def __init__(self, pipe_handle, destination, activity=None):
         threading.Thread.__init__(self)
         self.pipe_handle = pipe_handle
         self.destination = destination
+        self.activity = activity
+
+    def connect(self, header):
+        """Opens the behavior stream of a process.
+        @param header: first data read from the pipe, which starts with the
+        protocol header (e.g., "BSON\n") as the monitor sends it itself.
+        """
+        conn = NetlogConnection(proto=header, upload_class="behavior")
+        conn.hostip, conn.hostport = self.destination
+        conn.connect(self.CONNECT_ATTEMPTS)
+        return conn
 
     def run(self):
         buf = create_string_buffer(BUFSIZE)
@@ -62,16 +88,11 @@ class PipeForwarder(threading.Thread):
             KERNEL32.CloseHandle(self.pipe_handle)
             return
 
+        # The stream is opened once the monitor has sent its protocol
+        # header, which then goes along with the OPEN frame.
+        sock = self.sockets.get(pid.value) if pid.value else None
         if pid.value:
-            if pid.value not in self.sockets:
-                self.sockets[pid.value] = (
-                    socket.create_connection(self.destination)
-                )
-
-            sock = self.sockets[pid.value]
             self.active[pid.value] = True
-        else:
-            sock = socket.create_connection(self.destination)
 
         while True:
             success = KERNEL32.ReadFile(
@@ -84,7 +105,23 @@ class PipeForwarder(threading.Thread):
             #log.error(buf[:bytes_read.value])
             if success or KERNEL32.GetLastError() == ERROR_MORE_DATA:
                 #log.info("Sending data")
-                sock.sendall(buf.raw[:bytes_read.value])
+                if sock:
+                    sock.sendall(buf.raw[:bytes_read.value])
+                elif bytes_read.value:
+                    try:
+                        sock = self.connect(buf.raw[:bytes_read.value])
+                    except socket.error as e:
+                        log.warning(
+                            "Unable to connect to the result server for the "
+                            "log pipe of process %d: %s", pid.value, e
+                        )
+                        KERNEL32.CloseHandle(self.pipe_handle)
+                        break
+
+                    if pid.value:
+                        self.sockets[pid.value] = sock
+                if self.activity:
+                    self.activity.add("bytes", bytes_read.value)
             # If we get the broken pipe error then this pipe connection has
             # been terminated for one reason or another. So break from the
             # loop and make the socket "inactive", that is, another pipe
@@ -0,0 +1,503 @@
+# Copyright (C) 2017 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+"""Benchmarks of the analyzer upload paths.
+
+Every benchmark drives one of the guest upload paths against the stand-in
+result server (see resultserver.py) on loopback. As the analyzer of each
+platform has its own "lib" package, every benchmark runs in a Python process
+of its own. Run all benchmarks or just a couple of them, e.g.:
+
+    $ python netlogbench.py
+    $ python netlogbench.py dump_pool windows_upload
+
+The results may be saved and compared against later on, in which case the
+script exits with a non-zero status if any of the benchmarks has become
+slower than the tolerance allows:
+
+    $ python netlogbench.py --save baseline.json
+    $ python netlogbench.py --compare baseline.json --tolerance 0.25
+
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import resultserver
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+BENCHMARKS = {}
+
+# Number of small files and log records used by the latency benchmarks.
+SMALL_FILES = 100
+LOG_RECORDS = 10000
+
+def benchmark(platform, multiplex=True):
+    """Registers a benchmark function for the analyzer of a platform. The
+    function is called with the stand-in result server, the analyzer's
+    working directory and the amount of data to upload and returns a list
+    of results."""
+    def register(fn):
+        BENCHMARKS[fn.__name__] = platform, multiplex, fn
+        return fn
+    return register
+
+def create_files(dirpath, count, size, prefix="file"):
+    """Creates files with somewhat compressible contents."""
+    ret = []
+    for idx in xrange(count):
+        filepath = os.path.join(dirpath, "%s%d.bin" % (prefix, idx))
+        with open(filepath, "wb") as f:
+            for offset in xrange(0, size, 65536):
+                buf = os.urandom(16384) + "\x00" * 49152
+                f.write(buf[:size - offset])
+        ret.append(filepath)
+    return ret
+
+def result(name, length, duration, **kwargs):
+    kwargs.update({
+        "name": name,
+        "bytes": length,
+        "duration": duration,
+    })
+    return kwargs
+
+def measure(server, name, length, fn, *args, **kwargs):
+    """Runs fn and returns its duration along with the amount of connections
+    made to the result server in the meantime."""
+    connections = server.stats.connections
+    start = time.time()
+    fn(*args, **kwargs)
+    return result(
+        name, length, time.time() - start,
+        connections=server.stats.connections - connections
+    )
+
+def upload_files(server, workdir, size, upload_to_host, confirm=None,
+                 **kwargs):
+    """Uploads one large file and a number of small ones. If uploads are
+    confirmed by the result server later on, they're only done once they
+    have been confirmed."""
+    filepath, = create_files(workdir, 1, size, "large")
+    filepaths = create_files(workdir, SMALL_FILES, 4096, "small")
+
+    def upload_large():
+        upload_to_host(filepath, "files/large.bin", **kwargs)
+        if confirm:
+            assert confirm()
+
+    def upload_small():
+        for filepath in filepaths:
+            dump_path = "files/%s" % os.path.basename(filepath)
+            upload_to_host(filepath, dump_path, **kwargs)
+        if confirm:
+            assert confirm()
+
+    return [
+        measure(server, "large file", size, upload_large),
+        measure(server, "%d small files" % SMALL_FILES, SMALL_FILES * 4096,
+                upload_small),
+    ]
+
+def log_records(server, handler):
+    """Sends log records through a NetlogHandler."""
+    record = logging.makeLogRecord({"msg": "A log record of some length."})
+
+    def emit():
+        for _ in xrange(LOG_RECORDS):
+            handler.emit(record)
+        handler.flush()
+
+    return [
+        measure(server, "%d log records" % LOG_RECORDS, 0, emit),
+    ]
+
+def load_config(server, Config):
+    """Loads the analysis configuration the way every upload does."""
+    # A configuration as written by the Cuckoo host.
+    with open("analysis.conf", "ab") as f:
+        f.write(
+            "id = 1\ncategory = file\npackage = exe\n"
+            "options = procmemdump=yes,free=no,human=yes,route=none\n"
+            "enforce_timeout = False\ntimeout = 120\n"
+            "file_name = sample.exe\nfile_type = PE32 executable\n"
+            "clock = 20171018T120000\nterminate_processes = True\n"
+            "upload_max_size = 100000000\ndo_upload_max_size = 0\n"
+            "pe_exports = \nremote_control = False\n"
+        )
+
+    def load():
+        for _ in xrange(LOG_RECORDS):
+            Config(cfg="analysis.conf")
+
+    return [
+        measure(server, "%d loads" % LOG_RECORDS, 0, load),
+    ]
+
+@benchmark("windows")
+def windows_upload(server, workdir, size):
+    from lib.common.results import unconfirmed, upload_to_host
+    return upload_files(server, workdir, size, upload_to_host,
+                        confirm=unconfirmed.confirm, pids=["1"])
+
+@benchmark("windows", multiplex=False)
+def windows_upload_legacy(server, workdir, size):
+    from lib.common.results import unconfirmed, upload_to_host
+    return upload_files(server, workdir, size, upload_to_host,
+                        confirm=unconfirmed.confirm, pids=["1"])
+
+@benchmark("windows")
+def windows_config(server, workdir, size):
+    from lib.core.config import Config
+    return load_config(server, Config)
+
+@benchmark("windows")
+def windows_log(server, workdir, size):
+    from lib.common.results import NetlogHandler
+    return log_records(server, NetlogHandler())
+
+@benchmark("windows")
+def dump_pool(server, workdir, size):
+    from lib.common.results import UploadPool, unconfirmed
+
+    filepaths = create_files(workdir, 16, size / 16)
+    length = sum(os.path.getsize(filepath) for filepath in filepaths)
+
+    def upload(pool):
+        def fn(filepath):
+            dump_path = "files/%s" % os.path.basename(filepath)
+            return pool.upload(filepath, dump_path, ["1"])
+
+        start = time.time()
+        try:
+            assert all(pool.map(fn, filepaths))
+        finally:
+            pool.close()
+        assert unconfirmed.confirm()
+        return time.time() - start
+
+    ret = []
+    for workers in (1, 4):
+        duration = upload(UploadPool(workers))
+        ret.append(result("%d workers" % workers, length, duration))
+
+    # Uploads are capped at half the bandwidth seen with one worker.
+    bandwidth = length / ret[0]["duration"] / 2
+    duration = upload(UploadPool(4, bandwidth))
+    ret.append(result(
+        "4 workers, capped", length, duration,
+        limit=length / bandwidth
+    ))
+
+    # On loopback the workers mostly compete for the CPU. Over a link with
+    # a long round trip time the throughput of each connection is limited,
+    # which is where the workers' connections of their own pay off.
+    server.bandwidth = length / 4
+    for workers in (1, 4):
+        duration = upload(UploadPool(workers))
+        ret.append(result(
+            "%d workers, slow link" % workers, length, duration
+        ))
+    return ret
+
+@benchmark("windows")
+def upload_priority(server, workdir, size):
+    from lib.common.results import NetlogHandler, unconfirmed
+    from lib.common.results import upload_to_host
+
+    filepath, = create_files(workdir, 1, size)
+    handler = NetlogHandler()
+
+    def log_latency():
+        """Time it takes to get a batch of log records to the result
+        server."""
+        start = time.time()
+        for idx in xrange(100):
+            handler.emit(logging.makeLogRecord({"msg": "record %d" % idx}))
+        handler.flush()
+        return time.time() - start
+
+    ret = [result("log records, idle", 0, log_latency())]
+
+    t = threading.Thread(
+        target=upload_to_host, args=(filepath, "memory/1-1.dmp"),
+        kwargs={"upload_class": "memory"}
+    )
+    start = time.time()
+    t.start()
+    time.sleep(0.05)
+    ret.append(result("log records, busy", 0, log_latency()))
+    t.join()
+    assert unconfirmed.confirm()
+    ret.append(result(
+        "memory dump", os.path.getsize(filepath), time.time() - start
+    ))
+    return ret
+
+@benchmark("windows")
+def dump_large(server, workdir, size):
+    import hashlib
+    from lib.common.hashing import hash_file
+    from lib.common.results import unconfirmed, upload_to_host
+
+    filepath, = create_files(workdir, 1, size)
+
+    def name(sha256):
+        return "files/%s_large.bin" % sha256[:16]
+
+    def hashed_first():
+        """Reads the file twice, to hash it and then to upload it."""
+        dump_path = name(hash_file(hashlib.sha256, filepath))
+        assert upload_to_host(filepath, dump_path, ["1"])
+        assert unconfirmed.confirm()
+
+    def named_afterwards():
+        """Hashes the file while uploading it."""
+        assert upload_to_host(filepath, "files/large.bin", ["1"], name=name)
+        assert unconfirmed.confirm()
+
+    return [
+        measure(server, "hashed first", size, hashed_first),
+        measure(server, "named afterwards", size, named_afterwards),
+    ]
+
+@benchmark("windows")
+def windows_behavior(server, workdir, size):
+    from lib.common.results import NetlogConnection, unconfirmed
+    from lib.common.results import upload_to_host
+
+    # BSON documents as written to the log pipe by the monitor, an eighth of
+    # the data size, which are forwarded the way PipeForwarder does, i.e.,
+    # the stream is opened with the first data read from the pipe.
+    data = "BSON\n" + ("\x00\x04\x00\x00" + "x" * 1020) * (size / 8192)
+    chunks = [data[idx:idx+0x10000] for idx in xrange(0, len(data), 0x10000)]
+
+    def forward():
+        conn = NetlogConnection(proto=chunks[0], upload_class="behavior")
+        conn.connect()
+        for chunk in chunks[1:]:
+            conn.sendall(chunk)
+        conn.close()
+
+    ret = measure(server, "behavior log", len(data), forward)
+
+    # A file that is uploaded right after the behavior log mustn't get stuck
+    # behind it on the result server.
+    filepath, = create_files(workdir, 1, 4096)
+
+    def upload():
+        assert upload_to_host(filepath, "files/small.bin", ["1"])
+        assert unconfirmed.confirm()
+
+    return [ret, measure(server, "file after behavior", 4096, upload)]
+
+@benchmark("linux")
+def linux_upload(server, workdir, size):
+    from lib.common.results import upload_to_host
+    return upload_files(server, workdir, size, upload_to_host)
+
+@benchmark("linux")
+def linux_config(server, workdir, size):
+    from lib.core.config import Config
+    return load_config(server, Config)
+
+@benchmark("linux")
+def linux_log(server, workdir, size):
+    from lib.common.results import NetlogHandler
+    return log_records(server, NetlogHandler())
+
+@benchmark("linux")
+def linux_stap(server, workdir, size):
+    from modules.auxiliary.stap import STAP
+
+    # The SystemTap log is a text file, which is uploaded line by line.
+    with open("stap.log", "wb") as f:
+        for idx in xrange(0, size, 64):
+            f.write("%-63d\n" % idx)
+
+    length = os.path.getsize("stap.log")
+    return [
+        measure(server, "stap log", length,
+                STAP._upload_file, "stap.log", "logs/all.stap"),
+    ]
+
+@benchmark("darwin")
+def darwin_upload(server, workdir, size):
+    from lib.common.results import upload_to_host
+    return upload_files(server, workdir, size, upload_to_host)
+
+@benchmark("darwin")
+def darwin_config(server, workdir, size):
+    from lib.common.config import Config
+    return load_config(server, Config)
+
+@benchmark("darwin")
+def darwin_log(server, workdir, size):
+    from lib.common.results import NetlogHandler
+    return log_records(server, NetlogHandler())
+
+@benchmark("darwin")
+def darwin_bson(server, workdir, size):
+    try:
+        from lib.core.host import CuckooHost
+        from lib.dtrace.apicalls import apicall
+    except ImportError as e:
+        return [result("skipped (%s)" % e, 0, 0)]
+
+    host = CuckooHost("127.0.0.1", server.server_address[1])
+    calls = [
+        apicall("open", ["/etc/hosts", idx], 3, time.time(), 1, 0, 1, 0)
+        for idx in xrange(LOG_RECORDS)
+    ]
+
+    def send():
+        for call in calls:
+            host.send_api(call)
+
+    return [
+        measure(server, "%d api calls" % LOG_RECORDS, 0, send),
+    ]
+
+@benchmark("android")
+def android_upload(server, workdir, size):
+    from lib.common.results import upload_to_host
+    return upload_files(server, workdir, size, upload_to_host)
+
+@benchmark("android")
+def android_config(server, workdir, size):
+    from lib.core.config import Config
+    return load_config(server, Config)
+
+@benchmark("android")
+def android_log(server, workdir, size):
+    from lib.common.results import NetlogHandler
+    return log_records(server, NetlogHandler())
+
+def run_child(name, size):
+    """Runs a single benchmark in this process."""
+    platform, multiplex, fn = BENCHMARKS[name]
+    sys.path.insert(0, os.path.join(ROOT, "analyzer", platform))
+
+    workdir = tempfile.mkdtemp(prefix="netlogbench-")
+    storage = resultserver.Storage(os.path.join(workdir, "storage"))
+    server = resultserver.ResultServer(
+        ("127.0.0.1", 0), storage, multiplex=multiplex
+    )
+
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+
+    try:
+        os.chdir(workdir)
+        with open("analysis.conf", "wb") as f:
+            f.write("[analysis]\nip = 127.0.0.1\nport = %d\n" %
+                    server.server_address[1])
+
+        results = fn(server, workdir, size)
+
+        # Give the result server a moment to finish off the last streams.
+        time.sleep(0.1)
+
+        print json.dumps({
+            "results": results,
+            "server": server.stats.to_dict(),
+        })
+    finally:
+        server.shutdown()
+        os.chdir(ROOT)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def run(name, size):
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), "--child",
+        "--size", str(size), name,
+    ])
+    return json.loads(output.strip().split("\n")[-1])
+
+def report(name, data):
+    for row in data["results"]:
+        line = "%-22s %-24s %8.3fs" % (name, row["name"], row["duration"])
+        if row["bytes"]:
+            line += " %8.1f MB/s" % (
+                row["bytes"] / row["duration"] / 1024 / 1024
+            )
+        if "connections" in row:
+            line += " %5d conns" % row["connections"]
+        if "limit" in row:
+            line += " (limit %.2fs)" % row["limit"]
+        print line
+
+    protocols = data["server"]["protocols"]
+    for protocol, stats in sorted(protocols.items()):
+        print "%-22s   %-8s %5d streams, latency avg %.1fms, max %.1fms" % (
+            "", protocol, stats["streams"], stats["latency_avg"] * 1000,
+            stats["latency_max"] * 1000
+        )
+
+def compare(baseline, results, tolerance):
+    """Compares the durations against those of an earlier run.
+    @return: list of regressions.
+    """
+    ret = []
+    for name, data in results.items():
+        if name not in baseline:
+            continue
+
+        durations = dict(
+            (row["name"], row["duration"])
+            for row in baseline[name]["results"]
+        )
+        for row in data["results"]:
+            duration = durations.get(row["name"])
+            if duration and row["duration"] > duration * (1 + tolerance):
+                ret.append("%s %s: %.3fs, was %.3fs" % (
+                    name, row["name"], row["duration"], duration
+                ))
+    return ret
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmarks", nargs="*", help="Benchmarks to run")
+    parser.add_argument("--size", type=int, default=64,
+                        help="Amount of data to upload (MB)")
+    parser.add_argument("--save", help="Save the results to a JSON file")
+    parser.add_argument("--compare", help="Compare against saved results")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Allowed slowdown when comparing results")
+    parser.add_argument("--child", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.benchmarks[0], args.size)
+        sys.exit(0)
+
+    results = collections.OrderedDict()
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        results[name] = run(name, args.size * 1024 * 1024)
+        report(name, results[name])
+
+    if args.save:
+        with open(args.save, "wb") as f:
+            json.dump(results, f, indent=4)
+
+    if args.compare:
+        with open(args.compare, "rb") as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+
+        for line in regressions:
+            print "Regression: %s" % line
+
+        sys.exit(1 if regressions else 0)
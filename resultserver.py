@@ -0,0 +1,535 @@
+# Copyright (C) 2017 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+"""Stand-in for the Cuckoo result server.
+
+This script implements the host side of the netlog protocol as spoken by the
+analyzers, i.e., the "LOG", "BSON", "FILE", "FILE 2", and "FILE 3" (compressed
+and resumable file upload) protocols, either over one connection per stream or
+multiplexed over a single connection ("MUX"). All artifacts are written to a
+storage directory laid out like an analysis directory. The number of
+connections and the amount of bytes and duration of each stream are recorded
+and printed on exit. This makes it possible to test and benchmark the
+analyzer upload paths on a regular Linux machine, e.g.:
+
+    $ python resultserver.py 127.0.0.1 2042 --storage /tmp/analysis
+
+See also netlogbench.py.
+
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import socket
+import SocketServer
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+BUFSIZE = 1024*1024
+
+# Maximum amount of data buffered per multiplexed stream.
+STREAM_BUFSIZE = 4*1024*1024
+
+FRAME = struct.Struct("!IBI")
+OPEN, DATA, CLOSE, ACK = 1, 2, 3, 4
+
+ACK_INFO = struct.Struct("!QB")
+PENDING, COMPLETE, FAILED = 0, 1, 2
+
+RECORD = struct.Struct("!BQI")
+CHUNK, TRAILER, NAME = 1, 2, 3
+
+# Features advertised to multiplexed connections.
+FEATURES = "compress", "resume", "rename"
+
+class StreamReader(object):
+    """File-like object for reading a stream that is fed from another thread,
+    i.e., one of the streams of a multiplexed connection."""
+
+    def __init__(self, ack=None):
+        # Data that has been read is skipped by its offset rather than
+        # copying what remains of the buffer for every, e.g., 4 byte read.
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.done = False
+        self.cond = threading.Condition()
+        self.ack = ack
+
+    def feed(self, data):
+        with self.cond:
+            # Wait for the reader to catch up, which in turn stalls all
+            # other streams on this connection, i.e., flow control. Once
+            # the reader is done with the stream its data is dropped.
+            while len(self.buf) - self.pos > STREAM_BUFSIZE and \
+                    not self.done:
+                self.cond.wait()
+
+            if not self.done:
+                self.buf = self.buf[self.pos:] + data
+                self.pos = 0
+            self.cond.notify_all()
+
+    def close(self):
+        """Ends the stream. Only a CLOSE frame does so, an empty OPEN or
+        DATA frame doesn't."""
+        with self.cond:
+            self.eof = True
+            self.cond.notify_all()
+
+    def discard(self):
+        """Drops all data of the stream, from now on as well."""
+        with self.cond:
+            self.done = True
+            self.buf, self.pos = "", 0
+            self.cond.notify_all()
+
+    def take(self, size):
+        ret = self.buf[self.pos:self.pos+size]
+        self.pos += len(ret)
+        self.cond.notify_all()
+        return ret
+
+    def read(self, size=BUFSIZE):
+        with self.cond:
+            while self.pos == len(self.buf) and not self.eof:
+                self.cond.wait()
+            return self.take(size)
+
+    def readline(self):
+        with self.cond:
+            while self.buf.find("\n", self.pos) < 0 and not self.eof:
+                self.cond.wait()
+
+            idx = self.buf.find("\n", self.pos) + 1 or len(self.buf)
+            return self.take(idx - self.pos)
+
+class Upload(object):
+    """State of a resumable upload. Until the upload has been completed its
+    data is stored in a ".part" file next to the artifact. A name record
+    replaces the dump path of the artifact, an empty name drops it."""
+
+    def __init__(self, dump_path, path):
+        self.dump_path = dump_path
+        self.path = path
+        self.name = None
+        self.offset = 0
+        self.sha256 = hashlib.sha256()
+        self.status = PENDING
+        self.lock = threading.Lock()
+
+class CountingReader(object):
+    """Counts the bytes read from a file-like object."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.ack = getattr(fd, "ack", None)
+        self.count = 0
+
+    def read(self, size=BUFSIZE):
+        ret = self.fd.read(size)
+        self.count += len(ret)
+        return ret
+
+    def readline(self):
+        ret = self.fd.readline()
+        self.count += len(ret)
+        return ret
+
+class ThrottledReader(object):
+    """Limits the throughput of reading from a connection, the way a link
+    with a long round trip time limits the throughput of a single TCP
+    connection."""
+
+    def __init__(self, fd, rate):
+        self.fd = fd
+        self.rate = float(rate)
+        self.start = time.time()
+        self.count = 0
+
+    def read(self, size=BUFSIZE):
+        return self.throttle(self.fd.read(size))
+
+    def readline(self):
+        return self.throttle(self.fd.readline())
+
+    def throttle(self, data):
+        self.count += len(data)
+        delay = self.start + self.count / self.rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        return data
+
+class Statistics(object):
+    """Keeps track of the connections and of the amount of bytes and the
+    duration, i.e., latency, of each stream per protocol."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.connections = 0
+        self.multiplexed = 0
+        self.protocols = {}
+
+    def connection(self, multiplexed=False):
+        with self.lock:
+            self.connections += 1
+            self.multiplexed += multiplexed
+
+    def stream(self, protocol, length, duration):
+        with self.lock:
+            stats = self.protocols.setdefault(protocol, {
+                "streams": 0,
+                "bytes": 0,
+                "durations": [],
+            })
+            stats["streams"] += 1
+            stats["bytes"] += length
+            stats["durations"].append(duration)
+
+    def to_dict(self):
+        with self.lock:
+            protocols = {}
+            for protocol, stats in self.protocols.items():
+                durations = sorted(stats["durations"])
+                protocols[protocol] = {
+                    "streams": stats["streams"],
+                    "bytes": stats["bytes"],
+                    "throughput": stats["bytes"] / (sum(durations) or 1),
+                    "latency_avg": sum(durations) / len(durations),
+                    "latency_max": durations[-1],
+                }
+
+            return {
+                "duration": time.time() - self.started,
+                "connections": self.connections,
+                "multiplexed": self.multiplexed,
+                "protocols": protocols,
+            }
+
+class Storage(object):
+    """Analysis directory in which the artifacts are stored."""
+
+    def __init__(self, dirpath):
+        self.dirpath = os.path.abspath(dirpath)
+        self.lock = threading.Lock()
+        self.uploads = {}
+        self.bson_count = 0
+
+    def path(self, relpath):
+        """Returns the absolute path of an artifact, making sure that it
+        doesn't escape the storage directory."""
+        path = os.path.abspath(os.path.join(self.dirpath, relpath))
+        if not path.startswith(self.dirpath + os.sep):
+            raise ValueError("Invalid artifact path: %r" % relpath)
+
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return path
+
+    def upload(self, upload_id, dump_path):
+        with self.lock:
+            if upload_id not in self.uploads:
+                self.uploads[upload_id] = Upload(
+                    dump_path, self.path(dump_path)
+                )
+            return self.uploads[upload_id]
+
+    def bson_path(self):
+        """Returns the path for the next behavior log. Without decoding the
+        BSON stream there's no process identifier, so they're numbered."""
+        with self.lock:
+            self.bson_count += 1
+            return self.path("logs/%d.bson" % self.bson_count)
+
+    def log(self, data):
+        with self.lock:
+            with open(self.path("analysis.log"), "ab") as f:
+                f.write(data)
+
+    def add_file(self, dump_path, filepath, pids):
+        with self.lock:
+            with open(self.path("files.json"), "ab") as f:
+                f.write(json.dumps({
+                    "path": dump_path,
+                    "filepath": filepath,
+                    "pids": pids,
+                }) + "\n")
+
+def parse_options(line):
+    """Parses the "key=value key2=value2" option line of "FILE 3"."""
+    ret = {}
+    for field in line.split():
+        if "=" in field:
+            key, value = field.split("=", 1)
+            ret[key] = value
+    return ret
+
+def readall(fd, length):
+    """Reads exactly length bytes unless the stream ends prematurely."""
+    ret = ""
+    while len(ret) < length:
+        buf = fd.read(length - len(ret))
+        if not buf:
+            break
+        ret += buf
+    return ret
+
+def handle_log(storage, fd):
+    buf = fd.read(BUFSIZE)
+    while buf:
+        storage.log(buf)
+        buf = fd.read(BUFSIZE)
+
+def handle_bson(storage, fd):
+    with open(storage.bson_path(), "wb") as f:
+        while True:
+            header = readall(fd, 4)
+            if len(header) != 4:
+                break
+
+            # The documents are framed by their length, but not decoded.
+            length, = struct.unpack("<i", header)
+            data = readall(fd, length - 4)
+            f.write(header + data)
+            if len(data) != length - 4:
+                break
+
+def handle_file(storage, fd, version):
+    dump_path = fd.readline().rstrip("\n")
+    filepath, pids, options = None, [], {}
+    if version >= 2:
+        filepath = fd.readline().rstrip("\n").decode("utf8")
+        pids = [int(pid) for pid in fd.readline().split()]
+    if version >= 3:
+        options = parse_options(fd.readline())
+
+    encoding = options.get("encoding")
+    if encoding and encoding != "zlib":
+        raise ValueError("Unsupported file encoding: %r" % encoding)
+
+    if "upload" in options:
+        upload = storage.upload(options["upload"], dump_path)
+        with upload.lock:
+            completed = handle_upload(storage, fd, upload, encoding)
+
+        if completed and upload.dump_path and filepath:
+            storage.add_file(upload.dump_path, filepath, pids)
+        return
+
+    decompressor = zlib.decompressobj() if encoding else None
+
+    with open(storage.path(dump_path), "wb") as f:
+        buf = fd.read(BUFSIZE)
+        while buf:
+            f.write(decompressor.decompress(buf) if decompressor else buf)
+            buf = fd.read(BUFSIZE)
+
+        if decompressor:
+            f.write(decompressor.flush())
+
+    if filepath:
+        storage.add_file(dump_path, filepath, pids)
+
+def handle_upload(storage, fd, upload, encoding):
+    """Receives the records of a resumable upload, acknowledging each one of
+    them. Returns when the upload has finished or has been interrupted.
+    @return: whether the upload has been completed by this stream.
+    """
+    if not fd.ack:
+        raise ValueError("Resumable uploads require a multiplexed connection")
+
+    fd.ack(upload.offset, upload.status)
+    if upload.status != PENDING:
+        return False
+
+    with open(upload.path + ".part", "r+b" if upload.offset else "wb") as f:
+        f.seek(upload.offset)
+        f.truncate()
+
+        while True:
+            header = readall(fd, RECORD.size)
+            if len(header) != RECORD.size:
+                return False
+
+            record_type, offset, length = RECORD.unpack(header)
+            data = readall(fd, length)
+            if len(data) != length:
+                return False
+
+            if record_type == CHUNK:
+                if offset != upload.offset:
+                    raise ValueError(
+                        "Unexpected chunk offset %d, expected %d" %
+                        (offset, upload.offset)
+                    )
+
+                if encoding:
+                    data = zlib.decompress(data)
+
+                f.write(data)
+                upload.sha256.update(data)
+                upload.offset += len(data)
+                fd.ack(upload.offset, PENDING)
+            elif record_type == NAME:
+                upload.name = data.decode("utf8")
+            elif record_type == TRAILER:
+                break
+
+    if offset != upload.offset or data != upload.sha256.digest():
+        os.unlink(upload.path + ".part")
+        upload.status = FAILED
+    elif upload.name == "":
+        os.unlink(upload.path + ".part")
+        upload.dump_path = None
+        upload.status = COMPLETE
+    else:
+        part = upload.path + ".part"
+        if upload.name:
+            upload.dump_path = upload.name
+            upload.path = storage.path(upload.name)
+        os.rename(part, upload.path)
+        upload.status = COMPLETE
+
+    fd.ack(upload.offset, upload.status)
+    return upload.status == COMPLETE
+
+def handle_stream(server, fd, line=None):
+    """Handles a single netlog stream based on its protocol line."""
+    start, fd = time.time(), CountingReader(fd)
+    line = line or fd.readline()
+    protocol = line.strip()
+
+    try:
+        if line == "LOG\n":
+            handle_log(server.storage, fd)
+        elif line == "BSON\n":
+            handle_bson(server.storage, fd)
+        elif line == "FILE\n":
+            handle_file(server.storage, fd, 1)
+        elif line.startswith("FILE "):
+            handle_file(server.storage, fd, int(line.split()[1]))
+        else:
+            protocol = "unknown"
+            raise ValueError("Unknown netlog protocol requested: %r" % line)
+    finally:
+        server.stats.stream(protocol, fd.count, time.time() - start)
+
+def stream_thread(server, fd):
+    try:
+        handle_stream(server, fd)
+    except Exception as e:
+        print >>sys.stderr, "Error handling netlog stream:", e
+
+    # Drop anything that's left so the connection doesn't stall.
+    fd.discard()
+
+class ResultHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.lock = threading.Lock()
+        fd = self.request.makefile("rb")
+        if self.server.bandwidth:
+            fd = ThrottledReader(fd, self.server.bandwidth)
+
+        line = fd.readline()
+        multiplexed = line == "MUX\n"
+        self.server.stats.connection(multiplexed and self.server.multiplex)
+
+        # Like older result servers, drop the connection for "MUX".
+        if multiplexed and not self.server.multiplex:
+            return
+
+        if not multiplexed:
+            handle_stream(self.server, fd, line)
+            return
+
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.request.sendall("OK %s\n" % " ".join(FEATURES))
+        self.demultiplex(fd)
+
+    def demultiplex(self, fd):
+        streams = {}
+        while True:
+            header = fd.read(FRAME.size)
+            if len(header) != FRAME.size:
+                break
+
+            stream_id, frame_type, length = FRAME.unpack(header)
+            data = fd.read(length)
+
+            if frame_type == OPEN:
+                reader = streams[stream_id] = StreamReader(
+                    ack=self.acknowledger(stream_id)
+                )
+                reader.feed(data)
+
+                t = threading.Thread(
+                    target=stream_thread,
+                    args=(self.server, reader)
+                )
+                t.daemon = True
+                t.start()
+            elif frame_type == DATA and data:
+                streams[stream_id].feed(data)
+            elif frame_type == CLOSE:
+                streams.pop(stream_id).close()
+
+        # Connection is gone, terminate all streams that are still open.
+        for reader in streams.values():
+            reader.close()
+
+    def acknowledger(self, stream_id):
+        def ack(offset, status):
+            data = ACK_INFO.pack(offset, status)
+            with self.lock:
+                self.request.sendall(
+                    FRAME.pack(stream_id, ACK, len(data)) + data
+                )
+        return ack
+
+class ResultServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    # Guests open a connection per uploaded file, with the default backlog
+    # bursts of small files wait on SYN retransmissions.
+    request_queue_size = 128
+
+    def __init__(self, address, storage, multiplex=True, bandwidth=0):
+        """@param bandwidth: bytes per second per connection, 0 for no
+        limit."""
+        SocketServer.TCPServer.__init__(self, address, ResultHandler)
+        self.storage = storage
+        self.multiplex = multiplex
+        self.bandwidth = bandwidth
+        self.stats = Statistics()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("host", nargs="?", default="127.0.0.1")
+    parser.add_argument("port", nargs="?", type=int, default=2042)
+    parser.add_argument("--storage", help="Directory to store artifacts in")
+    parser.add_argument("--no-multiplex", action="store_true",
+                        help="Behave like a result server without MUX support")
+    parser.add_argument("--bandwidth", type=float, default=0,
+                        help="Limit the throughput per connection (MB/s)")
+    args = parser.parse_args()
+
+    storage = Storage(args.storage or tempfile.mkdtemp(prefix="cuckoo-"))
+    print "Storing artifacts in %s" % storage.dirpath
+
+    server = ResultServer(
+        (args.host, args.port), storage, multiplex=not args.no_multiplex,
+        bandwidth=args.bandwidth * 1024 * 1024
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print json.dumps(server.stats.to_dict(), indent=4)